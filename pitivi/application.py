@@ -26,8 +26,10 @@ Main application
 """
 import gobject
 import gtk
+import gst
 import os
 import sys
+import json
 import urllib
 import ges
 import gio
@@ -47,6 +49,10 @@ from pitivi.project import ProjectManager, ProjectLogObserver
 from pitivi.undo.medialibrary import MediaLibraryLogObserver
 from pitivi.undo.undo import UndoableActionLog, DebugActionLogObserver
 from pitivi.dialogs.startupwizard import StartUpWizard
+from pitivi.timeline.thumbnailer import get_thumbnail_store, \
+    remove_legacy_thumbnails
+from pitivi.utils.analysis import get_audio_analysis_service
+import pitivi.autoaligner as autoaligner
 
 from pitivi.utils.signal import Signallable
 from pitivi.utils.system import getSystem
@@ -144,6 +150,11 @@ class Pitivi(Loggable, Signallable):
         self.projectLogObserver = ProjectLogObserver(self.action_log)
         self.medialibrary_log_observer = MediaLibraryLogObserver(self.action_log)
 
+        if autoaligner.numpy is not None:
+            # Compute the envelopes for the aligner when importing media.
+            get_audio_analysis_service().addAnalysis(
+                autoaligner.EnvelopeAnalysis())
+
         self.version_information = {}
         self._checkVersion()
 
@@ -433,7 +444,12 @@ def _parse_options(argv):
     parser = OptionParser(
             usage=_("""
     %prog [PROJECT_FILE]               # Start the video editor.
-    %prog -i [-a] [MEDIA_FILE1 ...]    # Start the editor and create a project."""))
+    %prog -i [-a] [MEDIA_FILE1 ...]    # Start the editor and create a project.
+    %prog --gc-thumbnails              # Clean up the thumbnail cache.
+    %prog --align MEDIA_FILE1 MEDIA_FILE2 ...
+                                       # Report the offsets of media files.
+    %prog --align --layer=LAYER PROJECT_FILE
+                                       # Align the clips of a layer."""))
 
     parser.add_option("-i", "--import", dest="import_sources",
             action="store_true", default=False,
@@ -444,16 +460,51 @@ def _parse_options(argv):
     parser.add_option("-d", "--debug",
             action="store_true", default=False,
             help=_("Run Pitivi in the Python Debugger."))
+    parser.add_option("--gc-thumbnails", dest="gc_thumbnails",
+            action="store_true", default=False,
+            help=_("Remove old and least recently used thumbnails from the "
+                   "cache until it fits its size limit, then exit."))
+    parser.add_option("--align",
+            action="store_true", default=False,
+            help=_("Align the audio of each MEDIA_FILE with the first one, "
+                   "or of each clip of a layer of PROJECT_FILE with the "
+                   "first one, then exit."))
+    parser.add_option("--layer", type="int",
+            help=_("With --align, shift the clips of layer LAYER of "
+                   "PROJECT_FILE and save it."))
+    parser.add_option("--max-offset", dest="max_offset", type="float",
+            help=_("With --align, the largest offset in seconds to "
+                   "consider."))
+    parser.add_option("--drift",
+            action="store_true", default=False,
+            help=_("With --align, estimate the clock drift of each file."))
+    parser.add_option("-o", "--output",
+            help=_("With --align, where to write the JSON report instead "
+                   "of the standard output."))
     options, args = parser.parse_args(argv[1:])
 
     # Validate options.
     if options.add_to_timeline and not options.import_sources:
         parser.error(_("-a requires -i"))
+    if options.gc_thumbnails and (options.import_sources or args):
+        parser.error(_("--gc-thumbnails cannot be used with other arguments"))
+    if options.align and (options.import_sources or options.gc_thumbnails):
+        parser.error(_("--align cannot be used with -i or --gc-thumbnails"))
+    if not options.align and (options.layer is not None or
+            options.max_offset is not None or options.drift or
+            options.output):
+        parser.error(_("--layer, --max-offset, --drift and -o require "
+                       "--align"))
 
     # Validate args.
     if options.import_sources:
         # When no MEDIA_FILE is specified, we just create a new project.
         pass
+    elif options.align:
+        if options.layer is not None and len(args) != 1:
+            parser.error(_("--layer requires a single PROJECT_FILE"))
+        if options.layer is None and len(args) < 2:
+            parser.error(_("--align requires at least two MEDIA_FILEs"))
     else:
         if len(args) > 1:
             parser.error(_("Cannot open more than one PROJECT_FILE"))
@@ -461,8 +512,158 @@ def _parse_options(argv):
     return options, args
 
 
+def _gc_thumbnails():
+    """Enforce the size and age limits of the shared thumbnail store."""
+    store = get_thumbnail_store(GlobalSettings())
+    removed, freed = store.gc()
+    freed += remove_legacy_thumbnails()
+    store.vacuum()
+    store.close()
+    print _("Removed %(count)d thumbnails, %(freed).1f MiB freed, "
+            "%(size).1f MiB in use.") % {"count": removed,
+            "freed": freed / 1048576.0, "size": store.size / 1048576.0}
+    return 0
+
+
+def _loadLayer(project_uri, layer_index):
+    """
+    Load a project without the GUI.
+
+    @returns: the timeline, the formatter used to load it, and the file
+        sources of the layer, or None if the project or layer could not be
+        loaded, for example because a media file is missing
+    """
+    timeline = ges.Timeline()
+    formatter = ges.PitiviFormatter()
+    loop = gobject.MainLoop()
+    loaded = []
+    failed = []
+
+    def loadedCb(formatter, timeline):
+        loaded.append(True)
+        loop.quit()
+
+    def sourceMovedCb(formatter, tfs):
+        # Unlike in the GUI, there is nobody to ask where the file is.
+        print >> sys.stderr, _("Missing file: %s") % tfs.get_uri()
+        failed.append(True)
+        loop.quit()
+
+    def discoveryErrorCb(timeline, tfs, error):
+        print >> sys.stderr, _("Could not load %(uri)s: %(error)s") % {
+            "uri": tfs.get_uri(), "error": error.message}
+        failed.append(True)
+        loop.quit()
+
+    formatter.connect("loaded", loadedCb)
+    formatter.connect("source-moved", sourceMovedCb)
+    timeline.connect("discovery-error", discoveryErrorCb)
+    if not formatter.load_from_uri(timeline, project_uri):
+        return None
+    if not loaded and not failed:
+        loop.run()
+    if failed:
+        return None
+    layers = timeline.get_layers()
+    if not 0 <= layer_index < len(layers):
+        return None
+    sources = [obj for obj in layers[layer_index].get_objects()
+               if isinstance(obj, ges.TimelineFileSource)]
+    sources.sort(key=lambda source: source.props.start)
+    return timeline, formatter, sources
+
+
+def _shiftSources(sources, results):
+    """Move the sources of a layer by the results of a L{BatchAligner}."""
+    reference = sources[0]
+    for source, result in zip(sources[1:], results[1:]):
+        if result is None:
+            continue
+        newstart = reference.props.start + result[0]
+        if newstart >= 0:
+            source.props.start = newstart
+        else:
+            # Like the AutoAligner, chop off the part before zero.
+            source.props.start = 0
+            source.props.in_point = source.props.in_point - newstart
+            source.props.duration = source.props.duration + newstart
+
+
+def _align(options, args):
+    """
+    Align media files, or the clips of a layer of a project, without the
+    GUI, and write a JSON report of the offsets.
+    """
+    if autoaligner.numpy is None:
+        print >> sys.stderr, _("NumPy is required to align media files.")
+        return 1
+    if options.layer is None:
+        uris = ["file://" + urllib.quote(os.path.abspath(media_filename))
+                for media_filename in args]
+        clips = [(uri, 0, None) for uri in uris]
+    else:
+        project_uri = "file://" + urllib.quote(os.path.abspath(args[0]))
+        layer = _loadLayer(project_uri, options.layer)
+        if layer is None:
+            print >> sys.stderr, _("Could not load layer %(layer)d of "
+                "%(project)s.") % {"layer": options.layer, "project": args[0]}
+            return 1
+        timeline, formatter, sources = layer
+        if len(sources) < 2:
+            print >> sys.stderr, _("There is nothing to align.")
+            return 1
+        clips = [(source.props.uri, source.props.in_point,
+                  source.props.duration) for source in sources]
+
+    max_offset = None
+    if options.max_offset is not None:
+        max_offset = long(options.max_offset * gst.SECOND)
+    loop = gobject.MainLoop()
+    results = []
+
+    def alignedCb(clip_results):
+        results.extend(clip_results)
+        loop.quit()
+
+    aligner = autoaligner.BatchAligner(clips, alignedCb,
+                                       max_offset=max_offset,
+                                       estimate_drift=options.drift)
+    aligner.start()
+    loop.run()
+
+    report = {"reference": clips[0][0], "clips": []}
+    for (uri, in_point, duration), result in zip(clips, results):
+        entry = {"uri": uri, "in_point": float(in_point) / gst.SECOND,
+                 "offset": None, "drift": None, "confidence": None}
+        if result is not None:
+            shift, drift, confidence = result
+            entry["offset"] = float(shift) / gst.SECOND
+            entry["drift"] = drift
+            entry["confidence"] = confidence
+        report["clips"].append(entry)
+
+    if options.layer is not None:
+        _shiftSources(sources, results)
+        formatter.set_sources(formatter.get_sources())
+        if not formatter.save_to_uri(timeline, project_uri):
+            print >> sys.stderr, _("Could not save %s.") % args[0]
+            return 1
+
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print
+    return 0 if results and results[0] is not None else 1
+
+
 def main(argv):
     options, args = _parse_options(argv)
+    if options.gc_thumbnails:
+        return _gc_thumbnails()
+    if options.align:
+        return _align(options, args)
     if options.import_sources:
         ptv = ProjectCreatorGuiPitivi(media_filenames=args,
                                       add_to_timeline=options.add_to_timeline,
@@ -30,6 +30,7 @@ import array
 import time
 import gtk
 import os
+import multiprocessing
 
 
 try:
@@ -41,10 +42,28 @@ from gettext import gettext as _
 
 import pitivi.configure as configure
 
+from pitivi.settings import xdg_cache_home
 from pitivi.utils.ui import beautify_ETA
-from pitivi.utils.misc import call_false
-from pitivi.utils.extract import Extractee
+from pitivi.utils.misc import call_false, hash_file
+from pitivi.utils.extract import Extractee, RandomAccessAudioExtractor
+from pitivi.utils.analysis import Analysis, AudioAnalysisService, \
+    MonoExtractee
 from pitivi.utils.loggable import Loggable
+from pitivi.utils.signal import Signallable
+
+
+# the maximum number of envelopes extracted at the same time by default
+MAX_AUTO_WORKERS = 4
+
+# the number of cross-correlation samples computed at once by rigidalign
+_BATCH_SAMPLES = 2 ** 22
+
+# the minimum number of samples per block when estimating the drift
+_MIN_DRIFT_BLOCK = 64
+
+# the half width of the peak of a cross-correlation, which is excluded from
+# the background when estimating the confidence of the peak
+_PEAK_WIDTH = 8
 
 
 def nextpow2(x):
@@ -88,7 +107,29 @@ def submax(left, middle, right):
     # z = (R/L - 1)/(R/L + 1) = (R-L)/(R+L)
 
 
-def rigidalign(reference, targets):
+def _peakconfidence(xcorrs, peaks):
+    """
+    Compute the peak-to-sidelobe ratio of each row of xcorrs: the height of
+    its peak above the mean of the rest of the row, in standard deviations.
+    """
+    rows = numpy.arange(len(xcorrs))
+    L = xcorrs.shape[1]
+    heights = xcorrs[rows, peaks].astype(numpy.float64)
+    background = xcorrs.astype(numpy.float64)
+    background[~numpy.isfinite(background)] = numpy.nan
+    background[rows[:, numpy.newaxis],
+               (peaks[:, numpy.newaxis] +
+                numpy.arange(-_PEAK_WIDTH, _PEAK_WIDTH + 1)) % L] = numpy.nan
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        mean = numpy.nanmean(background, axis=1)
+        std = numpy.nanstd(background, axis=1)
+        confidences = (heights - mean) / std
+    confidences[~numpy.isfinite(confidences)] = 0
+    return confidences
+
+
+def rigidalign(reference, targets, max_offset=None, dtype=None,
+               with_confidence=False):
     """
     Estimate the relative shift between reference and targets.
 
@@ -96,210 +137,365 @@ def rigidalign(reference, targets):
     the maximum of the cross-correlation.  For inputs of length M{N},
     the running time is M{O(C{len(targets)}*N*log(N))}.
 
+    The targets are stacked and transformed together, a batch at a time,
+    which is much faster than one transform per target when there are many
+    short targets.
+
     @param reference: the waveform to regard as fixed
     @type reference: Sequence(Number)
     @param targets: the waveforms that should be aligned to reference
     @type targets: Sequence(Sequence(Number))
+    @param max_offset: if given, the largest absolute shift to consider
+    @type max_offset: L{int}
+    @param dtype: the type of the stacked targets and of the
+        cross-correlations, C{numpy.float32} halving their memory use at
+        the cost of precision
+    @type dtype: C{numpy.dtype}
+    @param with_confidence: whether to return the confidence of each
+        shift too
+    @type with_confidence: L{bool}
     @returns: The shift necessary to bring each target into alignment
         with the reference.  The returned shift may not be an integer,
         indicating that the best alignment would be achieved by a
-        non-integer shift and appropriate interpolation.
-    @rtype: Sequence(Number)
+        non-integer shift and appropriate interpolation.  If
+        with_confidence is True, (shifts, confidences), the confidence
+        of a shift being the peak-to-sidelobe ratio of the
+        cross-correlation, which is typically below 5 for unrelated
+        signals.
+    @rtype: Sequence(Number) or (Sequence(Number), Sequence(Number))
 
     """
+    if dtype is None:
+        dtype = numpy.float64
+    lengths = numpy.array([len(t) for t in targets])
     # L is the maximum size of a cross-correlation between the
     # reference and any of the targets.
-    L = len(reference) + max(len(t) for t in targets) - 1
+    L = len(reference) + int(lengths.max()) - 1
     # We round up L to the next power of 2 for speed in the FFT.
     L = nextpow2(L)
     reference = reference - numpy.mean(reference)
     fref = numpy.fft.rfft(reference, L).conj()
+    # Bound the memory used by the spectra of a batch.
+    batch = max(1, _BATCH_SAMPLES // L)
     shifts = []
-    for t in targets:
-        t = t - numpy.mean(t)
-        # Compute cross-correlation
-        xcorr = numpy.fft.irfft(fref * numpy.fft.rfft(t, L))
+    confidences = []
+    for first in xrange(0, len(targets), batch):
+        stack = numpy.zeros((len(targets[first:first + batch]), L), dtype)
+        for row, t in enumerate(targets[first:first + batch]):
+            stack[row, :len(t)] = t
+            stack[row, :len(t)] -= numpy.mean(t)
+        # Compute the cross-correlations
+        xcorr = numpy.fft.irfft(fref * numpy.fft.rfft(stack, axis=1),
+                                L, axis=1).astype(dtype, copy=False)
+        del stack
+        if max_offset is not None and 2 * max_offset + 1 < L:
+            # Negative shifts are at the end of xcorr, see below.
+            xcorr[:, int(max_offset) + 1:L - int(max_offset)] = -numpy.inf
         # shift maximizes dotproduct(t[shift:],reference)
-        # int() to convert numpy.int32 to python int
-        shift = int(numpy.argmax(xcorr))
-        subsample_shift = submax(xcorr[(shift - 1) % L],
-                                 xcorr[shift],
-                                 xcorr[(shift + 1) % L])
-        shift = shift + subsample_shift
-        # shift is now a float indicating the interpolated maximum
-        if shift >= len(t):  # Negative shifts appear large and positive
-            shift -= L       # This corrects them to be negative
-        shifts.append(-shift)
-        # Sign reversed to move the target instead of the reference
+        rows = numpy.arange(len(xcorr))
+        best = numpy.argmax(xcorr, axis=1)
+        left = xcorr[rows, (best - 1) % L].astype(numpy.float64)
+        middle = xcorr[rows, best].astype(numpy.float64)
+        right = xcorr[rows, (best + 1) % L].astype(numpy.float64)
+        if with_confidence:
+            confidences.extend(_peakconfidence(xcorr, best))
+        for i, shift in enumerate(best):
+            # int() to convert numpy.int32 to python int
+            shift = int(shift)
+            if numpy.isfinite(left[i]) and numpy.isfinite(right[i]):
+                shift = shift + submax(left[i], middle[i], right[i])
+            # shift is now a float indicating the interpolated maximum
+            if shift >= lengths[first + i]:  # Negative shifts appear large
+                shift -= L                   # This corrects them
+            shifts.append(-shift)
+            # Sign reversed to move the target instead of the reference
+    if with_confidence:
+        return shifts, confidences
     return shifts
 
 
-def _findslope(a):
-    # Helper function for affinealign
-    # The provided matrix a contains a bright line whose slope we want to know,
-    # against a noisy background.
-    # The line starts at 0,0.  If the slope is positive, it runs toward the
-    # center of the matrix (i.e. toward (-1,-1))
-    # If the slope is negative, it wraps from 0,0 to 0,-1 and continues toward
-    # the center, (i.e. toward (-1,0)).
-    # The line segment terminates at the midline along the X direction.
-    # We locate the line by simply checking the sum along each possible line
-    # up to the Y-max edge of a.  The caller sets the limit by choosing the
-    # size of a.
-    # The function returns a floating-point slope assuming that the matrix
-    # has "square pixels".
-    Y, X = a.shape
-    X /= 2
-    x_pos = numpy.arange(1, X)
-    x_neg = numpy.arange(2 * X - 1, X, -1)
-    best_end = 0
-    max_sum = 0
-    for end in xrange(Y):
-        y = (x_pos * end) // X
-        s = numpy.sum(a[y, x_pos])
-        if s > max_sum:
-            max_sum = s
-            best_end = end
-        s = numpy.sum(a[y, x_neg])
-        if s > max_sum:
-            max_sum = s
-            best_end = -end
-    return float(best_end) / X
-
-
-def affinealign(reference, targets, max_drift=0.02):
-    """ EXPERIMENTAL FUNCTION.
-
-    Perform an affine registration between a reference and a number of
-    targets.  Designed for aligning the amplitude envelopes of recordings of
-    the same event by different devices.
-
-    NOTE: This method is currently NOT USED by PiTiVi, as it has proven both
-    unnecessary and unusable.  So far every test case has been registered
-    successfully by rigidalign, and until PiTiVi supports time-stretching of
-    audio, the drift calculation cannot actually be used.
+def _blocksum(x, factor):
+    """Decimate x by summing each block of factor consecutive samples."""
+    n = len(x) // factor
+    return numpy.sum(numpy.reshape(x[:n * factor], (n, factor)), 1)
+
+
+def _refineshift(reference, target, center, radius, max_offset=None):
+    """
+    Find the shift between reference and target by computing their
+    cross-correlation directly, around a candidate shift.
+
+    @param center: the candidate shift, with the same meaning as the
+        values returned by L{rigidalign}
+    @type center: L{float}
+    @param radius: the distance from center of the shifts to consider
+    @type radius: L{int}
+    @returns: the shift maximizing the cross-correlation, interpolated to
+        subsample precision
+    @rtype: L{float}
+    """
+    reference = reference - numpy.mean(reference)
+    target = target - numpy.mean(target)
+    center = int(round(center))
+    lo = max(center - radius, 1 - len(target))
+    hi = min(center + radius, len(reference) - 1)
+    if max_offset is not None:
+        lo = max(lo, -int(max_offset))
+        hi = min(hi, int(max_offset))
+    if lo > hi:
+        return float(center)
+    xcorr = numpy.empty((hi - lo + 1,))
+    for i, shift in enumerate(xrange(lo, hi + 1)):
+        # target[m] is compared to reference[m + shift]
+        start = max(0, -shift)
+        end = min(len(target), len(reference) - shift)
+        xcorr[i] = numpy.dot(target[start:end],
+                             reference[start + shift:end + shift])
+    best = int(numpy.argmax(xcorr))
+    shift = float(lo + best)
+    if 0 < best < len(xcorr) - 1:
+        left, middle, right = xcorr[best - 1:best + 2]
+        if 2 * middle - left - right > 0:
+            shift += submax(left, middle, right)
+    return shift
+
+
+def hierarchicalalign(reference, targets, max_offset=None, factor=4,
+                      min_length=1024, with_confidence=False):
+    """
+    Estimate the relative shift between reference and targets, from coarse
+    to fine resolution.
+
+    The signals are decimated by factor until they are shorter than
+    min_length, and aligned by L{rigidalign} at that resolution.  The shift
+    is then refined at each finer resolution by computing the
+    cross-correlation directly, over the few shifts around the previous
+    estimate.  For inputs of length M{N}, the running time is
+    M{O(C{len(targets)}*N*factor)}, instead of a full-length FFT per target.
+
+    The coarsest resolution must retain the features of the signals, or the
+    estimate may be wrong.  When in doubt, use L{rigidalign}.
+
+    @param reference: the waveform to regard as fixed
+    @type reference: Sequence(Number)
+    @param targets: the waveforms that should be aligned to reference
+    @type targets: Sequence(Sequence(Number))
+    @param max_offset: if given, the largest absolute shift to consider
+    @type max_offset: L{int}
+    @param factor: the decimation factor between resolutions
+    @type factor: L{int}
+    @param min_length: the length under which signals are not decimated
+    @type min_length: L{int}
+    @param with_confidence: whether to return the confidence of each
+        shift too, which is computed at the coarsest resolution
+    @type with_confidence: L{bool}
+    @returns: the same as L{rigidalign}
+    @rtype: Sequence(Number) or (Sequence(Number), Sequence(Number))
+
+    """
+    results = [_coarsetofine(reference, t, max_offset, factor, min_length)
+               for t in targets]
+    shifts = [shift for shift, confidence in results]
+    if with_confidence:
+        return shifts, [confidence for shift, confidence in results]
+    return shifts
+
+
+def _coarsetofine(reference, target, max_offset, factor, min_length):
+    # Helper function for hierarchicalalign
+    if min(len(reference), len(target)) < min_length * factor:
+        shifts, confidences = rigidalign(reference, [target], max_offset,
+                                         with_confidence=True)
+        return shifts[0], confidences[0]
+    coarse_max_offset = None
+    if max_offset is not None:
+        coarse_max_offset = -(-max_offset // factor)
+    coarse, confidence = _coarsetofine(_blocksum(reference, factor),
+                                       _blocksum(target, factor),
+                                       coarse_max_offset, factor, min_length)
+    # The coarse estimate is off by less than a coarse sample, give or take
+    # the subsample interpolation.
+    return _refineshift(reference, target, coarse * factor, 2 * factor,
+                        max_offset), confidence
+
+
+def affinealign(reference, targets, max_drift=0.001, max_offset=None,
+                num_blocks=16, with_confidence=False):
+    """
+    Estimate the relative shift and clock drift between reference and
+    targets.
+
+    Designed for aligning the amplitude envelopes of recordings of the same
+    event by devices whose clocks run at slightly different speeds.  Each
+    target is split in num_blocks blocks, which are cross-correlated with the
+    reference together.  Because of the drift, the position of the
+    cross-correlation peak of each block is a linear function of the
+    position of the block.  The line is found by summing the
+    cross-correlations along every candidate line at once, like a Hough
+    transform.
+
+    Targets too short to be split in blocks are aligned by L{rigidalign},
+    with no drift.
 
     @param reference: the reference signal to which others will be registered
-    @type reference: array(number)
+    @type reference: Sequence(Number)
     @param targets: the signals to register
-    @type targets: ordered iterable(array(number))
+    @type targets: Sequence(Sequence(Number))
     @param max_drift: the maximum absolute clock drift rate
-                  (i.e. stretch factor) that will be considered during search
+        (i.e. stretch factor minus one) to consider
     @type max_drift: positive L{float}
-    @return: (offsets, drifts).  offsets[i] is the point in reference at which
-           targets[i] starts.  drifts[i] is the speed of targets[i] relative to
-           the reference (positive is faster, meaning the target should be
-           slowed down to be in sync with the reference)
-    """
-    L = len(reference) + max(len(t) for t in targets) - 1
-    L2 = nextpow2(L)
-    bsize = int(20. / max_drift)  # NEEDS TUNING
-    num_blocks = nextpow2(1.0 * len(reference) // bsize)  # NEEDS TUNING
-    bspace = (len(reference) - bsize) // num_blocks
-    reference -= numpy.mean(reference)
-
-    # Construct FFT'd reference blocks
-    freference_blocks = numpy.zeros((L2 / 2 + 1, num_blocks),
-                                    dtype=numpy.complex)
-    for i in xrange(num_blocks):
-        s = i * bspace
-        tmp = numpy.zeros((L2,))
-        tmp[s:s + bsize] = reference[s:s + bsize]
-        freference_blocks[:, i] = numpy.fft.rfft(tmp, L2).conj()
-    freference_blocks[:10, :] = 0  # High-pass to ignore slow volume variations
+    @param max_offset: if given, the largest absolute shift to consider
+    @type max_offset: L{int}
+    @param num_blocks: the number of blocks each target is split in
+    @type num_blocks: L{int}
+    @param with_confidence: whether to return the confidence of each
+        offset too, as defined by L{rigidalign}
+    @type with_confidence: L{bool}
+    @returns: (offsets, drifts).  C{targets[i][m]} is
+        C{reference[offsets[i] + m * (1 + drifts[i])]}, so a positive drift
+        means that targets[i] is faster than the reference, and should be
+        slowed down to be in sync with it.  If with_confidence is True,
+        (offsets, drifts, confidences).
+    @rtype: (Sequence(Number), Sequence(Number))
 
+    """
+    L = nextpow2(len(reference) + max(len(t) for t in targets) - 1)
+    fref = numpy.fft.rfft(reference - numpy.mean(reference), L).conj()
     offsets = []
     drifts = []
+    confidences = []
     for t in targets:
-        t -= numpy.mean(t)
-        ft = numpy.fft.rfft(t, L2)
-        #fxcorr is the FFT'd cross-correlation with the reference blocks
-        fxcorr_blocks = numpy.zeros((L2 / 2 + 1, num_blocks),
-                                    dtype=numpy.complex)
-        for i in xrange(num_blocks):
-            fxcorr_blocks[:, i] = ft * freference_blocks[:, i]
-            fxcorr_blocks[:, i] /= numpy.sqrt(numpy.sum(
-                    fxcorr_blocks[:, i] ** 2))
-        del ft
-        # At this point xcorr_blocks would show a distinct bright line, nearly
-        # orthogonal to time, indicating where each of these blocks found their
-        # peak.  Each point on this line represents the time in t where block i
-        # found its match.  The time-intercept gives the time in b at which the
-        # reference starts, and the slope gives the amount by which the
-        # reference is faster relative to b.
-
-        # The challenge now is to find this line.  Our strategy is to reduce the
-        # search to one dimension by first finding the slope.
-        # The Fourier Transform of a smooth real line in 2D is an orthogonal
-        # line through the origin, with phase that gives its position.
-        # Unfortunately this line is not clearly visible in fxcorr_blocks, so
-        # we discard the phase (by taking the absolute value) and then inverse
-        # transform.  This places the line at the origin, so we can find its
-        # slope.
-
-        # Construct the half-autocorrelation matrix
-        # (A true autocorrelation matrix would be ifft(abs(fft(x))**2), but this
-        # is just ifft(abs(fft(x))).)
-        # Construction is stepwise partly in an attempt to save memory
-        # The width is 2*num_blocks in order to avoid overlapping positive and
-        # negative correlations
-        halfautocorr = numpy.fft.fft(fxcorr_blocks, 2 * num_blocks, 1)
-        halfautocorr = numpy.abs(halfautocorr)
-        halfautocorr = numpy.fft.ifft(halfautocorr, None, 1)
-        halfautocorr = numpy.fft.irfft(halfautocorr, None, 0)
-        # Now it's actually the half-autocorrelation.
-        # Chop out the bit we don't care about
-        halfautocorr = halfautocorr[:bspace * num_blocks * max_drift, :]
-        # Remove the local-correlation peak.
-        halfautocorr[-1:2, -1:2] = 0  # NEEDS TUNING
-        # Normalize each column (appears to be necessary)
-        for i in xrange(2 * num_blocks):
-            halfautocorr[:, i] /= numpy.sqrt(numpy.sum(
-                    halfautocorr[:, i] ** 2))
-        #from matplotlib.pyplot import imshow,show
-        #imshow(halfautocorr,interpolation='nearest',aspect='auto');show()
-        drift = _findslope(halfautocorr) / bspace
-        del halfautocorr
-
-        #inverse transform and shift everything into alignment
-        xcorr_blocks = numpy.fft.irfft(fxcorr_blocks, None, 0)
-        del fxcorr_blocks
-        #TODO: see if phase ramps are worthwhile here
-        for i in xrange(num_blocks):
-            blockcenter = i * bspace + bsize / 2
-            shift = int(blockcenter * drift)
-            if shift > 0:
-                temp = xcorr_blocks[:shift, i].copy()
-                xcorr_blocks[:-shift, i] = xcorr_blocks[shift:, i].copy()
-                xcorr_blocks[-shift:, i] = temp
-            elif shift < 0:
-                temp = xcorr_blocks[shift:, i].copy()
-                xcorr_blocks[-shift:, i] = xcorr_blocks[:shift, i].copy()
-                xcorr_blocks[:-shift, i] = temp
-
-        #from matplotlib.pyplot import imshow,show
-        #imshow(xcorr_blocks,interpolation='nearest',aspect='auto');show()
-
-        # xcorr is the drift-compensated cross-correlation
-        xcorr = numpy.sum(xcorr_blocks, axis=1)
-        del xcorr_blocks
-
-        offset = numpy.argmax(xcorr)
-        #from matplotlib.pyplot import plot,show
-        #plot(xcorr);show()
-        del xcorr
-        if offset >= len(t):
-            offset -= L2
-
-        # now offset is the point in target at which reference starts and
-        # drift is the speed with which the reference drifts relative to the
-        # target.  We reverse these relationships for the caller.
-        slope = 1 + drift
-        offsets.append(-offset / slope)
-        drifts.append(1 / slope - 1)
+        blocks = min(num_blocks, len(t) // _MIN_DRIFT_BLOCK)
+        if blocks < 2:
+            shifts, shift_confidences = rigidalign(reference, [t],
+                max_offset, with_confidence=True)
+            offset, drift, confidence = shifts[0], 0.0, shift_confidences[0]
+        else:
+            offset, drift, confidence = _affineshift(fref, L, t, max_drift,
+                                                     max_offset, blocks)
+        offsets.append(offset)
+        drifts.append(drift)
+        confidences.append(confidence)
+    if with_confidence:
+        return offsets, drifts, confidences
     return offsets, drifts
 
 
+def _affineshift(fref, L, target, max_drift, max_offset, num_blocks):
+    # Helper function for affinealign
+    n = len(target)
+    edges = numpy.arange(num_blocks + 1) * n // num_blocks
+    stack = numpy.zeros((num_blocks, L))
+    for j in xrange(num_blocks):
+        block = target[edges[j]:edges[j + 1]]
+        stack[j, edges[j]:edges[j + 1]] = block - numpy.mean(block)
+    # xcorrs[j] is the cross-correlation of the j-th block, with the same
+    # layout as in rigidalign.
+    xcorrs = numpy.fft.irfft(fref * numpy.fft.rfft(stack, axis=1), L, axis=1)
+    del stack
+
+    # The sum of the blocks peaks near the shift of the middle of the target.
+    total = xcorrs.sum(axis=0)
+    if max_offset is not None and 2 * max_offset + 1 < L:
+        total[int(max_offset) + 1:L - int(max_offset)] = -numpy.inf
+    center = int(numpy.argmax(total))
+    confidence = _peakconfidence(total[numpy.newaxis, :],
+                                 numpy.array([center]))[0]
+    del total
+
+    # The line is within radius of center at the middle of the target, and
+    # moves by less than radius / 2 on either side.
+    radius = int(numpy.ceil(max_drift * n)) + 2
+    window = xcorrs[:, (center + numpy.arange(-2 * radius,
+                                              2 * radius + 1)) % L]
+    del xcorrs
+    # Normalize the blocks so that the loudest ones don't dominate.
+    norms = numpy.sqrt(numpy.sum(window ** 2, axis=1))
+    norms[norms == 0] = 1
+    window /= norms[:, numpy.newaxis]
+
+    positions = (edges[:-1] + edges[1:] - 1) / 2.0
+    middle = numpy.mean(positions)
+    positions -= middle
+    # The slopes are spaced so that the ends of neighbouring lines are half
+    # a sample apart.
+    step = 0.5 / (positions[-1] - positions[0])
+    count = int(numpy.ceil(max_drift / step))
+    slopes = numpy.arange(-count, count + 1) * step
+    intercepts = numpy.arange(-radius, radius + 1) + 2 * radius
+    columns = numpy.arange(num_blocks)
+    acc = numpy.empty((len(slopes), len(intercepts)))
+    # Bound the memory used by the lines of a batch of slopes.
+    batch = max(1, _BATCH_SAMPLES // (len(intercepts) * num_blocks))
+    for first in xrange(0, len(slopes), batch):
+        # rows[k, i, j] is where the line of slope k through intercept i
+        # crosses the cross-correlation of block j.
+        rows = (intercepts[numpy.newaxis, :, numpy.newaxis] +
+                slopes[first:first + batch, numpy.newaxis, numpy.newaxis] *
+                positions[numpy.newaxis, numpy.newaxis, :])
+        rows = numpy.clip(rows, 0, 4 * radius)
+        lower = numpy.minimum(rows.astype(int), 4 * radius - 1)
+        frac = rows - lower
+        acc[first:first + batch] = numpy.sum(
+            (1 - frac) * window[columns, lower] +
+            frac * window[columns, lower + 1], axis=2)
+        del rows, lower, frac
+
+    k, i = numpy.unravel_index(numpy.argmax(acc), acc.shape)
+    del acc
+    # Refine the line by fitting it to the subsample position of the peak of
+    # each block, near the line.
+    rows = numpy.clip(numpy.round(intercepts[i] + slopes[k] * positions),
+                      2, 4 * radius - 2).astype(int)
+    near = window[columns[:, numpy.newaxis],
+                  rows[:, numpy.newaxis] + numpy.arange(-2, 3)]
+    best = numpy.argmax(near, axis=1)
+    peaks = rows + best - 2.0
+    weights = near[columns, best]
+    for j in numpy.nonzero((best > 0) & (best < 4))[0]:
+        left, middle_near, right = near[j, best[j] - 1:best[j] + 2]
+        if 2 * middle_near - left - right > 0:
+            peaks[j] += submax(left, middle_near, right)
+    slope, shift = slopes[k], float(intercepts[i])
+    if numpy.sum(weights > 0) >= 2:
+        weights = numpy.maximum(weights, 0)
+        slope, shift = numpy.polyfit(positions, peaks, 1, w=weights)
+        slope = float(numpy.clip(slope, -max_drift, max_drift))
+    shift += center - 2 * radius
+    # shift is the position of the cross-correlation peak for the middle of
+    # the target, see rigidalign.
+    shift %= L
+    if shift >= n:
+        shift -= L
+    # Sign reversed to move the target instead of the reference
+    drift = -slope
+    return -shift - drift * middle, drift, confidence
+
+
+def envelopeRange(in_point, out_point, blockrate):
+    """
+    Get the range of the envelope of a stream covering a part of it.
+
+    @param in_point: The start of the part of the stream, in nanoseconds
+    @type in_point: L{long}
+    @param out_point: The end of the part of the stream, in nanoseconds, or
+        None for the end of the stream
+    @type out_point: L{long}
+    @param blockrate: The number of envelope blocks per second
+    @type blockrate: L{int}
+    @returns: the first block, the block after the last one or None, and
+        the fraction of a block by which the first one starts before
+        in_point
+    @rtype: (L{int}, L{int}, L{float})
+    """
+    position = float(in_point * blockrate) / gst.SECOND
+    first = int(position)
+    last = None
+    if out_point is not None:
+        last = -(-out_point * blockrate // gst.SECOND)
+    return first, last, position - first
+
+
 def getAudioTrack(timeline_object):
     """Helper function for getting an audio track from a TimelineObject
 
@@ -351,6 +547,10 @@ class ProgressAggregator(ProgressMeter):
         self._portions = []
         self._start = time.time()
         self._watchers = []
+        # Whether a call to _callForward() is already scheduled. The portions
+        # may be updated by several threads at once, this avoids flooding
+        # the main loop with redundant reports.
+        self._pending = False
 
     def getPortionCB(self, target):
         """Prepare a new input for the Aggregator.
@@ -374,7 +574,9 @@ class ProgressAggregator(ProgressMeter):
 
         def cb(thusfar):
             self._portions[i] = thusfar
-            gobject.idle_add(self._callForward)
+            if not self._pending:
+                self._pending = True
+                gobject.idle_add(self._callForward)
         return cb
 
     def addWatcher(self, function):
@@ -385,9 +587,10 @@ class ProgressAggregator(ProgressMeter):
         # invoked via gobject.idle_add(). Use of idle_add() is necessary
         # to ensure that watchers are always called from the main thread,
         # even if progress updates are received from other threads.
+        self._pending = False
         total_target = sum(self._targets)
         total_completed = sum(self._portions)
-        if total_target == 0:
+        if total_target == 0 or total_completed == 0:
             return False
         frac = min(1.0, float(total_completed) / total_target)
         now = time.time()
@@ -405,6 +608,12 @@ class EnvelopeExtractee(Extractee, Loggable):
     over each block.  This class computes the envelope incrementally,
     so that the entire signal does not ever need to be stored.
 
+    The received buffers are processed in place, without copying them,
+    except for the samples of the last incomplete block which are carried
+    over to the next buffer.  The envelope is stored in an array whose
+    capacity doubles whenever it is full, so that the cost of extending it
+    stays proportional to its length.
+
     """
 
     def __init__(self, blocksize, callback, *cbargs):
@@ -421,21 +630,67 @@ class EnvelopeExtractee(Extractee, Loggable):
         self._blocksize = blocksize
         self._cb = callback
         self._cbargs = cbargs
-        self._blocks = numpy.zeros((0,), dtype=numpy.float32)
-        self._empty = array.array('f', [])
-        # self._samples buffers up to self._threshold samples, before
-        # their envelope is computed and store in self._blocks, in order
+        # The envelope is self._blocks[:self._nblocks], the rest of
+        # self._blocks being spare capacity.
+        self._blocks = numpy.zeros((1024,), dtype=numpy.float32)
+        self._nblocks = 0
+        # The first self._ncarry items of self._carry are the samples of an
+        # incomplete block, waiting for the next buffer.
+        self._carry = numpy.zeros((blocksize,), dtype=numpy.float32)
+        self._ncarry = 0
+        self._received = 0
+        # The watchers are notified every self._threshold samples, in order
         # to amortize some of the function call overheads.
-        self._samples = array.array('f', [])
         self._threshold = 2000 * blocksize
+        self._notified = 0
         self._progress_watchers = []
 
     def receive(self, a):
-        self._samples.extend(a)
-        if len(self._samples) < self._threshold:
-            return
-        else:
-            self._process_samples()
+        samples = self._asArray(a)
+        self._received += len(samples)
+        if self._ncarry:
+            # complete the carried over block first
+            taken = min(len(samples), self._blocksize - self._ncarry)
+            self._carry[self._ncarry:self._ncarry + taken] = samples[:taken]
+            self._ncarry += taken
+            samples = samples[taken:]
+            if self._ncarry == self._blocksize:
+                self._appendBlocks(self._carry.reshape((1, self._blocksize)))
+                self._ncarry = 0
+        newblocks = len(samples) // self._blocksize
+        if newblocks:
+            self._appendBlocks(samples[:newblocks * self._blocksize].reshape(
+                (newblocks, self._blocksize)))
+        excess = len(samples) - newblocks * self._blocksize
+        if excess:
+            self._carry[:excess] = samples[-excess:]
+            self._ncarry = excess
+        if self._received - self._notified >= self._threshold:
+            self._notified = self._received
+            for w in self._progress_watchers:
+                w(self._received)
+
+    def _asArray(self, a):
+        """Get a float32 numpy array of the samples in a, without copying
+        them if possible."""
+        if isinstance(a, numpy.ndarray):
+            return a.astype(numpy.float32, copy=False).ravel()
+        if isinstance(a, array.array) and a.typecode == 'f':
+            return numpy.frombuffer(a, dtype=numpy.float32)
+        return numpy.asarray(a, dtype=numpy.float32).ravel()
+
+    def _appendBlocks(self, blocks):
+        newblocks = len(blocks)
+        end = self._nblocks + newblocks
+        if end > len(self._blocks):
+            grown = numpy.zeros((max(end, 2 * len(self._blocks)),),
+                                dtype=numpy.float32)
+            grown[:self._nblocks] = self._blocks[:self._nblocks]
+            self._blocks = grown
+        # This sum relies on blocks being a floating-point type.  If it
+        # were int16 then the sum may overflow.
+        numpy.abs(blocks).sum(axis=1, out=self._blocks[self._nblocks:end])
+        self._nblocks = end
 
     def addWatcher(self, w):
         """
@@ -447,33 +702,164 @@ class EnvelopeExtractee(Extractee, Loggable):
         """
         self._progress_watchers.append(w)
 
-    def _process_samples(self):
-        excess = len(self._samples) % self._blocksize
-        if excess != 0:
-            samples_to_process = self._samples[:-excess]
-            self._samples = self._samples[-excess:]
-        else:
-            samples_to_process = self._samples
-            self._samples = array.array('f', [])
-        self.debug("Adding %s samples to %s blocks",
-                   len(samples_to_process), len(self._blocks))
-        newblocks = len(samples_to_process) // self._blocksize
-        samples_abs = numpy.abs(
-                samples_to_process).reshape((newblocks, self._blocksize))
-        self._blocks.resize((len(self._blocks) + newblocks,))
-        # This numpy.sum() call relies on samples_abs being a
-        # floating-point type. If samples_abs.dtype is int16
-        # then the sum may overflow.
-        self._blocks[-newblocks:] = numpy.sum(samples_abs, 1)
+    def finalize(self):
+        # The samples of an incomplete last block are ignored.
+        self.debug("Extracted %s blocks from %s samples",
+                   self._nblocks, self._received)
         for w in self._progress_watchers:
-            w(self._blocksize * len(self._blocks) + excess)
+            w(self._received)
+        self._cb(self._blocks[:self._nblocks], *self._cbargs)
 
-    def finalize(self):
-        self._process_samples()  # absorb any remaining buffered samples
-        self._cb(self._blocks, *self._cbargs)
+    def envelope(self):
+        """
+        Get a copy of the envelope computed so far.  Unlike the other
+        methods, this may be called from any thread.
 
+        @rtype: C{numpy.ndarray}
+
+        """
+        # self._nblocks is read first, because self._blocks is only ever
+        # replaced by a larger array starting with the same blocks.
+        nblocks = self._nblocks
+        return self._blocks[:nblocks].copy()
+
+
+class EnvelopeCache(Loggable):
+
+    """
+    On-disk cache of the amplitude envelopes computed by L{AutoAligner}.
+
+    There is one file per media content hash, audio stream index and block
+    rate, holding a contiguous range of blocks of the envelope of the
+    stream. It starts with the index of the first block and whether the
+    range reaches the end of the stream, as little-endian int32, followed
+    by the blocks as little-endian float32. The ranges cached for the same
+    stream are merged when they overlap or touch.
+    """
+
+    def __init__(self, directory=None):
+        """
+        @param directory: Where to store the envelopes, by default in the
+            user cache directory.
+        @type directory: L{str}
+        """
+        Loggable.__init__(self)
+        if directory is None:
+            directory = os.path.join(xdg_cache_home(), "envelopes")
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._directory = directory
+
+    def _path(self, media_hash, stream_index, blockrate):
+        return os.path.join(self._directory, "%s-%d-%d.env" %
+                            (media_hash, stream_index, blockrate))
+
+    def _read(self, path, blocks=True):
+        """
+        @returns: the first block of the cached range, whether it reaches
+            the end of the stream, and its blocks, or their number if blocks
+            is False, or None if nothing is cached
+        """
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as envelope_file:
+            header = numpy.fromfile(envelope_file, dtype="<i4", count=2)
+            if len(header) < 2:
+                return None
+            if blocks:
+                data = numpy.fromfile(envelope_file, dtype="<f4")
+            else:
+                data = (os.path.getsize(path) - header.nbytes) // 4
+        return int(header[0]), bool(header[1]), data
+
+    @staticmethod
+    def _covers(start, complete, length, first, last):
+        end = start + length
+        if start > first:
+            return False
+        if last is None:
+            return complete
+        return complete or end >= last
+
+    def contains(self, media_hash, stream_index, blockrate, first=0,
+                 last=None):
+        """
+        @param first: The first block needed
+        @type first: L{int}
+        @param last: The block after the last one needed, or None for the
+            end of the stream
+        @type last: L{int}
+        @returns: whether these blocks of the envelope are cached
+        @rtype: L{bool}
+        """
+        cached = self._read(self._path(media_hash, stream_index, blockrate),
+                            blocks=False)
+        return cached is not None and self._covers(*(cached + (first, last)))
 
-class AutoAligner(Loggable):
+    def get(self, media_hash, stream_index, blockrate, first=0, last=None):
+        """
+        Get a part of a cached envelope.
+
+        @param first: The first block needed
+        @type first: L{int}
+        @param last: The block after the last one needed, or None for the
+            end of the stream
+        @type last: L{int}
+        @returns: the blocks, fewer than requested if the stream ends
+            before last, or None if they are not all cached
+        @rtype: numpy array of float32, or L{NoneType}
+        """
+        cached = self._read(self._path(media_hash, stream_index, blockrate))
+        if cached is None:
+            return None
+        start, complete, envelope = cached
+        if not self._covers(start, complete, len(envelope), first, last):
+            return None
+        if last is None:
+            return envelope[first - start:]
+        return envelope[first - start:last - start]
+
+    def put(self, media_hash, stream_index, blockrate, envelope, first=0,
+            complete=False):
+        """
+        Cache a part of an envelope, merging it with the part already cached
+        for the same stream if they overlap or touch, and replacing it
+        otherwise.
+
+        @param first: The index of the first block of envelope in the
+            envelope of the stream
+        @type first: L{int}
+        @param complete: Whether envelope reaches the end of the stream
+        @type complete: L{bool}
+        """
+        path = self._path(media_hash, stream_index, blockrate)
+        envelope = numpy.asarray(envelope, dtype="<f4")
+        end = first + len(envelope)
+        cached = self._read(path)
+        if cached is not None:
+            start, cached_complete, blocks = cached
+            cached_end = start + len(blocks)
+            if start <= end and first <= cached_end:
+                merged_first = min(start, first)
+                merged = numpy.zeros((max(end, cached_end) - merged_first,),
+                                     dtype="<f4")
+                merged[start - merged_first:cached_end - merged_first] = \
+                    blocks
+                merged[first - merged_first:end - merged_first] = envelope
+                complete = ((complete and end >= cached_end) or
+                            (cached_complete and cached_end >= end))
+                first, envelope = merged_first, merged
+        # write to a temporary file so that readers never see a partial one
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as envelope_file:
+            numpy.array([first, complete], dtype="<i4").tofile(envelope_file)
+            envelope.tofile(envelope_file)
+        os.rename(tmp_path, path)
+        self.debug("Cached blocks %d to %d in %s", first,
+                   first + len(envelope), path)
+
+
+class AutoAligner(Signallable, Loggable):
 
     """
     Class for aligning a set of L{TimelineObject}s automatically.
@@ -482,8 +868,18 @@ class AutoAligner(Loggable):
     are synchronized.  The current implementation only analyzes audio
     data, so timeline objects without an audio track cannot be aligned.
 
+    Signals:
+     - C{offsets-estimated}: In incremental mode, provisional shifts have
+       been computed from the envelopes extracted so far.  The results map
+       each object to be aligned to its shift in nanoseconds relative to
+       the reference, and the confidence of the shift.
+
     """
 
+    __signals__ = {
+        "offsets-estimated": ["results"],
+    }
+
     BLOCKRATE = 25
     """
     @ivar BLOCKRATE: The number of amplitude blocks per second.
@@ -501,7 +897,30 @@ class AutoAligner(Loggable):
 
     """
 
-    def __init__(self, timeline_objects, callback):
+    PROVISIONAL_SECONDS = 60
+    """
+    @ivar PROVISIONAL_SECONDS: In incremental mode, the duration of
+    envelope each object needs before the first provisional shifts are
+    computed.  The shifts are computed again whenever the envelopes have
+    doubled in length.
+    """
+
+    PROVISIONAL_INTERVAL = 1000
+    """
+    @ivar PROVISIONAL_INTERVAL: In incremental mode, how often in
+    milliseconds to check whether the provisional shifts can be computed.
+    """
+
+    CONFIDENCE_THRESHOLD = 10
+    """
+    @ivar CONFIDENCE_THRESHOLD: In incremental mode, the extraction stops
+    as soon as every provisional shift has at least this confidence, and
+    is within a block of the previous estimate.  See L{rigidalign}.
+    """
+
+    def __init__(self, timeline_objects, callback, max_workers=None,
+                 envelope_cache=None, max_offset=None, estimate_drift=False,
+                 incremental=False):
         """
         @param timeline_objects: an iterable of L{TimelineObject}s.
             In this implementation, only L{TimelineObject}s with at least one
@@ -510,6 +929,25 @@ class AutoAligner(Loggable):
         @param callback: A function to call when alignment is complete.  No
             arguments will be provided.
         @type callback: function
+        @param max_workers: The maximum number of envelopes to extract at the
+            same time, by default one per CPU core up to MAX_AUTO_WORKERS.
+        @type max_workers: L{int}
+        @param envelope_cache: Where to look for previously computed
+            envelopes, and store the new ones.
+        @type envelope_cache: L{EnvelopeCache}
+        @param max_offset: If given, the largest shift in nanoseconds to
+            consider between the objects and the reference, which makes
+            the alignment faster and more robust when the objects are known
+            to be roughly aligned already.
+        @type max_offset: L{long}
+        @param estimate_drift: Whether to estimate the clock drift of each
+            object relative to the reference too, using L{affinealign}.
+        @type estimate_drift: L{bool}
+        @param incremental: Whether to estimate the shifts while the
+            envelopes are being extracted, emitting C{offsets-estimated},
+            and to stop extracting them as soon as the shifts are
+            confident.
+        @type incremental: L{bool}
 
         """
         Loggable.__init__(self)
@@ -517,11 +955,41 @@ class AutoAligner(Loggable):
         # are initially None prior to envelope extraction.
         self._timeline_objects = dict.fromkeys(timeline_objects)
         self._callback = callback
-        # stack of (Track, Extractee) pairs waiting to be processed
+        if max_workers is None:
+            max_workers = min(multiprocessing.cpu_count(), MAX_AUTO_WORKERS)
+        self._max_workers = max(1, max_workers)
+        # stack of (TimelineObject, Track, Extractee) waiting to be processed
         # When start() is called, the stack will be populated, and then
-        # processed sequentially.  Only one item from the stack will be
-        # actively in process at a time.
+        # processed by up to self._max_workers extractors at a time, a new
+        # one being started whenever one of them is done.
         self._extraction_stack = []
+        # maps each TimelineObject being processed to its extractor
+        self._extractors = {}
+        # maps each TimelineObject being processed or waiting to be
+        # processed to its extractee
+        self._extractees = {}
+        if envelope_cache is None:
+            envelope_cache = EnvelopeCache()
+        self._envelope_cache = envelope_cache
+        self._max_offset = max_offset
+        # Maps each TimelineObject to the cache key of its stream and the
+        # range of blocks of its envelope in the stream envelope.
+        self._envelope_ranges = {}
+        # Maps each TimelineObject to the fraction of a block by which its
+        # envelope starts before its in-point.
+        self._phases = {}
+        self._estimate_drift = estimate_drift
+        # Maps each aligned TimelineObject to its shift in nanoseconds
+        # relative to the reference, and its drift, or None if it was not
+        # estimated.
+        self.results = {}
+        self._incremental = incremental
+        # The minimum length in blocks of the envelopes being extracted
+        # before computing the next provisional shifts
+        self._provisional_length = self.PROVISIONAL_SECONDS * self.BLOCKRATE
+        # Maps each TimelineObject to its last provisional shift
+        self._provisional = {}
+        self._done = False
 
     @staticmethod
     def canAlign(timeline_objects):
@@ -543,21 +1011,91 @@ class AutoAligner(Loggable):
         return all(getAudioTrack(t) is not None for t in timeline_objects)
 
     def _extractNextEnvelope(self):
-        audiotrack, extractee = self._extraction_stack.pop()
-        r = RandomAccessAudioExtractor(audiotrack.factory,
-                                       audiotrack.stream)
-        r.extract(extractee, audiotrack.in_point,
-                  audiotrack.out_point - audiotrack.in_point)
+        while (self._extraction_stack and
+               len(set(self._extractors.values())) < self._max_workers):
+            entry = self._extraction_stack.pop()
+            audiotrack = entry[1]
+            r = RandomAccessAudioExtractor(audiotrack.factory,
+                                           audiotrack.stream)
+            # The objects using the same stream share the extractor, which
+            # coalesces their extractions into a single run.
+            same_stream = [other for other in self._extraction_stack
+                           if other[1].factory is audiotrack.factory and
+                           other[1].stream is audiotrack.stream]
+            for other in same_stream:
+                self._extraction_stack.remove(other)
+            for timeline_object, audiotrack, extractee in \
+                    [entry] + same_stream:
+                self._extractors[timeline_object] = r
+                # Extract whole blocks, from the start of the block
+                # containing in_point to the end of the one containing
+                # out_point, which would be dropped if incomplete, so that
+                # the envelope can be cached as a range of the envelope of
+                # the stream.
+                key, first, last = self._envelope_ranges[timeline_object]
+                r.extract(extractee, first * gst.SECOND // self.BLOCKRATE,
+                          (last - first) * gst.SECOND // self.BLOCKRATE)
         return False
 
     def _envelopeCb(self, array, timeline_object):
+        # The extractors run concurrently and may call this from their
+        # streaming threads, so the bookkeeping is done in the main thread.
+        gobject.idle_add(call_false, self._envelopeReady, array,
+                         timeline_object)
+
+    def _envelopeReady(self, array, timeline_object):
+        if timeline_object not in self._extractors:
+            # The extraction was stopped early.
+            return
         self.debug("Receiving envelope for %s", timeline_object)
+        key, first, last = self._envelope_ranges[timeline_object]
+        # Fewer blocks than requested means that the stream ended.
+        self._envelope_cache.put(*(key + (array,)), first=first,
+                                 complete=len(array) < last - first)
         self._timeline_objects[timeline_object] = array
+        del self._extractors[timeline_object]
         if self._extraction_stack:
             self._extractNextEnvelope()
-        else:  # This was the last envelope
-            self._performShifts()
-            self._callback()
+        elif not self._extractors:  # This was the last envelope
+            self._alignmentDone()
+
+    def _alignmentDone(self):
+        self._done = True
+        self._performShifts()
+        self._callback()
+        return False
+
+    def _envelopeKey(self, audiotrack):
+        """
+        Get the key of the envelope of the stream of audiotrack in the
+        envelope cache.
+        """
+        factory = audiotrack.factory
+        media_hash = hash_file(gst.uri_get_location(factory.uri))
+        stream_index = factory.getOutputStreams(AudioStream).index(
+            audiotrack.stream)
+        return media_hash, stream_index, self.BLOCKRATE
+
+    def _cachedEnvelope(self, timeline_object, audiotrack):
+        """
+        Look for the envelope of audiotrack in the envelope cache.
+
+        @returns: whether the envelope was found, in which case it is
+            ready to be aligned.
+        @rtype: L{bool}
+        """
+        key = self._envelopeKey(audiotrack)
+        first, last, phase = envelopeRange(audiotrack.in_point,
+                                           audiotrack.out_point,
+                                           self.BLOCKRATE)
+        self._envelope_ranges[timeline_object] = key, first, last
+        self._phases[timeline_object] = phase
+        envelope = self._envelope_cache.get(*(key + (first, last)))
+        if envelope is None:
+            return False
+        self.debug("Using the cached envelope of %s", timeline_object)
+        self._timeline_objects[timeline_object] = envelope
+        return True
 
     def start(self):
         """
@@ -578,18 +1116,23 @@ class AutoAligner(Loggable):
                 self._timeline_objects.pop(timeline_object)
         if len(pairs) >= 2:
             for timeline_object, audiotrack in pairs:
+                if self._cachedEnvelope(timeline_object, audiotrack):
+                    continue
                 # blocksize is the number of samples per block
                 blocksize = audiotrack.stream.rate // self.BLOCKRATE
                 extractee = EnvelopeExtractee(blocksize, self._envelopeCb,
                                               timeline_object)
-                # numsamples is the total number of samples in the track,
+                # numsamples is the total number of samples to extract,
                 # which is used by progress_aggregator to determine
                 # the percent completion.
-                numsamples = ((audiotrack.duration / gst.SECOND) *
+                numsamples = (((audiotrack.out_point -
+                                audiotrack.in_point) / gst.SECOND) *
                               audiotrack.stream.rate)
                 extractee.addWatcher(
                         progress_aggregator.getPortionCB(numsamples))
-                self._extraction_stack.append((audiotrack, extractee))
+                self._extraction_stack.append((timeline_object, audiotrack,
+                                               extractee))
+                self._extractees[timeline_object] = extractee
             # After we return, start the extraction cycle.
             # This gobject.idle_add call should not be necessary;
             # we should be able to invoke _extractNextEnvelope directly
@@ -599,12 +1142,88 @@ class AutoAligner(Loggable):
             # occasional deadlocks during autoalignment.
             # This call to idle_add() reportedly eliminates the deadlock.
             # No one knows why.
-            gobject.idle_add(self._extractNextEnvelope)
+            if self._extraction_stack:
+                gobject.idle_add(self._extractNextEnvelope)
+                if self._incremental:
+                    gobject.timeout_add(self.PROVISIONAL_INTERVAL,
+                                        self._provisionalAlign)
+            else:  # every envelope was cached
+                gobject.idle_add(self._alignmentDone)
         else:  # We can't do anything without at least two audio tracks
             # After we return, call the callback function (once)
             gobject.idle_add(call_false, self._callback)
         return progress_aggregator
 
+    def _currentEnvelope(self, timeline_object):
+        """
+        Get the envelope of timeline_object if it is complete, or the part
+        extracted so far.
+
+        @returns: the envelope, and whether it is complete
+        @rtype: (C{numpy.ndarray}, L{bool})
+        """
+        envelope = self._timeline_objects[timeline_object]
+        if envelope is not None:
+            return envelope, True
+        return self._extractees[timeline_object].envelope(), False
+
+    def _provisionalAlign(self):
+        if self._done:
+            return False
+        envelopes = dict((timeline_object,
+                          self._currentEnvelope(timeline_object))
+                         for timeline_object in self._timeline_objects)
+        partial = [len(envelope)
+                   for envelope, complete in envelopes.itervalues()
+                   if not complete]
+        if not partial or min(partial) < self._provisional_length:
+            return True
+        self._provisional_length = 2 * min(partial)
+
+        reference = self._chooseReference()
+        reference_envelope = envelopes.pop(reference)[0]
+        pairs = [(timeline_object, envelope)
+                 for timeline_object, (envelope, complete)
+                 in envelopes.iteritems()]
+        shifts, confidences = rigidalign(reference_envelope,
+                                         [envelope for unused, envelope
+                                          in pairs],
+                                         self._maxOffsetBlocks(),
+                                         with_confidence=True)
+        results = {}
+        confident = True
+        for (movable, envelope), shift, confidence in zip(pairs, shifts,
+                                                          confidences):
+            shift += self._phases[movable] - self._phases[reference]
+            tshift = int((shift * gst.SECOND) / self.BLOCKRATE)
+            previous = self._provisional.get(movable)
+            if (confidence < self.CONFIDENCE_THRESHOLD or previous is None or
+                    abs(tshift - previous) > gst.SECOND // self.BLOCKRATE):
+                confident = False
+            self._provisional[movable] = tshift
+            results[movable] = (tshift, confidence)
+        self.debug("Provisional shifts from %i blocks: %s",
+                   self._provisional_length // 2, results)
+        self.emit("offsets-estimated", results)
+        if not confident:
+            return True
+
+        self.debug("The shifts are confident, stopping the extraction")
+        for extractor in set(self._extractors.itervalues()):
+            extractor.stop()
+        self._extractors.clear()
+        self._extraction_stack = []
+        self._timeline_objects[reference] = reference_envelope
+        for movable, envelope in pairs:
+            self._timeline_objects[movable] = envelope
+        self._alignmentDone()
+        return False
+
+    def _maxOffsetBlocks(self):
+        if self._max_offset is None:
+            return None
+        return -(-self._max_offset * self.BLOCKRATE // gst.SECOND)
+
     def _chooseReference(self):
         """
         Chooses the timeline object to use as a reference.
@@ -633,12 +1252,24 @@ class AutoAligner(Loggable):
         # (In python 3, dict.items() returns an unordered dictview)
         pairs = list(self._timeline_objects.items())
         envelopes = [p[1] for p in pairs]
-        offsets = rigidalign(reference_envelope, envelopes)
-        for (movable, envelope), offset in zip(pairs, offsets):
+        max_offset = self._maxOffsetBlocks()
+        if self._estimate_drift:
+            offsets, drifts = affinealign(reference_envelope, envelopes,
+                                          max_offset=max_offset)
+        else:
+            offsets = hierarchicalalign(reference_envelope, envelopes,
+                                        max_offset)
+            drifts = [None] * len(offsets)
+        for (movable, envelope), offset, drift in zip(pairs, offsets,
+                                                      drifts):
+            # The envelopes start at a block boundary, up to one block before
+            # the in-point of their object.
+            offset += self._phases[movable] - self._phases[reference]
             # tshift is the offset rescaled to units of nanoseconds
             tshift = int((offset * gst.SECOND) / self.BLOCKRATE)
-            self.debug("Shifting %s to %i ns from %i",
-                       movable, tshift, reference.start)
+            self.debug("Shifting %s to %i ns from %i, drift %s",
+                       movable, tshift, reference.start, drift)
+            self.results[movable] = (tshift, drift)
             newstart = reference.start + tshift
             if newstart >= 0:
                 movable.start = newstart
@@ -652,6 +1283,156 @@ class AutoAligner(Loggable):
                 movable.duration += newstart
 
 
+class EnvelopeAnalysis(Analysis):
+
+    """
+    Compute the envelopes of media files for the L{AutoAligner}, with an
+    L{AudioAnalysisService}.  Like the AutoAligner, the envelope is
+    computed from the first audio stream, downmixed to mono.
+    """
+
+    def __init__(self, envelope_cache=None):
+        """
+        @param envelope_cache: Where to store the envelopes
+        @type envelope_cache: L{EnvelopeCache}
+        """
+        if envelope_cache is None:
+            envelope_cache = EnvelopeCache()
+        self.envelope_cache = envelope_cache
+
+    def isCached(self, media_hash):
+        # The AutoAligner caches the envelopes of the ranges it aligns, only
+        # an envelope of the whole stream is enough.
+        return self.envelope_cache.contains(media_hash, 0,
+                                            AutoAligner.BLOCKRATE, 0, None)
+
+    def makeExtractee(self, media_hash, rate, channels):
+        extractee = EnvelopeExtractee(rate // AutoAligner.BLOCKRATE,
+                                      self._envelopeCb, media_hash)
+        return MonoExtractee(extractee, channels)
+
+    def _envelopeCb(self, envelope, media_hash):
+        self.envelope_cache.put(media_hash, 0, AutoAligner.BLOCKRATE,
+                                envelope, complete=True)
+
+
+class BatchAligner(Loggable):
+
+    """
+    Align media files or clips without a timeline, for batch processing.
+
+    Unlike L{AutoAligner}, the envelopes of the files are extracted by an
+    L{AudioAnalysisService} running as many pipelines at once as there are
+    CPU cores by default, and the shifts are reported instead of being
+    applied.  The first clip is the reference.
+
+    """
+
+    def __init__(self, clips, callback, max_workers=None,
+                 envelope_cache=None, max_offset=None, estimate_drift=False):
+        """
+        @param clips: The clips to align, as (uri, in_point, duration)
+            tuples in nanoseconds, a duration of None meaning until the end
+            of the file.
+        @type clips: list of (L{str}, L{long}, L{long})
+        @param callback: A function to call with the results when the
+            alignment is complete.  There is one result per clip: None if
+            the clip could not be analyzed, or (shift, drift, confidence),
+            shift being the position in nanoseconds of the start of the clip
+            relative to the start of the reference.  See L{affinealign} and
+            L{rigidalign} for drift, which is None unless estimated, and
+            confidence.
+        @type callback: function
+        @param max_workers: The maximum number of files to decode at the
+            same time, by default the number of CPU cores.
+        @type max_workers: L{int}
+        @param envelope_cache: See L{AutoAligner}.
+        @type envelope_cache: L{EnvelopeCache}
+        @param max_offset: See L{AutoAligner}.
+        @type max_offset: L{long}
+        @param estimate_drift: See L{AutoAligner}.
+        @type estimate_drift: L{bool}
+        """
+        Loggable.__init__(self)
+        self._clips = clips
+        self._callback = callback
+        self._analysis = EnvelopeAnalysis(envelope_cache)
+        self._service = AudioAnalysisService([self._analysis], max_workers)
+        self._max_offset = max_offset
+        self._estimate_drift = estimate_drift
+        # Maps each uri to the content hash of the file, None if its
+        # envelope could not be extracted.
+        self._hashes = {}
+
+    def start(self):
+        """
+        Start extracting the envelopes which are not cached yet.
+        """
+        uris = set(clip[0] for clip in self._clips)
+        self._remaining = len(uris)
+        for uri in uris:
+            self._service.analyze(uri, self._analyzedCb)
+
+    def _analyzedCb(self, uri, success):
+        media_hash = None
+        if success:
+            media_hash = hash_file(gst.uri_get_location(uri))
+        self._hashes[uri] = media_hash
+        self._remaining -= 1
+        if not self._remaining:
+            self._align()
+
+    def _align(self):
+        clips = []
+        for uri, in_point, duration in self._clips:
+            media_hash = self._hashes[uri]
+            if media_hash is None:
+                clips.append(None)
+                continue
+            out_point = None
+            if duration is not None:
+                out_point = in_point + duration
+            first, last, phase = envelopeRange(in_point, out_point,
+                                               AutoAligner.BLOCKRATE)
+            # None if the cached envelope does not cover the clip, which
+            # should not happen once the file has been analyzed.
+            envelope = self._analysis.envelope_cache.get(media_hash, 0,
+                AutoAligner.BLOCKRATE, first, last)
+            if envelope is None:
+                self.warning("The envelope of %s is not cached", uri)
+            clips.append((envelope, phase)
+                         if envelope is not None and len(envelope) else None)
+
+        results = [None] * len(clips)
+        targets = [i for i, clip in enumerate(clips[1:], 1)
+                   if clip is not None]
+        if clips[0] is None or not targets:
+            self._callback(results)
+            return False
+
+        reference, reference_phase = clips[0]
+        envelopes = [clips[i][0] for i in targets]
+        max_offset = None
+        if self._max_offset is not None:
+            max_offset = -(-self._max_offset * AutoAligner.BLOCKRATE //
+                           gst.SECOND)
+        if self._estimate_drift:
+            offsets, drifts, confidences = affinealign(reference, envelopes,
+                max_offset=max_offset, with_confidence=True)
+        else:
+            offsets, confidences = hierarchicalalign(reference, envelopes,
+                max_offset, with_confidence=True)
+            drifts = [None] * len(offsets)
+        results[0] = (0, 0.0 if self._estimate_drift else None, None)
+        for i, offset, drift, confidence in zip(targets, offsets, drifts,
+                                                confidences):
+            offset += clips[i][1] - reference_phase
+            tshift = int((offset * gst.SECOND) / AutoAligner.BLOCKRATE)
+            results[i] = (tshift, drift, float(confidence))
+        self._callback(results)
+        return False
+
+
 class AlignmentProgressDialog:
     """ Dialog indicating the progress of the auto-alignment process.
         Code derived from L{RenderingProgressDialog}, but greatly simplified
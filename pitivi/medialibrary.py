@@ -35,7 +35,6 @@ import time
 from urllib import unquote
 from gettext import gettext as _
 from hashlib import md5
-from gst.pbutils import Discoverer, DiscovererVideoInfo
 
 from pitivi.configure import get_pixmap_dir
 from pitivi.settings import GlobalSettings
@@ -43,9 +42,13 @@ from pitivi.mediafilespreviewer import PreviewWidget
 from pitivi.dialogs.filelisterrordialog import FileListErrorDialog
 from pitivi.dialogs.clipmediaprops import clipmediapropsDialog
 from pitivi.utils.ui import beautify_length
-from pitivi.utils.misc import PathWalker, quote_uri
+from pitivi.utils.misc import PathWalker, call_false, quote_uri
+from pitivi.utils.analysis import analyze_imported
+from pitivi.utils.discovery import DiscovererPool, get_discovery_cache
+from pitivi.utils.search import MediaSearchIndex
 from pitivi.utils.signal import SignalGroup, Signallable
 from pitivi.utils.loggable import Loggable
+from pitivi.utils.threads import Thread
 import pitivi.utils.ui as dnd
 from pitivi.utils.ui import beautify_info, info_name, SPACING, PADDING
 
@@ -75,7 +78,8 @@ GlobalSettings.addConfigOption('lastClipView',
  COL_URI,
  COL_LENGTH,
  COL_SEARCH_TEXT,
- COL_SHORT_TEXT) = range(8)
+ COL_SHORT_TEXT,
+ COL_VISIBLE) = range(9)
 
 (LOCAL_FILE,
  LOCAL_DIR,
@@ -110,19 +114,30 @@ ui = '''
 INVISIBLE = gtk.gdk.pixbuf_new_from_file(os.path.join(get_pixmap_dir(),
     "invisible.png"))
 
+# The time in seconds spent adding discovered sources to the view per idle
+# callback, so that the UI stays responsive during big imports.
+ADD_ROWS_BUDGET = 0.02
+# The number of sources waiting to be added from which the views are
+# detached from the model until they are all added.
+DETACH_VIEWS_THRESHOLD = 100
+
 
 class MediaLibraryError(Exception):
     pass
 
 
 class MediaLibrary(Signallable, Loggable):
-    discovererClass = Discoverer
+    discovererClass = DiscovererPool
 
     """
     Contains the sources for a project, stored as SourceFactory objects.
 
-    @ivar discoverer: The discoverer object used internally
-    @type discoverer: L{Discoverer}
+    @ivar discoverer: The discoverers used internally, as many as there
+    are CPU cores.
+    @type discoverer: L{DiscovererPool}
+    @ivar discovery_cache: The results of the previous discoveries. The
+    files found there are added without being discovered again.
+    @type discovery_cache: L{DiscoveryCache}
     @ivar nb_files_to_import: The number of URIs on the last addUris call.
     @type nb_files_to_import: int
     @ivar nb_imported_files: The number of URIs loaded since the last addUris
@@ -147,7 +162,7 @@ class MediaLibrary(Signallable, Loggable):
         "starting": [],
         }
 
-    def __init__(self):
+    def __init__(self, discovery_cache=None):
         Loggable.__init__(self)
         Signallable.__init__(self)
         # A (URI -> SourceFactory) map.
@@ -155,11 +170,17 @@ class MediaLibrary(Signallable, Loggable):
         # A list of SourceFactory objects.
         self._ordered_sources = []
         self._resetImportCounters()
-
-        self.discoverer = self.discovererClass.new(gst.SECOND)
+        if discovery_cache is None:
+            discovery_cache = get_discovery_cache()
+        self.discovery_cache = discovery_cache
+        # The number of URIs given to the discoverer and not reported yet.
+        self._discovering = 0
+        # The infos found in the discovery cache, added in an idle callback.
+        self._cached_infos = []
+
+        self.discoverer = self.discovererClass(timeout=gst.SECOND)
         self.discoverer.connect("discovered", self.addDiscovererInfo)
         self.discoverer.connect("finished", self.finishDiscovererCb)
-        self.discoverer.start()
 
     def _resetImportCounters(self):
         self.nb_files_to_import = 0
@@ -167,9 +188,22 @@ class MediaLibrary(Signallable, Loggable):
 
     def finishDiscovererCb(self, unused_discoverer):
         self.debug("Got the discoverer's finished signal")
+        self._discovering = 0
+        if self._cached_infos:
+            # _addCachedInfos will emit ready.
+            return
         self._resetImportCounters()
         self.emit("ready")
 
+    def _addCachedInfos(self):
+        infos = self._cached_infos
+        self._cached_infos = []
+        for info in infos:
+            self.addDiscovererInfo(None, info, None)
+        if not self._discovering:
+            self.finishDiscovererCb(None)
+        return False
+
     def addUris(self, uris):
         """
         Add c{uris} to the source list.
@@ -185,8 +219,16 @@ class MediaLibrary(Signallable, Loggable):
             # searching for duplicates
             uri = quote_uri(uri)
             if uri not in self._sources:
-                self.discoverer.discover_uri_async(uri)
-                self.debug("Added a uri to discoverer async")
+                info = self.discovery_cache.get(uri)
+                if info is not None:
+                    if not self._cached_infos:
+                        gobject.idle_add(self._addCachedInfos)
+                    self._cached_infos.append(info)
+                    self.debug("Found a uri in the discovery cache")
+                else:
+                    self._discovering += 1
+                    self.discoverer.discover_uri_async(uri)
+                    self.debug("Added a uri to discoverer async")
             else:
                 self.nb_files_to_import -= 1
                 self.debug('"%s" is already in the media library' % uri)
@@ -198,6 +240,15 @@ class MediaLibrary(Signallable, Loggable):
         else:
             self.debug("Done adding all URIs to discoverer async")
 
+    def cancelImport(self):
+        """
+        Stop discovering the files being imported. The files already
+        discovered stay in the source list.
+        """
+        self.debug("Cancelling the discovery of the remaining files")
+        self.discoverer.cancel()
+        self.finishDiscovererCb(self.discoverer)
+
     def removeUri(self, uri):
         """
         Remove the info for c{uri} from the source list.
@@ -234,13 +285,20 @@ class MediaLibrary(Signallable, Loggable):
     def addDiscovererInfo(self, discoverer, info, error):
         """
         Add the specified SourceFactory to the list of sources.
+
+        @param discoverer: The discoverer which found info, or None if it
+        was found in the discovery cache.
         """
+        if discoverer is not None:
+            self._discovering -= 1
         if error:
             self.emit("discovery-error", info.get_uri(), error.message)
         else:
             uri = info.get_uri()
             if self._sources.get(uri, None) is not None:
                 raise MediaLibraryError("We already have info for this URI", uri)
+            if discoverer is not None:
+                self.discovery_cache.put(info)
             self._sources[uri] = info
             self._ordered_sources.append(info)
             self.nb_imported_files += 1
@@ -256,6 +314,54 @@ class MediaLibrary(Signallable, Loggable):
         return self._ordered_sources
 
 
+class ThumbnailLoader(Thread):
+    """
+    Thread loading the thumbnails of video files from the freedesktop
+    thumbnails directory (~/.thumbnails). The filenames are simply the file
+    URI hashed with md5.
+    """
+
+    # the number of thumbnails handed to the main thread at once
+    BATCH_SIZE = 20
+
+    def __init__(self, uris, callback):
+        """
+        @param uris: The URIs of the video files
+        @type uris: C{list} of C{str}
+        @param callback: A function called in the main thread with lists of
+        (uri, thumbnail, large thumbnail) tuples, the files without a
+        thumbnail being left out, and whether all the files are done.
+        @type callback: function(C{list}, C{bool})
+        """
+        Thread.__init__(self)
+        self.uris = uris
+        self.callback = callback
+
+    def process(self):
+        thumb_dir = os.path.expanduser("~/.thumbnails/")
+        thumbnails = []
+        for uri in self.uris:
+            thumbnail_hash = md5(uri).hexdigest()
+            thumb_path_normal = thumb_dir + "normal/" + thumbnail_hash + ".png"
+            # Pitivi used to consider 64 pixels as normal and 96 as large
+            # However, the fdo spec specifies 128 as normal and 256 as large.
+            # We will thus simply use the "normal" size and scale it down.
+            try:
+                thumbnail_large = gtk.gdk.pixbuf_new_from_file(
+                    thumb_path_normal)
+            except gobject.GError:
+                # TODO gst discoverer should create missing thumbnails.
+                continue
+            thumbnail_height = int(thumbnail_large.get_height() / 2)
+            thumbnail = thumbnail_large.scale_simple(64, thumbnail_height,
+                gtk.gdk.INTERP_BILINEAR)
+            thumbnails.append((uri, thumbnail, thumbnail_large))
+            if len(thumbnails) == self.BATCH_SIZE:
+                gobject.idle_add(call_false, self.callback, thumbnails, False)
+                thumbnails = []
+        gobject.idle_add(call_false, self.callback, thumbnails, True)
+
+
 class MediaLibraryWidget(gtk.VBox, Loggable):
     """ Widget for listing sources """
 
@@ -272,11 +378,21 @@ class MediaLibraryWidget(gtk.VBox, Loggable):
         self._errors = []
         self._project = None
         self.dummy_selected = []
+        # The sources added to the media library and not to the model yet.
+        self._pending_infos = []
+        self._add_rows_id = None
+        self._views_detached = False
+        self._detached_selection = []
+        # A (URI -> gtk.TreeRowReference) map of the rows of the model.
+        self._row_refs = {}
+        # The URIs of the video files whose thumbnails are to be loaded.
+        self._pending_thumbnails = []
+        self._loading_thumbnails = False
 
         # Store
         # icon, infotext, objectfactory, uri, length
         self.storemodel = gtk.ListStore(gtk.gdk.Pixbuf, gtk.gdk.Pixbuf,
-            str, object, str, str, str, str)
+            str, object, str, str, str, str, bool)
 
         # Scrolled Windows
         self.treeview_scrollwin = gtk.ScrolledWindow()
@@ -324,7 +440,10 @@ class MediaLibraryWidget(gtk.VBox, Loggable):
         # Filtering model for the search box.
         # Use this instead of using self.storemodel directly
         self.modelFilter = self.storemodel.filter_new()
-        self.modelFilter.set_visible_func(self._setRowVisible, data=searchEntry)
+        # The rows matching the search are found with an index, and marked
+        # as visible in the model.
+        self._search_index = MediaSearchIndex()
+        self.modelFilter.set_visible_column(COL_VISIBLE)
 
         # TreeView
         # Displays icon, name, type, length
@@ -417,8 +536,16 @@ class MediaLibraryWidget(gtk.VBox, Loggable):
         actions_area.add(self._view_error_btn)
         actions_area.add(self._hide_infobar_btn)
 
-        # The _progressbar that shows up when importing clips
+        # The _progressbar that shows up when importing clips, with a button
+        # to stop importing.
         self._progressbar = gtk.ProgressBar()
+        cancel_import_btn = gtk.Button(stock=gtk.STOCK_CANCEL)
+        cancel_import_btn.set_tooltip_text(_("Stop importing the files"))
+        cancel_import_btn.connect("clicked", self._cancelImportClickedCb)
+        self._import_hbox = gtk.HBox()
+        self._import_hbox.set_spacing(SPACING)
+        self._import_hbox.pack_start(self._progressbar)
+        self._import_hbox.pack_start(cancel_import_btn, expand=False)
 
         # Connect to project.  We must remove and reset the callbacks when
         # changing project.
@@ -532,7 +659,7 @@ class MediaLibraryWidget(gtk.VBox, Loggable):
         self.pack_start(self.search_hbox, expand=False)
         self.pack_start(self.iconview_scrollwin)
         self.pack_start(self.treeview_scrollwin)
-        self.pack_start(self._progressbar, expand=False)
+        self.pack_start(self._import_hbox, expand=False)
 
         # display the help text
         self.clip_view = self.settings.lastClipView
@@ -593,22 +720,19 @@ class MediaLibraryWidget(gtk.VBox, Loggable):
         self._insertNextSource()
 
     def _searchEntryChangedCb(self, entry):
-        self.modelFilter.refilter()
+        shown, hidden = self._search_index.setQuery(entry.get_text())
+        # Only the rows whose visibility changed are filtered again.
+        for uris, visible in ((shown, True), (hidden, False)):
+            for uri in uris:
+                row_ref = self._row_refs.get(uri)
+                if row_ref is not None and row_ref.valid():
+                    self.storemodel.set_value(
+                        self.storemodel.get_iter(row_ref.get_path()),
+                        COL_VISIBLE, visible)
 
     def _searchEntryIconClickedCb(self, entry, unused, unsed1):
         entry.set_text("")
 
-    def _setRowVisible(self, model, iter, data):
-        """
-        Toggle the visibility of a liststore row.
-        Used for the search box.
-        """
-        text = data.get_text().lower()
-        if text == "":
-            return True  # Avoid silly warnings
-        else:
-            return text in model.get_value(iter, COL_INFOTEXT).lower()
-
     def _getIcon(self, iconname, alternate=None):
         icontheme = gtk.icon_theme_get_default()
         pixdir = get_pixmap_dir()
@@ -725,7 +849,13 @@ class MediaLibraryWidget(gtk.VBox, Loggable):
 
     def _addFolders(self, folders):
         """ walks the trees of the folders in the list and adds the files it finds """
-        self.app.threads.addThread(PathWalker, folders, self.app.current.medialibrary.addUris)
+        medialibrary = self.app.current.medialibrary
+
+        def addUris(uris):
+            # the walker runs in its own thread
+            gobject.idle_add(call_false, medialibrary.addUris, uris)
+
+        self.app.threads.addThread(PathWalker, folders, addUris)
 
     def _updateProgressbar(self):
         """
@@ -742,76 +872,151 @@ class MediaLibraryWidget(gtk.VBox, Loggable):
         elif total_clips != 0:
             self._progressbar.set_fraction((current_clip_iter - 1) / float(total_clips))
 
-    def _addDiscovererInfo(self, info):
-        # The code below tries to read existing thumbnails from the freedesktop
-        # thumbnails directory (~/.thumbnails). The filenames are simply
-        # the file URI hashed with md5, so we can retrieve them easily.
-        if [i for i in info.get_stream_list() if\
-            isinstance(i, DiscovererVideoInfo)]:
-            thumbnail_hash = md5(info.get_uri()).hexdigest()
-            thumb_dir = os.path.expanduser("~/.thumbnails/")
-            thumb_path_normal = thumb_dir + "normal/" + thumbnail_hash + ".png"
-            thumb_path_large = thumb_dir + "large/" + thumbnail_hash + ".png"
-            # Pitivi used to consider 64 pixels as normal and 96 as large
-            # However, the fdo spec specifies 128 as normal and 256 as large.
-            # We will thus simply use the "normal" size and scale it down.
-            try:
-                thumbnail = gtk.gdk.pixbuf_new_from_file(thumb_path_normal)
-                thumbnail_large = thumbnail
-                thumbnail_height = int(thumbnail.get_height() / 2)
-                thumbnail = thumbnail.scale_simple(64, thumbnail_height, \
-                    gtk.gdk.INTERP_BILINEAR)
-            except:
-                # TODO gst discoverer should create missing thumbnails.
-                thumbnail = self.videofilepixbuf
-                thumbnail_large = thumbnail
+    def _rowForInfo(self, info):
+        """
+        Build the row of the model for a source. The thumbnails of video
+        files are loaded later by a L{ThumbnailLoader}.
+        """
+        if info.get_video_streams():
+            thumbnail = self.videofilepixbuf
         else:
             thumbnail = self.audiofilepixbuf
-            thumbnail_large = self.audiofilepixbuf
 
         if info.get_duration() == gst.CLOCK_TIME_NONE:
             duration = ''
         else:
             duration = beautify_length(info.get_duration())
 
+        name = info_name(info)
         short_text = None
-        uni = unicode(info_name(info), 'utf-8')
+        uni = unicode(name, 'utf-8')
 
         if len(uni) > 34:
             short_uni = uni[0:29]
             short_uni += unicode('...')
             short_text = short_uni.encode('utf-8')
         else:
-            short_text = info_name(info)
+            short_text = name
 
-        self.storemodel.append([thumbnail,
-            thumbnail_large,
+        return [thumbnail,
+            thumbnail,
             beautify_info(info),
             info,
             info.get_uri(),
             duration,
-            info_name(info),
-            short_text])
+            name,
+            short_text,
+            self._search_index.add(info)]
 
-    # medialibrary callbacks
+    def _addPendingInfos(self):
+        """
+        Add the pending sources to the model, for at most ADD_ROWS_BUDGET
+        seconds.
 
-    def _sourceAddedCb(self, unused_medialibrary, factory):
-        """ a file was added to the medialibrary """
+        @return: Whether sources are still pending.
+        """
+        if (not self._views_detached and
+                len(self._pending_infos) >= DETACH_VIEWS_THRESHOLD):
+            # Don't let the views update themselves for every row.
+            self._detached_selection = self.getSelectedPaths()
+            self.treeview.set_model(None)
+            self.iconview.set_model(None)
+            self._views_detached = True
+
+        deadline = time.time() + ADD_ROWS_BUDGET
+        video_uris = []
+        added = 0
+        for info in self._pending_infos:
+            uri = info.get_uri()
+            row_iter = self.storemodel.append(self._rowForInfo(info))
+            self._row_refs[uri] = gtk.TreeRowReference(self.storemodel,
+                self.storemodel.get_path(row_iter))
+            if info.get_video_streams():
+                video_uris.append(uri)
+            added += 1
+            if time.time() > deadline:
+                break
+        del self._pending_infos[:added]
+        self._loadThumbnails(video_uris)
         self._updateProgressbar()
-        self._addDiscovererInfo(factory)
+
+        if self._pending_infos:
+            return True
+        self._add_rows_id = None
+        self._attachViews()
         if len(self.storemodel):
             self.infobar.hide_all()
             self.search_hbox.show_all()
+        return False
+
+    def _attachViews(self):
+        if not self._views_detached:
+            return
+        self._views_detached = False
+        self.treeview.set_model(self.modelFilter)
+        self.iconview.set_model(self.modelFilter)
+        for path in self._detached_selection:
+            self._viewSelectPath(path)
+        self._detached_selection = []
+
+    def _clearStore(self):
+        """Remove all the sources from the model, pending ones included."""
+        if self._add_rows_id is not None:
+            gobject.source_remove(self._add_rows_id)
+            self._add_rows_id = None
+        self._pending_infos = []
+        self._pending_thumbnails = []
+        self._row_refs = {}
+        self._detached_selection = []
+        self._search_index.clear()
+        self.storemodel.clear()
+        self._attachViews()
+
+    def _loadThumbnails(self, uris):
+        self._pending_thumbnails.extend(uris)
+        if self._loading_thumbnails or not self._pending_thumbnails:
+            return
+        self._loading_thumbnails = True
+        self.app.threads.addThread(ThumbnailLoader, self._pending_thumbnails,
+            self._thumbnailsLoadedCb)
+        self._pending_thumbnails = []
+
+    def _thumbnailsLoadedCb(self, thumbnails, done):
+        for uri, thumbnail, thumbnail_large in thumbnails:
+            row_ref = self._row_refs.get(uri)
+            if row_ref is None or not row_ref.valid():
+                # removed in the meantime
+                continue
+            row_iter = self.storemodel.get_iter(row_ref.get_path())
+            self.storemodel.set(row_iter, COL_ICON, thumbnail,
+                COL_ICON_LARGE, thumbnail_large)
+        if done:
+            self._loading_thumbnails = False
+            self._loadThumbnails([])
+
+    # medialibrary callbacks
+
+    def _sourceAddedCb(self, unused_medialibrary, factory):
+        """ a file was added to the medialibrary """
+        # The rows are added in batches, from an idle callback.
+        self._pending_infos.append(factory)
+        if self._add_rows_id is None:
+            self._add_rows_id = gobject.idle_add(self._addPendingInfos)
+        # Decode the audio once now, for everything needing it later.
+        analyze_imported(factory)
 
     def _sourceRemovedCb(self, unused_medialibrary, uri, unused_info):
         """ the given uri was removed from the medialibrary """
-        # find the good line in the storemodel and remove it
         model = self.storemodel
-        for row in model:
-            if uri == row[COL_URI]:
-                model.remove(row.iter)
-                break
-        if not len(model):
+        row_ref = self._row_refs.pop(uri, None)
+        self._search_index.remove(uri)
+        if row_ref is not None and row_ref.valid():
+            model.remove(model.get_iter(row_ref.get_path()))
+        else:
+            # not added to the model yet
+            self._pending_infos = [info for info in self._pending_infos
+                                   if info.get_uri() != uri]
+        if not len(model) and not self._pending_infos:
             self._displayHelpText()
             self.search_hbox.hide()
         self.debug("Removing %s", uri)
@@ -822,10 +1027,10 @@ class MediaLibraryWidget(gtk.VBox, Loggable):
         self._errors.append(error)
 
     def _sourcesStartedImportingCb(self, unused_medialibrary):
-        self._progressbar.show()
+        self._import_hbox.show_all()
 
     def _sourcesStoppedImportingCb(self, unused_medialibrary):
-        self._progressbar.hide()
+        self._import_hbox.hide()
         if self._errors:
             if len(self._errors) > 1:
                 self._warning_label.set_text(_("Errors occurred while importing."))
@@ -842,7 +1047,11 @@ class MediaLibraryWidget(gtk.VBox, Loggable):
         present in the media library. We then need to hide the progressbar
         because the media library is not going to emit the "ready" signal.
         """
-        self._progressbar.hide()
+        self._import_hbox.hide()
+
+    def _cancelImportClickedCb(self, unused_button):
+        # The media library emits "ready", which hides the progressbar.
+        self.app.current.medialibrary.cancelImport()
 
     ## Error Dialog Box callbacks
 
@@ -884,7 +1093,7 @@ class MediaLibraryWidget(gtk.VBox, Loggable):
         Determine which clips are selected in the icon or list view,
         and ask MediaLibrary to remove them from the project.
         """
-        model = self.treeview.get_model()
+        model = self.modelFilter
         paths = self.getSelectedPaths()
         if paths == None or paths < 1:
             return
@@ -899,29 +1108,31 @@ class MediaLibraryWidget(gtk.VBox, Loggable):
             uri = model[row.get_path()][COL_URI]
             self.app.current.medialibrary.removeUri(uri)
         self.app.action_log.commit()
+        # the selection to restore has been removed
+        self._detached_selection = []
 
     def _sourceIsUsed(self, uri):
         """Check if a given URI is present in the timeline"""
-        layers = self.app.current.timeline.get_layers()
-        for layer in layers:
-            for tlobj in layer.get_objects():
-                tlobj_uri = quote_uri(tlobj.get_uri())
-                if tlobj_uri == uri:
-                    return True
-        return False
+        return self.app.current.timeline.usage.isUsed(uri)
 
     def _selectUnusedSources(self):
         """
         Select, in the media library, unused sources in the project.
         """
         sources = self.app.current.medialibrary.getSources()
-        unused_sources_uris = []
+        unused_sources_uris = set()
 
-        model = self.treeview.get_model()
+        model = self.modelFilter
         selection = self.treeview.get_selection()
         for source in sources:
             if not self._sourceIsUsed(source.get_uri()):
-                unused_sources_uris.append(source.get_uri())
+                unused_sources_uris.add(source.get_uri())
+
+        if self._views_detached:
+            # selected when the views are attached again
+            self._detached_selection = [row.path for row in model
+                                        if row[COL_URI] in unused_sources_uris]
+            return
 
         # Hack around the fact that making selections (in a treeview/iconview)
         # deselects what was previously selected
@@ -945,8 +1156,11 @@ class MediaLibraryWidget(gtk.VBox, Loggable):
 
     def _previewClickedCb(self, unused_widget=None):
         """ Called when a user clicks on the Preview Clip button """
-        paths = self.getSelectedPaths()[0]  # Only use the first item
-        model = self.treeview.get_model()
+        paths = self.getSelectedPaths()
+        if not paths:
+            return
+        paths = paths[0]  # Only use the first item
+        model = self.modelFilter
         self.debug("Let's play %s", model[paths][COL_URI])
         self.emit('play', model[paths][COL_URI])
 
@@ -955,8 +1169,11 @@ class MediaLibraryWidget(gtk.VBox, Loggable):
         Show the clip properties (resolution, framerate, audio channels...)
         and allow setting them as the new project settings.
         """
-        paths = self.getSelectedPaths()[0]  # Only use the first item
-        model = self.treeview.get_model()
+        paths = self.getSelectedPaths()
+        if not paths:
+            return
+        paths = paths[0]  # Only use the first item
+        model = self.modelFilter
         factory = model[paths][COL_FACTORY]
         d = clipmediapropsDialog(self.app.current,
                                 factory.get_audio_streams(),
@@ -1238,17 +1455,17 @@ class MediaLibraryWidget(gtk.VBox, Loggable):
         if not self._project is project:
             self._project = project
             self._resetErrorList()
-            self.storemodel.clear()
+            self._clearStore()
             self._connectToProject(project)
 
     def _newProjectLoadedCb(self, unused_pitivi, project):
         if not self._project is project:
             self._project = project
-            self.storemodel.clear()
+            self._clearStore()
             self._connectToProject(project)
 
     def _newProjectFailedCb(self, unused_pitivi, unused_reason, unused_uri):
-        self.storemodel.clear()
+        self._clearStore()
         self.project_signals.disconnectAll()
         self._project = None
 
@@ -1309,6 +1526,10 @@ class MediaLibraryWidget(gtk.VBox, Loggable):
 
     def getSelectedPaths(self):
         """ Returns a list of selected treeview or iconview items """
+        if self._views_detached:
+            # the views have no model while sources are being added, the
+            # selection is restored when they get it back
+            return list(self._detached_selection)
         if self.clip_view == SHOW_TREEVIEW:
             return self._getSelectedPathsTreeView()
         elif self.clip_view == SHOW_ICONVIEW:
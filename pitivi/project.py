@@ -46,7 +46,7 @@ from pitivi.utils.pipeline import Seeker
 from pitivi.utils.loggable import Loggable
 from pitivi.utils.signal import Signallable
 from pitivi.utils.pipeline import Pipeline
-from pitivi.utils.timeline import Selection
+from pitivi.utils.timeline import Selection, UriUsageIndex
 from pitivi.utils.widgets import FractionWidget
 from pitivi.utils.ripple_update_group import RippleUpdateGroup
 from pitivi.utils.ui import frame_rates, audio_rates, audio_depths,\
@@ -63,6 +63,7 @@ class Timeline(ges.Timeline):
         self.add_track(ges.track_audio_raw_new())
         self.add_track(ges.track_video_raw_new())
         self.selection = Selection()
+        self.usage = UriUsageIndex(self)
 
 
 class ProjectSettingsChanged(UndoableAction):
@@ -536,6 +537,7 @@ class Project(Signallable, Loggable):
     uri = property(getUri, setUri)
 
     def release(self):
+        self.medialibrary.discoverer.stop()
         self.pipeline.release()
         self.pipeline = None
         self.timeline = None
@@ -31,21 +31,40 @@ import gobject
 import goocanvas
 import collections
 import array
+import heapq
+import bisect
 import sqlite3
+import time
+import zlib
+import multiprocessing
 
+from cStringIO import StringIO
 from gettext import gettext as _
 
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 import pitivi.settings as settings
 from pitivi.settings import GlobalSettings
 from pitivi.configure import get_pixmap_dir
 
 import pitivi.utils as utils
 
+from pitivi.utils.misc import call_false
 from pitivi.utils.misc import big_to_cairo_alpha_mask, big_to_cairo_red_mask, big_to_cairo_green_mask, big_to_cairo_blue_mask
 from pitivi.utils.receiver import receiver, handler
 from pitivi.utils.timeline import Zoomable
 from pitivi.utils.signal import Signallable
 from pitivi.utils.loggable import Loggable
+from pitivi.utils.waveform import compute_peaks, PeakFile, PeakFileError
+from pitivi.utils.analysis import PeaksAnalysis, get_audio_analysis_service
 
 from pitivi.dialogs.prefs import PreferencesDialog
 
@@ -86,22 +105,72 @@ PreferencesDialog.addChoicePreference("thumbnailPeriod",
         (_("minute"), 60 * gst.SECOND)),
     description=_("The interval, in seconds, between thumbnails."))
 
-# this default works out to a maximum of ~ 1.78 MiB per factory, assuming:
+# the maximum amount of decoded surface memory, in bytes, kept in memory per
+# factory. This default holds about 1250 thumbnails, assuming:
 # 4:3 aspect ratio
 # 4 bytes per pixel
 # 50 pixel height
-GlobalSettings.addConfigOption("thumbnailCacheSize",
+GlobalSettings.addConfigOption("thumbnailCacheMemory",
+    section="thumbnailing",
+    key="cache-memory",
+    default=16 * 1024 * 1024)
+
+# new thumbnails are buffered in memory and written to the on-disk cache in a
+# single transaction once this many are pending, or once the oldest pending
+# one has waited for cache-flush-interval milliseconds. A value of 1 writes
+# every thumbnail as soon as it is generated.
+GlobalSettings.addConfigOption("thumbnailCacheFlushSize",
+    section="thumbnailing",
+    key="cache-flush-size",
+    default=50)
+
+GlobalSettings.addConfigOption("thumbnailCacheFlushInterval",
+    section="thumbnailing",
+    key="cache-flush-interval",
+    default=2000)
+
+# the on-disk thumbnail store is shared by all media files and projects. When
+# it grows larger than store-size MiB the least recently used thumbnails are
+# evicted, and thumbnails unused for store-max-age days are removed.
+GlobalSettings.addConfigOption("thumbnailStoreSize",
     section="thumbnailing",
-    key="cache-size",
-    default=250)
+    key="store-size",
+    default=1024)
+
+GlobalSettings.addConfigOption("thumbnailStoreMaxAge",
+    section="thumbnailing",
+    key="store-max-age",
+    default=30)
+
+# the codec used to compress thumbnails in the store, one of the keys of
+# BLOB_CODECS. The fastest available one is used if not set.
+GlobalSettings.addConfigOption("thumbnailStoreCodec",
+    section="thumbnailing",
+    key="store-codec",
+    type_=str,
+    default=None)
 
 # the maximum number of thumbnails to enqueue at a given time. setting this to
-# a larger value will increase latency after large operations, such as zooming
+# a larger value will increase latency after large operations, such as zooming.
+# When the queue is full, the request furthest from the playhead is dropped.
 GlobalSettings.addConfigOption("thumbnailMaxRequests",
     section="thumbnailing",
     key="max-requests",
     default=10)
 
+# the number of pipelines decoding thumbnails in parallel for each video
+# file. 0 uses one pipeline per CPU core, up to MAX_AUTO_PIPELINES.
+GlobalSettings.addConfigOption("thumbnailPipelines",
+    section="thumbnailing",
+    key="pipelines",
+    default=0)
+
+MAX_AUTO_PIPELINES = 4
+
+# the widths at which the waveform of each audio segment is rendered, in
+# addition to the width of the segment at the maximum zoom level
+WAVEFORM_WIDTHS = (25, 50, 100, 200, 400, 800, 1600)
+
 GlobalSettings.addConfigOption('showThumbnails',
     section='user-interface',
     key='show-thumbnails',
@@ -113,6 +182,19 @@ PreferencesDialog.addTogglePreference('showThumbnails',
     label=_("Enable video thumbnails"),
     description=_("Show thumbnails on video clips"))
 
+GlobalSettings.addConfigOption('thumbnailFastSeek',
+    section='thumbnailing',
+    key='fast-seek',
+    default=True,
+    notify=True)
+
+PreferencesDialog.addTogglePreference('thumbnailFastSeek',
+    section=_("Performance"),
+    label=_("Fast video thumbnails"),
+    description=_("Show the closest keyframe on video thumbnails unless "
+        "the timeline is zoomed in enough to show every frame. This is "
+        "much faster for videos with few keyframes"))
+
 GlobalSettings.addConfigOption('showWaveforms',
     section='user-interface',
     key='show-waveforms',
@@ -125,68 +207,492 @@ PreferencesDialog.addTogglePreference('showWaveforms',
     description=_("Show waveforms on audio clips"))
 
 
-class ThumbnailCache(object):
+def _surfaceSize(value):
+    """Return the number of bytes of pixel data held by a cached value, which
+    is either a cairo surface or a list of cairo surfaces."""
+    if isinstance(value, (list, tuple)):
+        return sum(_surfaceSize(surface) for surface in value)
+    return value.get_stride() * value.get_height()
 
-    """Caches thumbnails by key using LRU policy, implemented with heapq.
 
-    Uses a two stage caching mechanism. A limited number of elements are
-    held in memory, the rest is being cached on disk using an sqlite db."""
+class BlobCodec(object):
 
-    def __init__(self, uri, size=100):
-        object.__init__(self)
-        self.hash = utils.misc.hash_file(gst.uri_get_location(uri))
-        self.cache = {}
-        self.queue = collections.deque()
-        dbfile = os.path.join(settings.get_dir(os.path.join(settings.xdg_cache_home(), "thumbs")), self.hash)
+    """Abstract class for the compression of thumbnails in the store.
+
+    Thumbnails are given as the pixel data of a cairo.FORMAT_RGB24 surface
+    whose stride is 4 * width."""
+
+    name = None
+
+    def encode(self, data, width, height):
+        raise NotImplementedError
+
+    def decode(self, blob, width, height):
+        """Return the pixel data as a writable buffer."""
+        raise NotImplementedError
+
+
+class RawCodec(BlobCodec):
+
+    name = "raw"
+
+    def encode(self, data, width, height):
+        return data
+
+    def decode(self, blob, width, height):
+        return bytearray(blob)
+
+
+class ZlibCodec(BlobCodec):
+
+    name = "zlib"
+
+    def __init__(self, level=3):
+        self.level = level
+
+    def encode(self, data, width, height):
+        return zlib.compress(str(data), self.level)
+
+    def decode(self, blob, width, height):
+        return bytearray(zlib.decompress(str(blob)))
+
+
+class PngCodec(BlobCodec):
+
+    name = "png"
+
+    def encode(self, data, width, height):
+        surface = cairo.ImageSurface.create_for_data(data,
+            cairo.FORMAT_RGB24, width, height, 4 * width)
+        png = StringIO()
+        surface.write_to_png(png)
+        return png.getvalue()
+
+    def decode(self, blob, width, height):
+        surface = cairo.ImageSurface.create_from_png(StringIO(str(blob)))
+        return bytearray(surface.get_data())
+
+
+class Lz4Codec(BlobCodec):
+
+    name = "lz4"
+
+    def encode(self, data, width, height):
+        return lz4_block.compress(str(data), store_size=False)
+
+    def decode(self, blob, width, height):
+        return bytearray(lz4_block.decompress(str(blob),
+            uncompressed_size=4 * width * height))
+
+
+BLOB_CODECS = dict((codec.name, codec) for codec in
+                   (RawCodec(), ZlibCodec(), PngCodec()))
+if lz4_block is not None:
+    BLOB_CODECS[Lz4Codec.name] = Lz4Codec()
+
+
+def get_default_codec():
+    """Return the fastest codec available, trading some compression for
+    speed when the lz4 module is installed."""
+    if Lz4Codec.name in BLOB_CODECS:
+        return BLOB_CODECS[Lz4Codec.name]
+    return BLOB_CODECS[ZlibCodec.name]
+
+
+class ThumbnailStore(Loggable):
+
+    """Process-wide, content-addressed store for thumbnails.
+
+    The thumbnails of every media file are kept in a single sqlite database,
+    keyed by the hash of the file contents, the timestamp of the thumbnail and
+    its requested height, so clips and projects using the same media share
+    their thumbnails. Use L{get_thumbnail_store} to get the store which owns
+    the only connection to the database.
+
+    When the store grows larger than max_bytes, the least recently used
+    thumbnails are evicted. L{gc} also removes the thumbnails which have not
+    been used for max_age seconds.
+
+    New thumbnails are compressed with codec, a L{BlobCodec}. The codec
+    is recorded for each thumbnail so that the store can be read back after
+    the codec is changed.
+
+    @ivar size: The number of bytes of thumbnail data in the store.
+    @type size: C{int}
+    """
+
+    _INSERT_SQL = "INSERT OR REPLACE INTO Thumbs VALUES (?,?,?,?,?,?,?,?,?)"
+    _KEY_SQL = "Hash = ? AND Time = ? AND Size = ?"
+    # Increase this when changing the layout of the Thumbs table. Stores
+    # with a different version are emptied when they are opened.
+    _SCHEMA_VERSION = 2
+
+    def __init__(self, dbfile, max_bytes=1024 * 1024 * 1024,
+            max_age=30 * 24 * 3600, codec=None):
+        Loggable.__init__(self)
         self.conn = sqlite3.connect(dbfile)
+        # With a write-ahead log, commits only append to the log and readers
+        # are not blocked while a batch is being written.
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
         self.cur = self.conn.cursor()
-        self.cur.execute("CREATE TABLE IF NOT EXISTS Thumbs (Time INTEGER NOT NULL PRIMARY KEY,\
-            Data BLOB NOT NULL, Width INTEGER NOT NULL, Height INTEGER NOT NULL)")
-        self.size = size
+        self.cur.execute("PRAGMA user_version")
+        if self.cur.fetchone()[0] != self._SCHEMA_VERSION:
+            self.debug("Resetting the store to schema version %d",
+                self._SCHEMA_VERSION)
+            self.cur.execute("DROP TABLE IF EXISTS Thumbs")
+            self.cur.execute("PRAGMA user_version = %d" % self._SCHEMA_VERSION)
+        # Size is the requested thumbnail height, Codec the name of the
+        # BlobCodec which encoded Data, Bytes the length of Data and Access
+        # the time at which the thumbnail was last used.
+        self.cur.execute("CREATE TABLE IF NOT EXISTS Thumbs (\
+            Hash TEXT NOT NULL, Time INTEGER NOT NULL, Size INTEGER NOT NULL,\
+            Data BLOB NOT NULL, Width INTEGER NOT NULL, Height INTEGER NOT NULL,\
+            Codec TEXT NOT NULL, Bytes INTEGER NOT NULL, Access INTEGER NOT NULL,\
+            PRIMARY KEY (Hash, Time, Size))")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS ThumbsAccess ON Thumbs (Access)")
+        self.conn.commit()
+        if codec is None:
+            codec = get_default_codec()
+        self.codec = codec
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        # Keys of the thumbnails read since the access times were last
+        # updated, see flushAccessed().
+        self._accessed = set()
+        self.size = self._computeSize()
+
+    def _computeSize(self):
+        self.cur.execute("SELECT TOTAL(Bytes) FROM Thumbs")
+        return int(self.cur.fetchone()[0])
+
+    def contains(self, hash, timestamp, size):
+        # like get(), ignore the thumbnails written with a codec which is
+        # not available anymore
+        self.cur.execute("SELECT 1 FROM Thumbs WHERE " + self._KEY_SQL +
+            " AND Codec IN (%s)" % ",".join("?" * len(BLOB_CODECS)),
+            (hash, timestamp, size) + tuple(BLOB_CODECS))
+        return self.cur.fetchone() is not None
+
+    def get(self, hash, timestamp, size):
+        """
+        Get a thumbnail from the store.
+
+        @return: The (data, width, height) of the thumbnail, or C{None}.
+        """
+        self.cur.execute("SELECT Data, Width, Height, Codec FROM Thumbs WHERE " +
+            self._KEY_SQL, (hash, timestamp, size))
+        row = self.cur.fetchone()
+        if not row:
+            return None
+        blob, width, height, codec_name = row
+        codec = BLOB_CODECS.get(codec_name)
+        if codec is None:
+            # written with a codec which is not available anymore, the
+            # thumbnail will be generated and stored again.
+            self.debug("Unknown codec %s", codec_name)
+            return None
+        self._accessed.add((hash, timestamp, size))
+        return codec.decode(blob, width, height), width, height
+
+    def putMany(self, rows):
+        """
+        Write thumbnails to the store in a single transaction.
+
+        @param rows: The thumbnails to write.
+        @type rows: A list of (hash, timestamp, size, data, width, height)
+        tuples.
+        """
+        now = int(time.time())
+        values = []
+        for hash, timestamp, size, data, width, height in rows:
+            blob = self.codec.encode(data, width, height)
+            values.append((hash, timestamp, size, sqlite3.Binary(blob),
+                           width, height, self.codec.name, len(blob), now))
+        # executemany() prepares the statement once for the whole batch,
+        # and using the connection as a context manager commits (or rolls
+        # back) the batch as one transaction.
+        with self.conn:
+            self.conn.executemany(self._INSERT_SQL, values)
+            self._updateAccessed(now)
+        self.size += sum(value[7] for value in values)
+        if self.size > self.max_bytes:
+            self.gc(max_age=None)
+
+    def flushAccessed(self):
+        """Record the access time of the thumbnails read since the last
+        time, so that the thumbnails in use are not evicted."""
+        if not self._accessed:
+            return
+        with self.conn:
+            self._updateAccessed(int(time.time()))
+
+    def _updateAccessed(self, now):
+        if self._accessed:
+            self.conn.executemany("UPDATE Thumbs SET Access = ? WHERE " +
+                self._KEY_SQL, [(now,) + key for key in self._accessed])
+            self._accessed.clear()
+
+    def removeHash(self, hash):
+        """Remove all the thumbnails of the media file with the given hash."""
+        with self.conn:
+            self.conn.execute("DELETE FROM Thumbs WHERE Hash = ?", (hash,))
+        self.size = self._computeSize()
+
+    def gc(self, max_bytes=None, max_age=-1, now=None):
+        """
+        Evict thumbnails which are too old, then the least recently used ones
+        until the store fits in its size budget.
+
+        @param max_bytes: The size budget, defaults to self.max_bytes.
+        @param max_age: The age in seconds after which an unused thumbnail is
+        removed, C{None} to keep them all. Defaults to self.max_age.
+        @return: The number of thumbnails removed and the number of bytes freed.
+        @rtype: C{tuple}
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        if max_age == -1:
+            max_age = self.max_age
+        if now is None:
+            now = int(time.time())
+        self.flushAccessed()
+        self.cur.execute("SELECT COUNT(*), TOTAL(Bytes) FROM Thumbs")
+        count, size = self.cur.fetchone()
+        with self.conn:
+            if max_age is not None:
+                self.conn.execute("DELETE FROM Thumbs WHERE Access < ?",
+                    (now - max_age,))
+            excess = self._computeSize() - max_bytes
+            if excess > 0:
+                doomed = []
+                for rowid, nbytes in self.conn.execute(
+                        "SELECT rowid, Bytes FROM Thumbs ORDER BY Access"):
+                    if excess <= 0:
+                        break
+                    doomed.append((rowid,))
+                    excess -= nbytes
+                self.conn.executemany("DELETE FROM Thumbs WHERE rowid = ?",
+                    doomed)
+        self.size = self._computeSize()
+        self.cur.execute("SELECT COUNT(*) FROM Thumbs")
+        removed = count - self.cur.fetchone()[0]
+        self.debug("Removed %d thumbnails, %d bytes", removed, size - self.size)
+        return removed, int(size) - self.size
+
+    def vacuum(self):
+        """Shrink the database file after thumbnails have been removed."""
+        self.conn.execute("VACUUM")
+
+    def close(self):
+        self.flushAccessed()
+        self.conn.close()
+
+
+_thumbnail_store = None
+
+
+def remove_legacy_thumbnails():
+    """
+    Remove the thumbnail databases of older versions, one per media file,
+    which the shared store replaced.
+
+    @return: The number of bytes freed.
+    @rtype: C{int}
+    """
+    directory = os.path.join(settings.xdg_cache_home(), "thumbs")
+    if not os.path.isdir(directory):
+        return 0
+    freed = 0
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            freed += os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            pass
+    try:
+        os.rmdir(directory)
+    except OSError:
+        pass
+    return freed
+
+
+def get_thumbnail_store(global_settings=None):
+    """
+    Return the thumbnail store shared by the whole process, creating it if
+    needed.
+
+    @param global_settings: The settings from which to read the size budget
+    of the store. The defaults are used if not given.
+    @type global_settings: L{GlobalSettings}
+    """
+    global _thumbnail_store
+    if _thumbnail_store is None:
+        if global_settings is None:
+            global_settings = GlobalSettings
+        dbfile = os.path.join(settings.xdg_cache_home(), "thumbs.db")
+        _thumbnail_store = ThumbnailStore(dbfile,
+            max_bytes=global_settings.thumbnailStoreSize * 1024 * 1024,
+            max_age=global_settings.thumbnailStoreMaxAge * 24 * 3600,
+            codec=BLOB_CODECS.get(global_settings.thumbnailStoreCodec))
+        # get rid of old thumbnails once the UI is up
+        gobject.idle_add(call_false, _thumbnail_store.gc)
+        gobject.idle_add(call_false, remove_legacy_thumbnails)
+    return _thumbnail_store
+
+
+class ThumbnailCache(object):
+
+    """Caches thumbnails by key using LRU policy, implemented with an
+    ordered dictionary so that lookups, insertions and evictions are O(1).
+
+    Uses a two stage caching mechanism. Up to max_bytes of decoded surfaces
+    are held in memory, the rest is being cached on disk in the
+    L{ThumbnailStore}, unless the cache is not persistent. Only persistent
+    caches are limited to single surfaces with integer keys, which the
+    store can hold.
+
+    Writes to the store are deferred: new thumbnails are kept in a
+    pending buffer and written in one transaction when flush_size of them
+    are waiting, when flush_interval milliseconds have passed since the
+    first of them was added, or when flush() or close() is called. The
+    access times of the thumbnails read from the store are recorded by the
+    same flushes.
+
+    @ivar flushes: The number of transactions written to the store.
+    @type flushes: C{int}
+    @ivar flush_latency: The duration of the last flush, in seconds.
+    @type flush_latency: C{float}
+    @ivar max_flush_latency: The duration of the slowest flush, in seconds.
+    @type max_flush_latency: C{float}
+    @ivar memory: The number of bytes of surface data held in memory.
+    @type memory: C{int}
+    """
+
+    def __init__(self, uri, height=50, max_bytes=16 * 1024 * 1024,
+            flush_size=50, flush_interval=2000, store=None, persistent=True):
+        object.__init__(self)
+        self.hash = utils.misc.hash_file(gst.uri_get_location(uri))
+        self.height = height
+        # A (key -> surface) map, from the least to the most recently used.
+        self.cache = collections.OrderedDict()
+        self.memory = 0
+        if not persistent:
+            store = None
+        elif store is None:
+            store = get_thumbnail_store()
+        self.store = store
+        self.max_bytes = max_bytes
+        self.flush_size = max(1, flush_size)
+        self.flush_interval = flush_interval
+        # A (key -> cairo.ImageSurface) map of thumbnails not yet written.
+        self._pending = {}
+        self._flush_source = None
+        self.flushes = 0
+        self.flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    @property
+    def pending_writes(self):
+        """The number of thumbnails waiting to be written to disk."""
+        return len(self._pending)
 
     def __contains__(self, key):
         # check if item is present in memory
-        if key in self.cache:
+        if key in self.cache or key in self._pending:
             return True
+        if self.store is None:
+            return False
         # check if item is present in on disk cache
-        self.cur.execute("SELECT Time FROM Thumbs WHERE Time = ?", (key,))
-        if self.cur.fetchone():
-            return True
-        return False
+        return self.store.contains(self.hash, key, self.height)
 
     def __getitem__(self, key):
         # check if item is present in memory
         if key in self.cache:
-            # I guess this is why LRU is considered expensive
-            self.queue.remove(key)
-            self.queue.append(key)
+            # move the item to the most recently used end
+            value = self.cache.pop(key)
+            self.cache[key] = value
+            return value
+        # check if the item was evicted before being written to disk
+        if key in self._pending:
+            self._cacheInMemory(key, self._pending[key])
             return self.cache[key]
+        if self.store is None:
+            raise KeyError(key)
         # check if item is present in on disk cache
         # if so load it into memory
-        self.cur.execute("SELECT * FROM Thumbs WHERE Time = ?", (key,))
-        row = self.cur.fetchone()
+        row = self.store.get(self.hash, key, self.height)
         if row:
-            if len(self.cache) > self.size:
-                self.ejectLRU()
-            self.cache[key] = cairo.ImageSurface.create_for_data(row[1], cairo.FORMAT_RGB24, row[2], row[3], 4 * row[2])
-            self.queue.append(key)
+            data, width, height = row
+            self._cacheInMemory(key, cairo.ImageSurface.create_for_data(data,
+                cairo.FORMAT_RGB24, width, height, 4 * width))
+            # its access time is recorded with the next flush
+            self._scheduleFlush()
             return self.cache[key]
         raise KeyError(key)
 
     def __setitem__(self, key, value):
+        self._cacheInMemory(key, value)
+        if self.store is None:
+            return
+        self._pending[key] = value
+        if len(self._pending) >= self.flush_size:
+            self.flush()
+        else:
+            self._scheduleFlush()
+
+    def _scheduleFlush(self):
+        if self.flush_interval <= 0:
+            self.flush()
+        elif self._flush_source is None:
+            self._flush_source = gobject.timeout_add(self.flush_interval,
+                self._flushTimeoutCb)
+
+    def _cacheInMemory(self, key, value):
+        if key in self.cache:
+            self.memory -= _surfaceSize(self.cache.pop(key))
         self.cache[key] = value
-        self.queue.append(key)
-        blob = sqlite3.Binary(bytearray(value.get_data()))
-        #Replace if the key already existed
-        self.cur.execute("DELETE FROM Thumbs WHERE  time=?", (key,))
-        self.cur.execute("INSERT INTO Thumbs VALUES (?,?,?,?)", (key, blob, value.get_width(), value.get_height()))
-        self.conn.commit()
-        if len(self.cache) > self.size:
+        self.memory += _surfaceSize(value)
+        # always keep the item we have just added
+        while self.memory > self.max_bytes and len(self.cache) > 1:
             self.ejectLRU()
 
     def ejectLRU(self):
-        key = self.queue.popleft()
-        del self.cache[key]
+        key, value = self.cache.popitem(last=False)
+        self.memory -= _surfaceSize(value)
+
+    def _flushTimeoutCb(self):
+        self._flush_source = None
+        self.flush()
+        return False
+
+    def flush(self):
+        """Write all the pending thumbnails to the store in a single
+        transaction, along with the access times of the thumbnails read
+        from it."""
+        if self._flush_source is not None:
+            gobject.source_remove(self._flush_source)
+            self._flush_source = None
+        if self.store is None:
+            return
+        if not self._pending:
+            self.store.flushAccessed()
+            return
+        start = time.time()
+        self.store.putMany([(self.hash, key, self.height,
+                             bytearray(surface.get_data()),
+                             surface.get_width(), surface.get_height())
+                            for key, surface in self._pending.iteritems()])
+        self._pending.clear()
+        self.flushes += 1
+        self.flush_latency = time.time() - start
+        self.max_flush_latency = max(self.max_flush_latency, self.flush_latency)
+
+    def close(self):
+        """Flush the pending thumbnails. The store is left open, as it is
+        shared with the other caches."""
+        self.flush()
 
 # Previewer                      -- abstract base class with public interface for UI
 # |_DefaultPreviewer             -- draws a default thumbnail for UI
@@ -212,9 +718,7 @@ def get_preview_for_object(instance, trackobject):
         # Note that we switch on the track_type, but we hash on the uri
         # itself.
         if track_type == ges.TRACK_TYPE_AUDIO:
-            # FIXME: RandomAccessAudioPreviewer doesn't work yet
-            # previewers[key] = RandomAccessAudioPreviewer(instance, uri)
-            previewers[key] = DefaultPreviewer(instance, uri)
+            previewers[key] = RandomAccessAudioPreviewer(instance, uri)
         elif track_type == ges.TRACK_TYPE_VIDEO:
             if trackobject.get_timeline_object().is_image():
                 previewers[key] = StillImagePreviewer(instance, uri)
@@ -274,22 +778,59 @@ class RandomAccessPreviewer(Previewer):
     appropriate filler will be substituted, and an asyncrhonous request
     for the data will be issued. When the data becomes available, the update
     signal is emitted, along with the stream, and time segments. This allows
-    the UI to re-draw the affected portion of a thumbnail sequence or audio waveform."""
+    the UI to re-draw the affected portion of a thumbnail sequence or audio waveform.
+
+    Requests are processed by a pool of at most pool_size pipelines sharing
+    the same queue. Pipelines are identified by their index in the pool,
+    the first one being created by _pipelineInit() and the others, if any,
+    by _addPipeline() when all the existing ones are busy.
+
+    The queue only holds segments which were visible the last time each
+    element was rendered, and the ones closest to the playhead are processed
+    first. When a segment being processed is no longer visible, its pipeline
+    is given the next segment right away."""
+
+    pool_size = 1
+    # whether the results are written to the thumbnail store
+    persistent_cache = True
 
     def __init__(self, instance, uri):
         self._view = True
         self.uri = uri
-        Previewer.__init__(self, instance, uri)
-        self._queue = []
-
-        bin = gst.element_factory_make("playbin")
-        bin.props.uri = uri
-
         # assume 50 pixel height
         self.theight = 50
-        self.waiting_timestamp = None
-
-        self._pipelineInit(uri, bin)
+        Previewer.__init__(self, instance, uri)
+        # make sure buffered thumbnails reach the disk cache before exiting
+        instance.connect("shutdown", self._shutdownCb)
+
+        # segment -> priority, lower values being processed first
+        self._queue = {}
+        # element -> (start, end, segments of its visible part)
+        self._wanted = {}
+        # the visible portion of the timeline, as given to setViewport()
+        self._viewport = None
+        self._playhead = 0
+        self._request_offset = 0
+        self._requested = None
+
+        # For each pipeline of the pool: the segment it is processing or
+        # None if it is idle, whether it is ready to process segments, the
+        # number of the last segment it was given, which tags its results,
+        # the (number -> segment) map of those it was processing before
+        # being preempted, whose results may still arrive, and the last
+        # segment it was given.
+        self._running = [None]
+        self._ready = [True]
+        self._seek_ids = [0]
+        self._superseded = [{}]
+        self._last = [None]
+
+        self._pipelineInit(uri, self._makeBin())
+
+    def _makeBin(self):
+        bin = gst.element_factory_make("playbin")
+        bin.props.uri = self.uri
+        return bin
 
     def _pipelineInit(self, uri, bin):
         """Create the pipeline for the preview process. Subclasses should
@@ -299,6 +840,24 @@ class RandomAccessPreviewer(Previewer):
 
 ## public interface
 
+    def setViewport(self, start, end, playhead):
+        """Set the visible portion of the timeline and the playhead position,
+        which are used to schedule the thumbnail requests.
+
+        @param start: The timeline position of the left edge of the view
+        @type start: L{long}
+        @param end: The timeline position of the right edge of the view
+        @type end: L{long}
+        @param playhead: The timeline position of the playhead
+        @type playhead: L{long}
+        """
+        self._viewport = (start, end)
+        self._playhead = playhead
+        for element, (estart, eend, unused_segments) in self._wanted.items():
+            if eend < start or estart > end:
+                del self._wanted[element]
+        self._cancelStale()
+
     def render_cairo(self, cr, bounds, element, hscroll_pos, y1):
         if not self._view:
             return
@@ -345,16 +904,48 @@ class RandomAccessPreviewer(Previewer):
         istep = self.twidth + self._spacing()
         jstep = self.tdur + Zoomable.pixelToNs(self.spacing)
 
+        # collect the segments requested by _thumbForTime()
+        start = element.get_start()
+        self._request_offset = start - element.get_inpoint()
+        self._requested = set()
         while i < bounds.x2:
             self._thumbForTime(cr, j, i, y1)
             cr.rectangle(i - 1, y1, self.twidth + 2, self.theight)
             i += istep
             j += jstep
             cr.fill()
+        # Only a strip of the element may have been redrawn, the requests
+        # for the rest of its visible part must be kept.
+        self._requested.update(self._visibleSegments(element, istep))
+        self._wanted[element] = (start, start + element.get_duration(),
+            self._requested)
+        self._requested = None
+        self._cancelStale()
+
+    def _visibleSegments(self, element, istep):
+        """Return the segments of the thumbnails of element which are in the
+        visible portion of the timeline, the thumbnails being istep pixels
+        apart."""
+        start = element.get_start()
+        end = start + element.get_duration()
+        if self._viewport is not None:
+            start = max(start, self._viewport[0])
+            end = min(end, self._viewport[1])
+        # the timestamps drawn by render_cairo(), which are multiples of
+        # istep pixels from the start of the file
+        offset = element.get_inpoint() - element.get_start()
+        first = int(Zoomable.nsToPixel(start + offset) // istep)
+        last = int(Zoomable.nsToPixel(end + offset) // istep)
+        return set(self._segment_for_time(Zoomable.pixelToNs(k * istep))
+                   for k in xrange(first, last + 1))
 
     def _spacing(self):
         return self.spacing
 
+    def _segmentStart(self, segment):
+        """Return the time stamp at which the specified segment starts."""
+        return segment
+
     def _segmentForTime(self, time):
         """Return the segment for the specified time stamp. For some stream
         types, the segment duration will depend on the current zoom ratio,
@@ -373,60 +964,176 @@ class RandomAccessPreviewer(Previewer):
             surface = self.default_thumb
         cr.set_source_surface(surface, x, y)
 
-    def _finishThumbnail(self, surface, segment):
+    def _finishThumbnail(self, surface, segment, index=0, seek_id=None):
         """Notifies the preview object that the a new thumbnail is ready to be
-        cached. This should be called by subclasses when they have finished
-        processing the thumbnail for the current segment. This function should
-        always be called from the main thread of the application."""
-        waiting = self.waiting_timestamp
-        self.waiting_timestamp = None
+        cached. This should be called by subclasses when pipeline index has
+        finished processing the thumbnail for a segment. This function should
+        always be called from the main thread of the application.
+
+        @param segment: The segment of the thumbnail, or the time stamp it
+        was produced for if the exact segment is not known.
+        @param seek_id: The value of _seek_ids[index] when the pipeline
+        started processing the segment, needed if segment is not exact.
+        """
+        if self._running[index] is None:
+            # Not something we asked for, such as the initial preroll.
+            return False
+
+        result = segment
+        if seek_id is None:
+            seek_id = self._matchSeek(result, index)
+        if seek_id == self._seek_ids[index]:
+            segment = self._running[index]
+        else:
+            segment = self._superseded[index].pop(seek_id, None)
+        if segment is None:
+            # A result which was already reported, or which is not ours.
+            return False
+        self._cacheResult(segment, surface, result)
 
-        if segment != waiting:
-            segment = waiting
+        if seek_id != self._seek_ids[index]:
+            # A preempted request which still made it, keep waiting.
+            return False
+        self._superseded[index] = {}
+        self._running[index] = None
+        self._nextThumbnail(index)
+        return False
 
+    def _cacheResult(self, segment, surface, unused_result):
+        """Cache the surface produced for segment, result being the value
+        the subclass passed to _finishThumbnail()."""
         self._cache[segment] = surface
         self.emit("update", segment)
 
-        if segment in self._queue:
-            self._queue.remove(segment)
-        self._nextThumbnail()
-        return False
-
-    def _nextThumbnail(self):
-        """Notifies the preview object that the pipeline is ready to process
+    def _matchSeek(self, segment, index):
+        """Return the number of the processing of segment by pipeline
+        index, or None if it is not running nor superseded."""
+        if segment == self._running[index]:
+            return self._seek_ids[index]
+        for seek_id, superseded in self._superseded[index].iteritems():
+            if superseded == segment:
+                return seek_id
+        return None
+
+    def _nextThumbnail(self, index=0):
+        """Notifies the preview object that pipeline index is ready to process
         the next thumbnail in the queue. This should always be called from the
         main application thread."""
-        if self._queue:
-            if not self._startThumbnail(self._queue[0]):
-                self._queue.pop(0)
-                self._nextThumbnail()
+        while self._queue:
+            if self._startThumbnail(self._takeSegment(index), index):
+                break
+            self._running[index] = None
         return False
 
+    def _takeSegment(self, index):
+        """Remove from the queue the segment pipeline index should process
+        next. The pipelines of the pool process the segments with the
+        highest priorities together, so among as many of them as there are
+        pipelines, each one takes the closest one after the last segment it
+        processed, moving forward through the stream instead of seeking
+        back and forth."""
+        best = heapq.nsmallest(len(self._running), self._queue,
+            key=self._queue.get)
+        segment = best[0]
+        last = self._last[index]
+        if last is not None:
+            following = [candidate for candidate in best
+                         if self._segmentStart(candidate) >
+                         self._segmentStart(last)]
+            if following:
+                segment = min(following, key=self._segmentStart)
+        del self._queue[segment]
+        return segment
+
     def _requestThumbnail(self, segment):
-        """Queue a thumbnail request for the given segment"""
+        """Queue a thumbnail request for the given segment, with a priority
+        depending on its distance to the playhead."""
+        if self._requested is not None:
+            self._requested.add(segment)
+        if segment in self._running:
+            return
+        priority = abs(self._request_offset + self._segmentStart(segment) -
+            self._playhead)
+        if segment not in self._queue and len(self._queue) > self.max_requests:
+            worst = max(self._queue, key=self._queue.get)
+            if self._queue[worst] <= priority:
+                return
+            del self._queue[worst]
+        self._queue[segment] = priority
+        for index, running in enumerate(self._running):
+            if running is None and self._ready[index]:
+                self._nextThumbnail(index)
+                return
+        if len(self._running) < self.pool_size:
+            self._addPipeline()
+
+    def _cancelStale(self):
+        """Drop the requests for segments which are not visible anymore, and
+        preempt the pipelines processing such segments if there is something
+        better to do."""
+        visible = set()
+        for unused_start, unused_end, segments in self._wanted.itervalues():
+            visible.update(segments)
+        for segment in self._queue.keys():
+            if segment not in visible:
+                del self._queue[segment]
+        for index, running in enumerate(self._running):
+            if not self._queue:
+                break
+            if running is not None and running not in visible:
+                self.debug("Preempting pipeline %d processing %r",
+                    index, running)
+                self._superseded[index][self._seek_ids[index]] = running
+                self._nextThumbnail(index)
+
+    def _addPipeline(self):
+        """Add a pipeline to the pool, which will start processing the queue
+        once the subclass calls _pipelineReady() for it."""
+        index = len(self._running)
+        self._running.append(None)
+        self._ready.append(False)
+        self._seek_ids.append(0)
+        self._superseded.append({})
+        self._last.append(None)
+        self._extraPipelineInit(index, self._makeBin())
+
+    def _extraPipelineInit(self, index, bin):
+        """Create an additional pipeline for the pool. Subclasses which use a
+        pool_size larger than 1 should override this method and call
+        _pipelineReady() when the pipeline can process segments."""
+        raise NotImplementedError
 
-        if (segment not in self._queue) and (len(self._queue) <=
-            self.max_requests):
-            if self._queue:
-                self._queue.append(segment)
-            else:
-                self._queue.append(segment)
-                self._nextThumbnail()
+    def _pipelineReady(self, index):
+        self._ready[index] = True
+        if self._running[index] is None:
+            self._nextThumbnail(index)
 
-    def _startThumbnail(self, segment):
-        """Start processing segment. Subclasses should override
-        this method to perform whatever action on the pipeline is necessary.
+    def _startThumbnail(self, segment, index=0):
+        """Start processing segment on pipeline index. Subclasses should
+        override this method to perform whatever action on the pipeline is
+        necessary, and return whether it succeeded.
         Typically this will be a flushing seek(). When the
         current segment has finished processing, subclasses should call
-        _nextThumbnail() with the resulting cairo surface. Since seeking and
-        playback are asynchronous, you may have to call _nextThumbnail() in a
-        message handler or other callback."""
-        self.waiting_timestamp = segment
+        _finishThumbnail() with the resulting cairo surface. Since seeking and
+        playback are asynchronous, you may have to call _finishThumbnail() in
+        a message handler or other callback. The pipeline may be given another
+        segment before that, in which case the processing of the previous one
+        should be interrupted, typically with another flushing seek().
+        Results which can't be matched to their segment should be tagged
+        with the new value of _seek_ids[index]."""
+        self._seek_ids[index] += 1
+        self._running[index] = segment
+        self._last[index] = segment
 
     def _connectSettings(self, settings):
         Previewer._connectSettings(self, settings)
         self.spacing = settings.thumbnailSpacingHint
-        self._cache = ThumbnailCache(uri=self.uri, size=settings.thumbnailCacheSize)
+        self._cache = ThumbnailCache(uri=self.uri, height=self.theight,
+            max_bytes=settings.thumbnailCacheMemory,
+            store=get_thumbnail_store(settings),
+            flush_size=settings.thumbnailCacheFlushSize,
+            flush_interval=settings.thumbnailCacheFlushInterval,
+            persistent=self.persistent_cache)
         self.max_requests = settings.thumbnailMaxRequests
         settings.connect("thumbnailSpacingHintChanged",
             self._thumbnailSpacingHintChanged)
@@ -435,6 +1142,9 @@ class RandomAccessPreviewer(Previewer):
         self.spacing = settings.thumbnailSpacingHint
         self.emit("update", None)
 
+    def _shutdownCb(self, unused_instance):
+        self._cache.close()
+
 
 class RandomAccessVideoPreviewer(RandomAccessPreviewer):
 
@@ -454,6 +1164,23 @@ class RandomAccessVideoPreviewer(RandomAccessPreviewer):
             frame_duration = (gst.SECOND * self.framerate.denom) / self.framerate.num
             self.tstep = max(frame_duration, self.tstep)
 
+    def _exactSeeks(self):
+        """Return whether the thumbnails should show the exact frame of their
+        segment, rather than the keyframe before it."""
+        # Only worth it when zoomed in enough to show every frame.
+        return not self._fast_seek or self.tdur <= self.tstep
+
+    def _keyframeFor(self, segment):
+        """Return the timestamp of the keyframe a key unit seek to segment
+        is known to snap to, or None."""
+        i = bisect.bisect_right(self._keyframes, segment) - 1
+        if i < 0:
+            return None
+        keyframe = self._keyframes[i]
+        if segment > self._snap_end[keyframe]:
+            return None
+        return keyframe
+
     def bus_handler(self, unused_bus, message):
         # set the scaling method of the videoscale element to Lanczos
         element = message.src
@@ -465,14 +1192,56 @@ class RandomAccessVideoPreviewer(RandomAccessPreviewer):
 
     def _pipelineInit(self, factory, sbin):
         """
-        Create the pipeline.
+        Create the first pipeline of the pool.
 
         It has the form "sbin ! thumbnailsink" where thumbnailsink
         is a Bin made out of "capsfilter ! cairosink"
         """
+        self.videopipelines = []
+        # the seek of each pipeline the frames reaching its sink come from
+        self._stream_seek_ids = []
+        sinkpad = self._buildPipeline(sbin)
         self.videopipeline = sbin
-        self.videopipeline.props.flags = 1  # Only render video
-        self.videopipeline.get_bus().connect("message", self.bus_handler)
+
+        self.videopipeline.set_state(gst.STATE_PAUSED)
+        # Wait for the pipeline to be prerolled so we can check the width
+        # that the thumbnails will have and set the aspect ratio accordingly
+        # as well as getting the framerate of the video:
+        if gst.STATE_CHANGE_SUCCESS == self.videopipeline.get_state(gst.CLOCK_TIME_NONE)[0]:
+            neg_caps = sinkpad.get_negotiated_caps()[0]
+            self.aspect = neg_caps["width"] / float(self.theight)
+            self.framerate = neg_caps["framerate"]
+        else:
+            # the pipeline couldn't be prerolled so we can't determine the
+            # correct values. Set sane defaults (this should never happen)
+            self.warning("Couldn't preroll the pipeline")
+            self.aspect = 16.0 / 9
+            self.framerate = gst.Fraction(24, 1)
+
+    def _extraPipelineInit(self, index, sbin):
+        self._buildPipeline(sbin)
+        # Unlike the first pipeline, don't block the UI while prerolling.
+        bus = sbin.get_bus()
+        bus.add_signal_watch()
+        self._async_done_ids[index] = bus.connect("message::async-done",
+            self._busMessageAsyncDoneCb, index)
+        sbin.set_state(gst.STATE_PAUSED)
+
+    def _busMessageAsyncDoneCb(self, bus, unused_message, index):
+        # Only the first preroll matters, every seek causes another one.
+        bus.disconnect(self._async_done_ids.pop(index))
+        self.debug("Pipeline %d is ready for seeking", index)
+        self._pipelineReady(index)
+
+    def _buildPipeline(self, sbin):
+        """
+        Connect a thumbnailsink to sbin and add it to the pool.
+
+        @return: The sink pad of the thumbnailsink.
+        """
+        index = len(self.videopipelines)
+        sbin.props.flags = 1  # Only render video
+        sbin.get_bus().connect("message", self.bus_handler)
 
         # Use a capsfilter to scale the video to the desired size
         # (fixed height and par, variable width)
@@ -481,7 +1250,9 @@ class RandomAccessVideoPreviewer(RandomAccessPreviewer):
         capsfilter = gst.element_factory_make("capsfilter", "thumbnailcapsfilter")
         capsfilter.props.caps = caps
         cairosink = CairoSurfaceThumbnailSink()
-        cairosink.connect("thumbnail", self._thumbnailCb)
+        cairosink.connect("thumbnail", self._thumbnailCb, index)
+        cairosink.get_pad("sink").add_event_probe(self._sinkEventCb, index)
+        self._stream_seek_ids.append(0)
 
         # Set up the thumbnailsink and add a sink pad
         thumbnailsink = gst.Bin("thumbnailsink")
@@ -492,42 +1263,87 @@ class RandomAccessVideoPreviewer(RandomAccessPreviewer):
         thumbnailsink.add_pad(sinkpad)
 
         # Connect sbin and thumbnailsink
-        self.videopipeline.props.video_sink = thumbnailsink
+        sbin.props.video_sink = thumbnailsink
 
-        self.videopipeline.set_state(gst.STATE_PAUSED)
-        # Wait for the pipeline to be prerolled so we can check the width
-        # that the thumbnails will have and set the aspect ratio accordingly
-        # as well as getting the framerate of the video:
-        if gst.STATE_CHANGE_SUCCESS == self.videopipeline.get_state(gst.CLOCK_TIME_NONE)[0]:
-            neg_caps = sinkpad.get_negotiated_caps()[0]
-            self.aspect = neg_caps["width"] / float(self.theight)
-            self.framerate = neg_caps["framerate"]
-        else:
-            # the pipeline couldn't be prerolled so we can't determine the
-            # correct values. Set sane defaults (this should never happen)
-            self.warning("Couldn't preroll the pipeline")
-            self.aspect = 16.0 / 9
-            self.framerate = gst.Fraction(24, 1)
+        self.videopipelines.append(sbin)
+        return sinkpad
 
     def _segment_for_time(self, time):
         # quantize thumbnail timestamps to maximum granularity
         return utils.misc.quantize(time, self.tperiod)
 
-    def _thumbnailCb(self, unused_thsink, pixbuf, timestamp):
-        gobject.idle_add(self._finishThumbnail, pixbuf, timestamp)
+    def _thumbForTime(self, cr, time, x, y):
+        if not self._exactSeeks():
+            keyframe = self._keyframeFor(self._segment_for_time(time))
+            if keyframe is not None and keyframe in self._cache:
+                cr.set_source_surface(self._cache[keyframe], x, y)
+                return
+        RandomAccessPreviewer._thumbForTime(self, cr, time, x, y)
+
+    def _sinkEventCb(self, unused_pad, event, index):
+        # The flushing seek of a segment reached the sink, the next frames
+        # are those of that segment.
+        if event.type == gst.EVENT_FLUSH_STOP:
+            self._stream_seek_ids[index] = self._seek_ids[index]
+        return True
 
-    def _startThumbnail(self, timestamp):
-        RandomAccessPreviewer._startThumbnail(self, timestamp)
-        return self.videopipeline.seek(1.0,
-            gst.FORMAT_TIME, gst.SEEK_FLAG_FLUSH | gst.SEEK_FLAG_ACCURATE,
+    def _thumbnailCb(self, unused_thsink, pixbuf, timestamp, index):
+        # A key unit seek gives the frame of the keyframe before the
+        # segment, so the result is matched by its seek, not its timestamp.
+        gobject.idle_add(self._finishThumbnail, pixbuf, timestamp, index,
+            self._stream_seek_ids[index])
+
+    def _startThumbnail(self, timestamp, index=0):
+        RandomAccessPreviewer._startThumbnail(self, timestamp, index)
+        flags = gst.SEEK_FLAG_FLUSH
+        if self._exactSeeks():
+            flags |= gst.SEEK_FLAG_ACCURATE
+            self._fast_segments.discard(timestamp)
+        else:
+            # decode the keyframe before timestamp, and nothing else
+            flags |= gst.SEEK_FLAG_KEY_UNIT
+            self._fast_segments.add(timestamp)
+        return self.videopipelines[index].seek(1.0,
+            gst.FORMAT_TIME, flags,
             gst.SEEK_TYPE_SET, timestamp,
             gst.SEEK_TYPE_NONE, -1)
 
+    def _cacheResult(self, segment, surface, timestamp):
+        if segment not in self._fast_segments:
+            RandomAccessPreviewer._cacheResult(self, segment, surface, timestamp)
+            return
+        self._fast_segments.remove(segment)
+        # There is no keyframe between timestamp and segment, so every
+        # segment in that range snaps to the same frame, which is cached
+        # under its own timestamp.
+        timestamp = min(timestamp, segment)
+        if timestamp not in self._snap_end:
+            bisect.insort(self._keyframes, timestamp)
+            self._snap_end[timestamp] = segment
+        else:
+            self._snap_end[timestamp] = max(self._snap_end[timestamp], segment)
+        RandomAccessPreviewer._cacheResult(self, timestamp, surface, timestamp)
+
     def _connectSettings(self, settings):
         RandomAccessPreviewer._connectSettings(self, settings)
+        self.pool_size = settings.thumbnailPipelines
+        if not self.pool_size:
+            self.pool_size = min(multiprocessing.cpu_count(),
+                                 MAX_AUTO_PIPELINES)
+        # (index -> handler id) of the pipelines waiting for their preroll
+        self._async_done_ids = {}
+        # the segments being processed with key unit seeks
+        self._fast_segments = set()
+        # the sorted timestamps of the keyframes found by key unit seeks, and
+        # for each one the last segment known to snap to it
+        self._keyframes = []
+        self._snap_end = {}
         settings.connect("showThumbnailsChanged", self._showThumbsChanged)
         settings.connect("thumbnailPeriodChanged",
             self._thumbnailPeriodChanged)
+        settings.connect("thumbnailFastSeekChanged",
+            self._thumbnailFastSeekChanged)
+        self._fast_seek = settings.thumbnailFastSeek
         self._view = settings.showThumbnails
         self.tperiod = settings.thumbnailPeriod
 
@@ -539,38 +1355,133 @@ class RandomAccessVideoPreviewer(RandomAccessPreviewer):
         self.tperiod = settings.thumbnailPeriod
         self.emit("update", None)
 
+    def _thumbnailFastSeekChanged(self, settings):
+        self._fast_seek = settings.thumbnailFastSeek
+        self.emit("update", None)
+
 
 class StillImagePreviewer(RandomAccessVideoPreviewer):
     def _thumbForTime(self, cr, time, x, y):
         return RandomAccessVideoPreviewer._thumbForTime(self, cr, 0L, x, y)
 
+    def _connectSettings(self, settings):
+        RandomAccessVideoPreviewer._connectSettings(self, settings)
+        # there is only one thumbnail to decode
+        self.pool_size = 1
+
 
 class RandomAccessAudioPreviewer(RandomAccessPreviewer):
 
+    # The waveforms are lists of surfaces keyed by (timestamp, duration),
+    # which the thumbnail store can't hold, and they are quickly drawn again
+    # from the peak file.
+    persistent_cache = False
+
     def __init__(self, instance, uri):
         self.tdur = 30 * gst.SECOND
         self.base_width = int(Zoomable.max_zoom)
+        # the width of the waveforms cached for each level of detail
+        self.lod_widths = [width for width in WAVEFORM_WIDTHS
+                           if width < self.base_width] + [self.base_width]
+        self.lod_hits = [0] * len(self.lod_widths)
+        self.lod_misses = [0] * len(self.lod_widths)
+        self._peaks = None
         RandomAccessPreviewer.__init__(self, instance, uri)
+        self._loadPeaks()
+
+## peak file
+
+    def _peaksPath(self):
+        """Return where the peak file of the media is stored, next to the
+        thumbnail store, or None if peak files are not supported."""
+        if numpy is None:
+            return None
+        return PeaksAnalysis().path(self._cache.hash)
+
+    def _loadPeaks(self):
+        """Map the peak file of the media, or have it built in the
+        background if there is none. Waveforms are decoded from the media
+        until it is available."""
+        path = self._peaksPath()
+        if path is None:
+            return
+        if os.path.exists(path):
+            try:
+                self._peaks = PeakFile(path)
+                return
+            except PeakFileError, e:
+                self.warning("Rebuilding the peak file: %s", e)
+                os.remove(path)
+        get_audio_analysis_service().analyze(self.uri, self._peaksBuiltCb)
+
+    def _peaksBuiltCb(self, uri, success):
+        if not success:
+            return
+        try:
+            self._peaks = PeakFile(self._peaksPath())
+        except (PeakFileError, IOError, OSError), e:
+            self.warning("Could not load the peak file: %s", e)
+            return
+        self.emit("update", None)
+
+    def _peakSurfaces(self, segment):
+        """Render the waveforms of a segment from the peak file, at each
+        width of lod_widths."""
+        timestamp, duration = segment
+        rate = self._peaks.rate
+        start = timestamp * rate // gst.SECOND
+        frames = duration * rate // gst.SECOND
+        surfaces = []
+        for width in self.lod_widths:
+            surface = cairo.ImageSurface(cairo.FORMAT_A8, width,
+                self.theight)
+            mins, maxs = self._peaks.peaks(start, frames, width)
+            self._plotPeaks(cairo.Context(surface), width, mins, maxs)
+            surfaces.append(surface)
+        return surfaces
 
     @property
     def twidth(self):
         return Zoomable.nsToPixel(self.tdur)
 
     def _pipelineInit(self, factory, sbin):
+        """
+        Create the pipeline decoding the waveforms when there is no peak
+        file.
+
+        It has the form "sbin ! waveformsink" where waveformsink is a Bin
+        made out of "audioconvert ! capsfilter ! appsink", collecting the
+        interleaved float32 samples of the segment being decoded.
+        """
         self.spacing = 0
+        # the samples of the segment being decoded, their number of
+        # channels, and the seek they come from, see _sinkEventCb()
+        self._samples = array.array("f")
+        self._channels = 1
+        self._stream_seek_id = 0
 
-        self.audioSink = ArraySink()
         conv = gst.element_factory_make("audioconvert")
-        self.audioPipeline = utils.pipeline({
-            sbin: conv,
-            conv: self.audioSink,
-            self.audioSink: None})
+        capsfilter = utils.misc.filter_("audio/x-raw-float, width=(int)32, "
+                                        "endianness=(int)1234")
+        self.audioSink = gst.element_factory_make("appsink")
+        self.audioSink.props.emit_signals = True
+        self.audioSink.props.sync = False
+        self.audioSink.connect("new-buffer", self._newBufferCb)
+        self.audioSink.get_pad("sink").add_event_probe(self._sinkEventCb)
+
+        waveformsink = gst.Bin("waveformsink")
+        waveformsink.add(conv, capsfilter, self.audioSink)
+        conv.link(capsfilter)
+        capsfilter.link(self.audioSink)
+        waveformsink.add_pad(gst.GhostPad("sink", conv.get_pad("sink")))
+
+        sbin.props.flags = 2  # Only render audio
+        sbin.props.audio_sink = waveformsink
+        self.audioPipeline = sbin
         bus = self.audioPipeline.get_bus()
         bus.add_signal_watch()
-        bus.connect("message::segment-done", self._busMessageSegmentDoneCb)
         bus.connect("message::error", self._busMessageErrorCb)
 
-        self._audio_cur = None
         self.audioPipeline.set_state(gst.STATE_PAUSED)
 
     def _spacing(self):
@@ -580,9 +1491,27 @@ class RandomAccessAudioPreviewer(RandomAccessPreviewer):
         # for audio files, we need to know the duration the segment spans
         return time - (time % self.tdur), self.tdur
 
-    def _busMessageSegmentDoneCb(self, bus, message):
-        self.debug("segment done")
-        self._finishWaveform()
+    def _segmentStart(self, segment):
+        return segment[0]
+
+    def _newBufferCb(self, sink):
+        # called from the streaming thread
+        buf = sink.emit("pull-buffer")
+        self._channels = buf.get_caps()[0]["channels"]
+        self._samples.fromstring(buf.data)
+
+    def _sinkEventCb(self, unused_pad, event):
+        # called from the streaming thread, or from the seeking one
+        if event.type == gst.EVENT_FLUSH_STOP:
+            # The flushing seek of a segment reached the sink, the next
+            # samples are those of that segment.
+            self._samples = array.array("f")
+            self._stream_seek_id = self._seek_ids[0]
+        elif event.type == gst.EVENT_EOS:
+            self.debug("segment done")
+            gobject.idle_add(self._finishWaveform, self._samples,
+                self._channels, self._stream_seek_id)
+        return True
 
     def _busMessageErrorCb(self, bus, message):
         error, debug = message.parse_error()
@@ -590,12 +1519,19 @@ class RandomAccessAudioPreviewer(RandomAccessPreviewer):
 
         return gst.BUS_PASS
 
-    def _startThumbnail(self, (timestamp, duration)):
-        RandomAccessPreviewer._startThumbnail(self, (timestamp, duration))
-        self._audio_cur = timestamp, duration
+    def _startThumbnail(self, segment, index=0):
+        RandomAccessPreviewer._startThumbnail(self, segment, index)
+        if self._peaks is not None:
+            # no need to decode anything
+            gobject.idle_add(self._finishThumbnail,
+                self._peakSurfaces(segment), segment, index)
+            return True
+        timestamp, duration = segment
+        # The flush drops the samples of a preempted segment, and the
+        # pipeline reaches EOS at the end of the segment.
         res = self.audioPipeline.seek(1.0,
             gst.FORMAT_TIME,
-            gst.SEEK_FLAG_FLUSH | gst.SEEK_FLAG_ACCURATE | gst.SEEK_FLAG_SEGMENT,
+            gst.SEEK_FLAG_FLUSH | gst.SEEK_FLAG_ACCURATE,
             gst.SEEK_TYPE_SET, timestamp,
             gst.SEEK_TYPE_SET, timestamp + duration)
         if not res:
@@ -604,63 +1540,55 @@ class RandomAccessAudioPreviewer(RandomAccessPreviewer):
 
         return res
 
-    def _finishWaveform(self):
+    def _finishWaveform(self, samples, channels, seek_id):
         surfaces = []
         surface = cairo.ImageSurface(cairo.FORMAT_A8,
             self.base_width, self.theight)
         cr = cairo.Context(surface)
-        self._plotWaveform(cr, self.base_width)
-        self.audioSink.reset()
+        self._plotWaveform(cr, self.base_width, samples, channels)
 
-        for width in [25, 100, 200]:
+        for width in self.lod_widths[:-1]:
             scaled = cairo.ImageSurface(cairo.FORMAT_A8,
                width, self.theight)
             cr = cairo.Context(scaled)
             matrix = cairo.Matrix()
-            matrix.scale(self.base_width / width, 1.0)
+            matrix.scale(float(self.base_width) / width, 1.0)
             cr.set_source_surface(surface)
             cr.get_source().set_matrix(matrix)
             cr.rectangle(0, 0, width, self.theight)
             cr.fill()
             surfaces.append(scaled)
         surfaces.append(surface)
-        gobject.idle_add(self._finishThumbnail, surfaces, self._audio_cur)
+        return self._finishThumbnail(surfaces, None, 0, seek_id)
+
+    def _plotWaveform(self, cr, base_width, samples, channels):
+        if samples:
+            mins, maxs = compute_peaks(samples, channels, base_width)
+        else:
+            mins = maxs = []
+        self._plotPeaks(cr, base_width, mins, maxs)
 
-    def _plotWaveform(self, cr, base_width):
+    def _plotPeaks(self, cr, width, mins, maxs):
         # clear background
         cr.set_source_rgba(1, 1, 1, 0.0)
-        cr.rectangle(0, 0, base_width, self.theight)
+        cr.rectangle(0, 0, width, self.theight)
         cr.fill()
 
-        samples = self.audioSink.samples
-
-        if not samples:
+        channels = len(mins)
+        if not channels or not len(mins[0]):
             return
 
-        # find the samples-per-pixel ratio
-        spp = len(samples) / base_width
-        if spp == 0:
-            spp = 1
-        channels = self.audioSink.channels
-        stride = spp * channels
         hscale = self.theight / (2 * channels)
 
-        # plot points from min to max over a given hunk
-        chan = 0
+        # plot a single polyline per channel, going from the min to the max
+        # of each column
         y = hscale
-        while chan < channels:
-            i = chan
-            x = 0
-            while i < len(samples):
-                slice = samples[i:i + stride:channels]
-                min_ = min(slice)
-                max_ = max(slice)
-                cr.move_to(x, y - (min_ * hscale))
+        for chan in xrange(channels):
+            cr.move_to(0, y - (mins[chan][0] * hscale))
+            for x, (min_, max_) in enumerate(zip(mins[chan], maxs[chan])):
+                cr.line_to(x, y - (min_ * hscale))
                 cr.line_to(x, y - (max_ * hscale))
-                i += spp
-                x += 1
             y += 2 * hscale
-            chan += 1
 
         # Draw!
         cr.set_source_rgba(0, 0, 0, 1.0)
@@ -668,31 +1596,44 @@ class RandomAccessAudioPreviewer(RandomAccessPreviewer):
 
     def _thumbForTime(self, cr, time, x, y):
         segment = self._segment_for_time(time)
-        twidth = self.twidth
+        level = self._levelForWidth(self.twidth)
         if segment in self._cache:
-            surfaces = self._cache[segment]
-            if twidth > 200:
-                surface = surfaces[3]
-                base_width = self.base_width
-            elif twidth <= 200:
-                surface = surfaces[2]
-                base_width = 200
-            elif twidth <= 100:
-                surface = surfaces[1]
-                base_width = 100
-            elif twidth <= 25:
-                surface = surfaces[0]
-                base_width = 25
-            x_scale = float(base_width) / self.twidth
+            self.lod_hits[level] += 1
+            surface = self._cache[segment][level]
+            x_scale = float(self.lod_widths[level]) / self.twidth
             cr.set_source_surface(surface)
             matrix = cairo.Matrix()
             matrix.scale(x_scale, 1.0)
             matrix.translate(-x, -y)
             cr.get_source().set_matrix(matrix)
         else:
+            self.lod_misses[level] += 1
             self._requestThumbnail(segment)
             cr.set_source_rgba(0.0, 0.0, 0.0, 0.0)
 
+    def _levelForWidth(self, width):
+        """Return the index in lod_widths of the narrowest waveform which is
+        at least width pixels wide, so that it only ever gets scaled down,
+        or of the widest one."""
+        return min(bisect.bisect_left(self.lod_widths, width),
+                   len(self.lod_widths) - 1)
+
+    def getLodStats(self):
+        """
+        Get the cache statistics of each level of detail.
+
+        @return: The width, the number of cache hits and the number of cache
+            misses of each level, when drawing the waveforms.
+        @rtype: C{list} of (C{int}, C{int}, C{int})
+        """
+        return zip(self.lod_widths, self.lod_hits, self.lod_misses)
+
+    def _shutdownCb(self, instance):
+        for width, hits, misses in self.getLodStats():
+            self.debug("Waveforms %d pixels wide: %d hits, %d misses",
+                width, hits, misses)
+        RandomAccessPreviewer._shutdownCb(self, instance)
+
     def _connectSettings(self, settings):
         RandomAccessPreviewer._connectSettings(self, settings)
         self._view = settings.showWaveforms
@@ -839,6 +1780,22 @@ class Preview(goocanvas.ItemSimple, goocanvas.Item, Zoomable):
         else:
             self.changed(False)
 
+## scrolling callbacks
+
+    hadj = receiver()
+
+    @handler(hadj, "value-changed")
+    def _scrolled(self, hadj):
+        self._updateViewport()
+
+    def _updateViewport(self):
+        if issubclass(self.previewer.__class__, RandomAccessPreviewer):
+            start = self.hadj.get_value()
+            end = start + self.hadj.props.page_size
+            playhead = self.app.gui.timeline_ui._canvas.position
+            self.previewer.setViewport(Zoomable.pixelToNs(start),
+                Zoomable.pixelToNs(end), playhead)
+
 ## Zoomable interface overries
 
     def zoomChanged(self):
@@ -858,6 +1815,7 @@ class Preview(goocanvas.ItemSimple, goocanvas.Item, Zoomable):
         x1 = -self.hadj.get_value()
         cr.identity_matrix()
         if issubclass(self.previewer.__class__, RandomAccessPreviewer):
+            self._updateViewport()
             self.previewer.render_cairo(cr, intersect(self.bounds, bounds),
             self.element, x1, self.bounds.y1)
 
@@ -42,7 +42,6 @@ from os.path import join
 from pitivi.check import soft_deps
 from pitivi.effects import AUDIO_EFFECT, VIDEO_EFFECT
 from pitivi.autoaligner import AlignmentProgressDialog
-from pitivi.utils.misc import quote_uri
 from pitivi.utils.pipeline import PipelineError
 from pitivi.settings import GlobalSettings
 
@@ -1371,17 +1370,9 @@ class Timeline(gtk.Table, Loggable, Zoomable):
 
     def purgeObject(self, uri):
         """Remove all instances of a clip from the timeline."""
-        quoted_uri = quote_uri(uri)
-        layers = self.timeline.get_layers()
-        for layer in layers:
-            for tlobj in layer.get_objects():
-                if hasattr(tlobj, "get_uri"):
-                    if quote_uri(tlobj.get_uri()) == quoted_uri:
-                        layer.remove_object(tlobj)
-                else:
-                    # TimelineStandardTransition and the like don't have URIs
-                    # GES will remove those transitions automatically.
-                    self.debug("Not removing %s from timeline as it has no URI" % tlobj)
+        # GES will remove the transitions of the clips automatically.
+        for tlobj in self.timeline.usage.getObjects(uri):
+            tlobj.get_layer().remove_object(tlobj)
 
     def _create_temp_source(self, x, y):
         """
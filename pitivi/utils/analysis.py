@@ -0,0 +1,314 @@
+# PiTiVi , Non-linear video editor
+#
+#       utils/analysis.py
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""
+Analysis of the audio of media files, decoding each file once for all the
+analyses
+"""
+
+import os
+import gobject
+import gst
+import multiprocessing
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from pitivi.settings import xdg_cache_home
+from pitivi.utils.extract import Extractee, UriAudioExtractor
+from pitivi.utils.loggable import Loggable
+from pitivi.utils.misc import call_false, hash_file
+from pitivi.utils.threads import Thread
+from pitivi.utils.waveform import PeakFileBuilder
+
+# the maximum number of files analyzed at the same time in the background
+MAX_BACKGROUND_WORKERS = 2
+# the longest media files analyzed in the background when they are imported,
+# the others being analyzed when a result is needed
+MAX_BACKGROUND_DURATION = 30 * 60 * gst.SECOND
+
+
+class Analysis(object):
+
+    """
+    Abstract base class for an analysis of the audio of media files, run by
+    an L{AudioAnalysisService}.  The results are cached by the content hash
+    of the files.
+    """
+
+    def isCached(self, media_hash):
+        """
+        @returns: Whether the result for the media file is cached.
+        @rtype: L{bool}
+        """
+        raise NotImplementedError
+
+    def makeExtractee(self, media_hash, rate, channels):
+        """
+        Create the extractee computing the result for a media file.  This is
+        called from a streaming thread.
+
+        @returns: An extractee receiving the interleaved float32 samples of
+            the file, which caches the result when it is finalized.
+        @rtype: L{Extractee}
+        """
+        raise NotImplementedError
+
+
+def _cache_directory(name):
+    directory = os.path.join(xdg_cache_home(), name)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    return directory
+
+
+class PeaksAnalysis(Analysis):
+
+    """Build the peak files used to draw the waveforms, see L{PeakFile}."""
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = _cache_directory("peaks")
+        self._directory = directory
+
+    def path(self, media_hash):
+        """Get where the peak file of a media file is stored."""
+        return os.path.join(self._directory, media_hash + ".peaks")
+
+    def isCached(self, media_hash):
+        return os.path.exists(self.path(media_hash))
+
+    def makeExtractee(self, media_hash, rate, channels):
+        return PeakFileBuilder(self.path(media_hash), rate, channels)
+
+
+class MonoExtractee(Extractee):
+
+    """Downmix interleaved samples for an extractee expecting mono."""
+
+    def __init__(self, extractee, channels):
+        self._extractee = extractee
+        self._channels = channels
+
+    def receive(self, array):
+        if self._channels > 1:
+            array = numpy.asarray(array).reshape(-1, self._channels).mean(
+                axis=1, dtype=numpy.float32)
+        self._extractee.receive(array)
+
+    def finalize(self):
+        self._extractee.finalize()
+
+
+class _FanOutExtractee(Extractee):
+
+    def __init__(self, extractees):
+        self._extractees = extractees
+
+    def receive(self, array):
+        for extractee in self._extractees:
+            extractee.receive(array)
+
+    def finalize(self):
+        for extractee in self._extractees:
+            extractee.finalize()
+
+
+class AudioAnalysisService(Loggable):
+
+    """
+    Run analyses on the audio of media files.
+
+    Each file is decoded once, all the analyses whose results are not
+    cached yet being fed in the same streaming pass.  Up to max_workers
+    files are decoded at the same time, the files analyzed in the
+    background waiting for those whose results are needed.
+    """
+
+    def __init__(self, analyses=(), max_workers=None):
+        """
+        @param analyses: The analyses to run on each file
+        @type analyses: iterable of L{Analysis}
+        @param max_workers: The maximum number of files to decode at the
+            same time, by default the number of CPU cores
+        @type max_workers: L{int}
+        """
+        Loggable.__init__(self)
+        self._analyses = list(analyses)
+        if max_workers is None:
+            max_workers = multiprocessing.cpu_count()
+        self._max_workers = max(1, max_workers)
+        # the uris waiting to be analyzed, and those waiting to be analyzed
+        # in the background
+        self._pending = []
+        self._background = []
+        # maps each uri being analyzed or waiting to be to its callbacks
+        self._callbacks = {}
+        # maps each uri being analyzed to its extractor, None until it is
+        # known which analyses to run
+        self._running = {}
+
+    def addAnalysis(self, analysis):
+        """
+        Run analysis on the files analyzed from now on.
+
+        @type analysis: L{Analysis}
+        """
+        self._analyses.append(analysis)
+
+    def analyze(self, uri, callback=None, *cbargs):
+        """
+        Run the analyses whose results are not cached yet on a media file.
+
+        @param uri: The media file
+        @type uri: L{str}
+        @param callback: A function to call in the main thread once the
+            results are cached, with the uri, whether the analyses
+            succeeded, and cbargs.
+        @type callback: function
+        """
+        if uri in self._background:
+            # The results are needed now.
+            self._background.remove(uri)
+            self._pending.append(uri)
+        elif uri not in self._callbacks:
+            self._callbacks[uri] = []
+            self._pending.append(uri)
+        if callback is not None:
+            self._callbacks[uri].append((callback, cbargs))
+        self._startNext()
+
+    def analyzeInBackground(self, uri):
+        """
+        Run the analyses whose results are not cached yet on a media file,
+        once the files whose results are needed have been analyzed.
+
+        @param uri: The media file
+        @type uri: L{str}
+        """
+        if uri not in self._callbacks:
+            self._callbacks[uri] = []
+            self._background.append(uri)
+        self._startNext()
+
+    def _startNext(self):
+        while ((self._pending or self._background) and
+               len(self._running) < self._max_workers):
+            if self._pending:
+                uri = self._pending.pop(0)
+            else:
+                uri = self._background.pop(0)
+            # The file is hashed and the caches are checked in a thread, as
+            # it is done for every file even when everything is cached.
+            self._running[uri] = None
+            _AnalysisPlanner(uri, list(self._analyses), self._plannedCb).start()
+
+    def _plannedCb(self, uri, media_hash, analyses):
+        if media_hash is None:
+            self._doneCb(False, uri)
+            return
+        if not analyses:
+            self._doneCb(True, uri)
+            return
+        self.debug("Running %d analyses on %s", len(analyses), uri)
+
+        def makeExtractee(rate, channels):
+            return _FanOutExtractee([
+                analysis.makeExtractee(media_hash, rate, channels)
+                for analysis in analyses])
+
+        extractor = UriAudioExtractor(uri, makeExtractee, self._doneCb, uri)
+        self._running[uri] = extractor
+        extractor.start()
+
+    def _doneCb(self, success, uri):
+        del self._running[uri]
+        for callback, cbargs in self._callbacks.pop(uri):
+            callback(uri, success, *cbargs)
+        self._startNext()
+
+
+class _AnalysisPlanner(Thread):
+
+    """
+    Thread hashing a media file and finding the analyses whose results are
+    not cached for it.
+    """
+
+    def __init__(self, uri, analyses, callback):
+        """
+        @param callback: A function called in the main thread with the uri,
+            the hash of the file or None if it cannot be read, and the
+            analyses to run.
+        @type callback: function(C{str}, C{str}, C{list})
+        """
+        Thread.__init__(self)
+        self.uri = uri
+        self.analyses = analyses
+        self.callback = callback
+
+    def process(self):
+        try:
+            media_hash = hash_file(gst.uri_get_location(self.uri))
+        except (IOError, OSError), e:
+            self.warning("Could not read %s: %s", self.uri, e)
+            gobject.idle_add(call_false, self.callback, self.uri, None, [])
+            return
+        analyses = [analysis for analysis in self.analyses
+                    if not analysis.isCached(media_hash)]
+        gobject.idle_add(call_false, self.callback, self.uri, media_hash,
+                         analyses)
+
+
+_audio_analysis_service = None
+
+
+def get_audio_analysis_service():
+    """
+    Return the audio analysis service shared by the whole process, creating
+    it if needed.  It builds the peak files of the media files it is asked
+    to analyze, if NumPy is available, and runs the analyses added with
+    L{AudioAnalysisService.addAnalysis}.
+    """
+    global _audio_analysis_service
+    if _audio_analysis_service is None:
+        analyses = []
+        if numpy is not None:
+            analyses = [PeaksAnalysis()]
+        _audio_analysis_service = AudioAnalysisService(analyses,
+            max_workers=min(multiprocessing.cpu_count(),
+                            MAX_BACKGROUND_WORKERS))
+    return _audio_analysis_service
+
+
+def analyze_imported(info):
+    """
+    Analyze the audio of an imported media file in the background, unless
+    it has none or it is too long, see L{MAX_BACKGROUND_DURATION}.
+
+    @type info: C{gst.pbutils.DiscovererInfo}
+    """
+    if not info.get_audio_streams():
+        return
+    duration = info.get_duration()
+    if duration == gst.CLOCK_TIME_NONE or duration > MAX_BACKGROUND_DURATION:
+        return
+    get_audio_analysis_service().analyzeInBackground(info.get_uri())
@@ -0,0 +1,423 @@
+# PiTiVi , Non-linear video editor
+#
+#       utils/discovery.py
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""
+Persistent cache of the discovery results of media files
+"""
+
+import os
+import json
+import sqlite3
+import multiprocessing
+
+from collections import deque
+
+import gst
+from gst.pbutils import Discoverer, DiscovererAudioInfo, \
+    DiscovererContainerInfo, DiscovererVideoInfo
+
+from pitivi.utils.loggable import Loggable
+from pitivi.utils.misc import hash_file
+from pitivi.utils.signal import Signallable
+
+
+class CachedStreamInfo(object):
+
+    """
+    A stream of a L{CachedDiscovererInfo}, with the same accessors as
+    C{gst.pbutils.DiscovererStreamInfo}.
+    """
+
+    def __init__(self, fields):
+        self._fields = fields
+
+    def get_caps(self):
+        return gst.caps_from_string(self._fields["caps"])
+
+    def get_stream_type_nick(self):
+        return self._fields["nick"]
+
+
+class CachedContainerInfo(CachedStreamInfo):
+    pass
+
+
+class CachedAudioInfo(CachedStreamInfo):
+
+    def get_channels(self):
+        return self._fields["channels"]
+
+    def get_sample_rate(self):
+        return self._fields["sample_rate"]
+
+    def get_depth(self):
+        return self._fields["depth"]
+
+    def get_bitrate(self):
+        return self._fields["bitrate"]
+
+    def get_max_bitrate(self):
+        return self._fields["max_bitrate"]
+
+
+class CachedVideoInfo(CachedStreamInfo):
+
+    def get_width(self):
+        return self._fields["width"]
+
+    def get_height(self):
+        return self._fields["height"]
+
+    def get_depth(self):
+        return self._fields["depth"]
+
+    def get_framerate_num(self):
+        return self._fields["framerate_num"]
+
+    def get_framerate_denom(self):
+        return self._fields["framerate_denom"]
+
+    def get_par_num(self):
+        return self._fields["par_num"]
+
+    def get_par_denom(self):
+        return self._fields["par_denom"]
+
+    def is_interlaced(self):
+        return self._fields["interlaced"]
+
+    def is_image(self):
+        return self._fields["image"]
+
+    def get_bitrate(self):
+        return self._fields["bitrate"]
+
+    def get_max_bitrate(self):
+        return self._fields["max_bitrate"]
+
+
+# kind -> (cached class, GStreamer class, accessors), the most derived
+# classes first
+_STREAM_KINDS = [
+    ("video", CachedVideoInfo, DiscovererVideoInfo,
+     ("width", "height", "depth", "framerate_num", "framerate_denom",
+      "par_num", "par_denom", "bitrate", "max_bitrate")),
+    ("audio", CachedAudioInfo, DiscovererAudioInfo,
+     ("channels", "sample_rate", "depth", "bitrate", "max_bitrate")),
+    ("container", CachedContainerInfo, DiscovererContainerInfo, ()),
+    ("stream", CachedStreamInfo, object, ()),
+]
+
+
+class CachedDiscovererInfo(object):
+
+    """
+    The discovery result of a media file read back from a L{DiscoveryCache},
+    with the accessors of C{gst.pbutils.DiscovererInfo} used by PiTiVi.
+    """
+
+    def __init__(self, fields):
+        self._fields = fields
+        classes = dict((kind, cls) for kind, cls, unused_gst_cls,
+                       unused_accessors in _STREAM_KINDS)
+        self._streams = [classes[stream["kind"]](stream)
+                         for stream in fields["streams"]]
+
+    def get_uri(self):
+        return self._fields["uri"]
+
+    def get_duration(self):
+        return self._fields["duration"]
+
+    def get_seekable(self):
+        return self._fields["seekable"]
+
+    def get_tags(self):
+        return self._fields["tags"]
+
+    def get_stream_list(self):
+        # the containers are only kept for the topology of the file
+        return [stream for stream in self._streams
+                if not isinstance(stream, CachedContainerInfo)]
+
+    def get_audio_streams(self):
+        return [stream for stream in self._streams
+                if isinstance(stream, CachedAudioInfo)]
+
+    def get_video_streams(self):
+        return [stream for stream in self._streams
+                if isinstance(stream, CachedVideoInfo)]
+
+    def get_container_streams(self):
+        return [stream for stream in self._streams
+                if isinstance(stream, CachedContainerInfo)]
+
+
+def serialize_info(info):
+    """
+    Get the fields of a discovery result which are cached, as a JSON string.
+
+    @param info: The discovery result of a media file
+    @type info: C{gst.pbutils.DiscovererInfo} or L{CachedDiscovererInfo}
+    @rtype: C{str}
+    """
+    streams = []
+    container_types = (CachedContainerInfo, DiscovererContainerInfo)
+    for stream in info.get_container_streams() + [stream
+            for stream in info.get_stream_list()
+            if not isinstance(stream, container_types)]:
+        for kind, cls, gst_cls, accessors in _STREAM_KINDS:
+            if isinstance(stream, (cls, gst_cls)):
+                break
+        fields = {"kind": kind,
+                  "caps": stream.get_caps().to_string(),
+                  "nick": stream.get_stream_type_nick()}
+        for accessor in accessors:
+            fields[accessor] = getattr(stream, "get_" + accessor)()
+        if kind == "video":
+            fields["interlaced"] = bool(stream.is_interlaced())
+            fields["image"] = bool(stream.is_image())
+        streams.append(fields)
+    # only the textual tags, the others are not used
+    tags = {}
+    info_tags = info.get_tags()
+    if info_tags:
+        for key in info_tags.keys():
+            if isinstance(info_tags[key], basestring):
+                tags[key] = info_tags[key]
+    return json.dumps({"uri": info.get_uri(),
+                       "duration": info.get_duration(),
+                       "seekable": bool(info.get_seekable()),
+                       "tags": tags,
+                       "streams": streams})
+
+
+class DiscoveryCache(Loggable):
+
+    """
+    Persistent cache of the discovery results of local media files, so that
+    files imported before, in any project, are not discovered again.
+
+    A result is only used if the file still has the same size, modification
+    time and hash of its first bytes as when it was discovered.
+    """
+
+    # Increase this when changing the layout of the Infos table or of the
+    # serialized infos. Caches with a different version are emptied when
+    # they are opened.
+    _SCHEMA_VERSION = 2
+
+    def __init__(self, dbfile):
+        Loggable.__init__(self)
+        self.conn = sqlite3.connect(dbfile)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.cur = self.conn.cursor()
+        self.cur.execute("PRAGMA user_version")
+        if self.cur.fetchone()[0] != self._SCHEMA_VERSION:
+            self.debug("Resetting the cache to schema version %d",
+                self._SCHEMA_VERSION)
+            self.cur.execute("DROP TABLE IF EXISTS Infos")
+            self.cur.execute("PRAGMA user_version = %d" % self._SCHEMA_VERSION)
+        self.cur.execute("CREATE TABLE IF NOT EXISTS Infos (\
+            Path TEXT PRIMARY KEY, Size INTEGER NOT NULL,\
+            Mtime REAL NOT NULL, Hash TEXT NOT NULL, Info TEXT NOT NULL)")
+        self.conn.commit()
+
+    def _fileKey(self, uri):
+        """
+        @return: The path, size, modification time and partial hash of a
+            local file, or None if it cannot be read.
+        """
+        if gst.uri_get_protocol(uri) != "file":
+            return None
+        path = gst.uri_get_location(uri)
+        try:
+            stat = os.stat(path)
+            return path, stat.st_size, stat.st_mtime, hash_file(path)
+        except (IOError, OSError), e:
+            self.debug("Cannot read %s: %s", path, e)
+            return None
+
+    def get(self, uri):
+        """
+        Get the cached discovery result of a media file.
+
+        @return: The result, or None if the file has not been discovered
+            or has changed since
+        @rtype: L{CachedDiscovererInfo}
+        """
+        if gst.uri_get_protocol(uri) != "file":
+            return None
+        self.cur.execute("SELECT Size, Mtime, Hash, Info FROM Infos "
+            "WHERE Path = ?", (gst.uri_get_location(uri),))
+        row = self.cur.fetchone()
+        if row is None:
+            return None
+        if self._fileKey(uri) != (gst.uri_get_location(uri),) + row[:3]:
+            self.debug("%s changed since it was discovered", uri)
+            return None
+        fields = json.loads(row[3])
+        # the file may have been imported with a differently quoted uri
+        fields["uri"] = uri
+        return CachedDiscovererInfo(fields)
+
+    def put(self, info):
+        """
+        Cache the discovery result of a media file, replacing any previous
+        one for the same file.
+
+        @type info: C{gst.pbutils.DiscovererInfo}
+        """
+        key = self._fileKey(info.get_uri())
+        if key is None:
+            return
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO Infos VALUES "
+                "(?,?,?,?,?)", key + (serialize_info(info),))
+
+    def remove(self, uri):
+        """Forget the discovery result of a media file."""
+        if gst.uri_get_protocol(uri) != "file":
+            return
+        with self.conn:
+            self.conn.execute("DELETE FROM Infos WHERE Path = ?",
+                (gst.uri_get_location(uri),))
+
+    def close(self):
+        self.conn.close()
+
+
+_discovery_cache = None
+
+
+def get_discovery_cache():
+    """
+    Return the discovery cache shared by the whole process, creating it if
+    needed.
+    """
+    global _discovery_cache
+    # imported here because pitivi.settings imports pitivi.utils.ui, which
+    # imports this module
+    from pitivi.settings import xdg_cache_home
+
+    if _discovery_cache is None:
+        _discovery_cache = DiscoveryCache(
+            os.path.join(xdg_cache_home(), "discovery.db"))
+    return _discovery_cache
+
+
+class DiscovererPool(Signallable, Loggable):
+
+    """
+    Discover media files with several discoverers at the same time.
+
+    The URIs wait in a single queue, from which each discoverer takes the
+    next one as soon as it is done with the previous one. It has the
+    signals and the discover_uri_async method of a L{Discoverer} in
+    asynchronous mode, the discoverers being started when needed.
+
+    Signals:
+     - C{discovered} : A file has been discovered, or could not be.
+     - C{finished} : No more files are waiting or being discovered.
+    """
+
+    __signals__ = {
+        "discovered": ["info", "error"],
+        "finished": [],
+        }
+
+    def __init__(self, size=None, timeout=gst.SECOND):
+        """
+        @param size: The maximum number of discoverers, by default the
+        number of CPU cores.
+        @type size: C{int}
+        @param timeout: The time after which the discovery of a single file
+        is given up, in nanoseconds.
+        @type timeout: C{int}
+        """
+        Loggable.__init__(self)
+        Signallable.__init__(self)
+        if size is None:
+            size = multiprocessing.cpu_count()
+        self.size = max(1, size)
+        self.timeout = timeout
+        self._queue = deque()
+        self._idle = []
+        # maps the discoverers at work to their URI
+        self._busy = {}
+
+    def discover_uri_async(self, uri):
+        """Queue a file for discovery."""
+        self._queue.append(uri)
+        self._startNext()
+
+    def _startNext(self):
+        while self._queue:
+            if self._idle:
+                discoverer = self._idle.pop()
+            elif len(self._busy) < self.size:
+                discoverer = Discoverer.new(self.timeout)
+                discoverer.connect("discovered", self._discoveredCb)
+                discoverer.start()
+            else:
+                break
+            uri = self._queue.popleft()
+            self._busy[discoverer] = uri
+            discoverer.discover_uri_async(uri)
+
+    def _discoveredCb(self, discoverer, info, error):
+        if self._busy.get(discoverer) != info.get_uri():
+            # The result of a cancelled discovery, reported after the
+            # discoverer was given another file, or none.
+            return
+        del self._busy[discoverer]
+        self._idle.append(discoverer)
+        self.emit("discovered", info, error)
+        self._startNext()
+        if not self._busy:
+            self.emit("finished")
+
+    def cancel(self, uri=None):
+        """
+        Stop discovering a file, or all the files if uri is None. The
+        cancelled files are not reported.
+        """
+        if uri is None:
+            self._queue.clear()
+        else:
+            try:
+                self._queue.remove(uri)
+            except ValueError:
+                pass
+        for discoverer, busy_uri in self._busy.items():
+            if uri is None or busy_uri == uri:
+                del self._busy[discoverer]
+                # stopping cancels the current discovery
+                discoverer.stop()
+                discoverer.start()
+                self._idle.append(discoverer)
+        self._startNext()
+
+    def stop(self):
+        """Cancel everything and stop the discoverers."""
+        self.cancel()
+        for discoverer in self._idle:
+            discoverer.stop()
+        self._idle = []
@@ -29,11 +29,18 @@ Code derived from ui/previewer.py.
 # FIXME reimplement after GES port
 
 import gst
-from collections import deque
+import gobject
+import array
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 #from pitivi.elements.singledecodebin import SingleDecodeBin
-#from pitivi.elements.extractionsink import ExtractionSink
 from pitivi.utils.loggable import Loggable
-from pitivi.utils.misc import pipeline
+from pitivi.utils.misc import filter_, pipeline
 
 
 class Extractee:
@@ -97,6 +104,12 @@ class Extractor(Loggable):
         """
         raise NotImplementedError
 
+    def stop(self):
+        """
+        Abort the pending extractions.  Their extractees are not finalized.
+        """
+        raise NotImplementedError
+
 
 class RandomAccessExtractor(Extractor):
 
@@ -131,43 +144,89 @@ class RandomAccessExtractor(Extractor):
         raise NotImplementedError
 
 
+class _ExtractionRequest(object):
+
+    """A segment of a stream to extract into an L{Extractee}."""
+
+    __slots__ = ("extractee", "position", "end")
+
+    def __init__(self, extractee, start, end):
+        self.extractee = extractee
+        # The start of the part of the segment which is still to be
+        # extracted, so that the request can resume where it left off.
+        self.position = start
+        self.end = end
+
+
 class RandomAccessAudioExtractor(RandomAccessExtractor):
 
     """
     L{Extractor} for random access audio streams.
 
+    The requests for contiguous or overlapping segments are coalesced into
+    a single playback run, which costs a single seek.  The samples of the
+    run are fanned out to the extractees by timestamp.
+
     Closely inspired by L{RandomAccessAudioPreviewer}.
 
     """
 
+    COALESCE_GAP = gst.SECOND / 2
+    """
+    @ivar COALESCE_GAP: Requests separated by less than this many
+    nanoseconds are coalesced, decoding the gap between them being cheaper
+    than flushing the pipeline.
+    """
+
     def __init__(self, factory, stream_):
-        self._queue = deque()
+        # The requests waiting for a run
+        self._pending = []
+        # The requests of the current run, which are also accessed from the
+        # streaming thread, like the other attributes protected by _lock.
+        self._active = []
+        self._lock = threading.Lock()
+        # The end of the samples received so far in the current run
+        self._position = None
+        self._run_end = None
+        self._rate = None
+        # The number of the current run, and of the run the samples
+        # reaching the sink belong to, which changes when the flushing
+        # seek of a run reaches it.
+        self._run_id = 0
+        self._stream_run_id = 0
         RandomAccessExtractor.__init__(self, factory, stream_)
         self._ready = False
 
     def _pipelineInit(self, factory, sbin):
         self.spacing = 0
 
-        self.audioSink = ExtractionSink()
-        self.audioSink.set_stopped_cb(self._finishSegment)
         # This audiorate element ensures that the extracted raw-data
         # timeline matches the timestamps used for seeking, even if the
         # audio source has gaps or other timestamp abnormalities.
         audiorate = gst.element_factory_make("audiorate")
         conv = gst.element_factory_make("audioconvert")
-        q = gst.element_factory_make("queue")
+        capsfilter = filter_("audio/x-raw-float, width=(int)32, "
+                             "endianness=(int)1234, channels=(int)1")
+        self.audioSink = gst.element_factory_make("appsink")
+        self.audioSink.props.emit_signals = True
+        self.audioSink.props.sync = False
+        self.audioSink.connect("new-buffer", self._newBufferCb)
+        self.audioSink.get_pad("sink").add_event_probe(self._sinkEventCb)
         self.audioPipeline = pipeline({
             sbin: audiorate,
             audiorate: conv,
-            conv: q,
-            q: self.audioSink,
+            conv: capsfilter,
+            capsfilter: self.audioSink,
             self.audioSink: None})
         bus = self.audioPipeline.get_bus()
         bus.add_signal_watch()
         bus.connect("message::error", self._busMessageErrorCb)
+        self._preroll()
+
+    def _preroll(self):
+        bus = self.audioPipeline.get_bus()
         self._donecb_id = bus.connect("message::async-done",
                                       self._busMessageAsyncDoneCb)
-
         self.audioPipeline.set_state(gst.STATE_PAUSED)
         # The audiopipeline.set_state() method does not take effect
         # immediately, but the extraction process (and in particular
@@ -186,10 +245,40 @@ class RandomAccessAudioExtractor(RandomAccessExtractor):
     def _busMessageAsyncDoneCb(self, bus, message):
         self.debug("Pipeline is ready for seeking")
         bus.disconnect(self._donecb_id)  # Don't call me again
+        self._donecb_id = None
         self._ready = True
-        if self._queue:  # Someone called .extract() before we were ready
+        if self._pending:  # Someone called .extract() before we were ready
             self._run()
 
+    def _sinkEventCb(self, pad, event):
+        # called from the streaming thread, or from the seeking one
+        with self._lock:
+            if event.type == gst.EVENT_FLUSH_STOP:
+                # The samples from now on are those of the latest run.
+                self._stream_run_id = self._run_id
+            elif event.type == gst.EVENT_EOS:
+                gobject.idle_add(self._runEosCb, self._stream_run_id)
+        return True
+
+    def _runEosCb(self, run_id):
+        # The end of the run, or of the stream if it ended first.
+        with self._lock:
+            if run_id != self._run_id:
+                # The EOS of a run which has been superseded by a seek.
+                return False
+            finished = self._active
+            self._active = []
+        for request in finished:
+            request.extractee.finalize()
+        self._runDone()
+        return False
+
+    def _runDone(self):
+        if self._pending:
+            self._run()
+        else:
+            self.audioPipeline.set_state(gst.STATE_PAUSED)
+
     def _startSegment(self, timestamp, duration):
         self.debug("processing segment with timestamp=%i and duration=%i",
                    timestamp, duration)
@@ -204,29 +293,196 @@ class RandomAccessAudioExtractor(RandomAccessExtractor):
 
         return res
 
-    def _finishSegment(self):
-        self.audioSink.extractee.finalize()
-        self.audioSink.reset()
-        self._queue.popleft()
-        # If there's more to do, keep running
-        if self._queue:
-            self._run()
+    def _newBufferCb(self, sink):
+        # called from the streaming thread
+        buf = sink.emit("pull-buffer")
+        if self._rate is None:
+            self._rate = buf.get_caps()[0]["rate"]
+        if numpy is not None:
+            samples = numpy.frombuffer(buf.data, dtype="<f4")
+        else:
+            samples = array.array("f", buf.data)
+        start = buf.timestamp
+        end = start + len(samples) * gst.SECOND // self._rate
+        finished = []
+        with self._lock:
+            self._position = end
+            for request in self._active:
+                if request.position >= end:
+                    continue
+                first = max(0, (request.position - start) * self._rate //
+                            gst.SECOND)
+                last = min(len(samples),
+                           -(-(request.end - start) * self._rate //
+                             gst.SECOND))
+                if first < last:
+                    request.extractee.receive(samples[first:last])
+                request.position = end
+                if request.end <= end:
+                    finished.append(request)
+            for request in finished:
+                self._active.remove(request)
+        for request in finished:
+            request.extractee.finalize()
 
     def extract(self, extractee, start, duration):
-        stopped = not self._queue
-        self._queue.append((extractee, start, duration))
-        if stopped and self._ready:
+        request = _ExtractionRequest(extractee, start, start + duration)
+        with self._lock:
+            if (self._active and start >= self._position and
+                    request.end <= self._run_end):
+                # The current run covers the request.
+                self._active.append(request)
+                return
+            running = bool(self._active)
+        self._pending.append(request)
+        if not running and self._ready:
             self._run()
+        elif self._donecb_id is None and not self._ready:
+            # The pipeline was stopped, it has to preroll again.
+            self._preroll()
         # if self._ready is False, self._run() will be called from
-        # self._busMessageDoneCb().
+        # self._busMessageAsyncDoneCb().
+
+    def cancel(self, extractee):
+        """
+        Cancel the pending extractions into extractee.  It is not finalized,
+        and it does not receive any more data once this returns.
+
+        @param extractee: The extractee given to L{extract}
+        @type extractee: L{Extractee}
+        """
+        self._pending = [request for request in self._pending
+                         if request.extractee is not extractee]
+        with self._lock:
+            active = [request for request in self._active
+                      if request.extractee is not extractee]
+            interrupted = len(active) < len(self._active) and not active
+            self._active = active
+        if interrupted:
+            # Don't decode the rest of a run nobody needs anymore.
+            self._runDone()
+
+    def stop(self):
+        self._pending = []
+        with self._lock:
+            self._active = []
+            # Ignore the EOS of the aborted run.
+            self._run_id += 1
+        if self._donecb_id is not None:
+            self.audioPipeline.get_bus().disconnect(self._donecb_id)
+            self._donecb_id = None
+        # A later extract() prerolls the pipeline again before seeking.
+        self._ready = False
+        self.audioPipeline.set_state(gst.STATE_NULL)
 
     def _run(self):
         # Control flows in a cycle:
-        # _run -> _startSegment -> busMessageSegmentDoneCb -> _finishSegment -> _run
-        # This forms a loop that extracts an entire segment (i.e. satisfies an
-        # extract request) in each cycle. The cycle
-        # runs until the queue of Extractees empties.  If the cycle is not
+        # _run -> _startSegment -> _runEosCb -> _runDone -> _run
+        # Each cycle decodes a run made of the pending request which starts
+        # first and of the requests it overlaps, recursively.  The cycle
+        # runs until there are no more pending requests.  If the cycle is not
         # running, extract() will kick it off again.
-        extractee, start, duration = self._queue[0]
-        self.audioSink.set_extractee(extractee)
-        self._startSegment(start, duration)
+        self._pending.sort(key=lambda request: request.position)
+        run = [self._pending.pop(0)]
+        start = run[0].position
+        end = run[0].end
+        while (self._pending and
+               self._pending[0].position <= end + self.COALESCE_GAP):
+            request = self._pending.pop(0)
+            run.append(request)
+            end = max(end, request.end)
+        with self._lock:
+            self._active = run
+            self._run_id += 1
+            self._position = start
+            self._run_end = end
+        self.debug("Coalesced %d requests in a run", len(run))
+        self._startSegment(start, end - start)
+
+
+class UriAudioExtractor(Loggable):
+
+    """
+    Decode the first audio stream of a media file from start to end, as
+    interleaved float32 samples, without needing a timeline.
+    """
+
+    def __init__(self, uri, extractee_factory, callback, *cbargs):
+        """
+        @param uri: The media file
+        @type uri: L{str}
+        @param extractee_factory: A function called from the streaming
+            thread with the sample rate and the number of channels once they
+            are known, returning the L{Extractee} to feed.
+        @type extractee_factory: function(rate, channels)
+        @param callback: A function to call in the main thread when the
+            extraction is over, with whether it succeeded, followed by
+            cbargs.  The extractee is finalized only if it did.
+        @type callback: function
+        """
+        Loggable.__init__(self)
+        self.uri = uri
+        self._extractee_factory = extractee_factory
+        self._cb = callback
+        self._cbargs = cbargs
+        self._extractee = None
+        self._pipeline = None
+
+    def start(self):
+        decoder = gst.element_factory_make("uridecodebin")
+        decoder.props.uri = self.uri
+        decoder.props.caps = gst.Caps("audio/x-raw-float; audio/x-raw-int")
+        conv = gst.element_factory_make("audioconvert")
+        capsfilter = filter_("audio/x-raw-float, width=(int)32, "
+                             "endianness=(int)1234")
+        sink = gst.element_factory_make("appsink")
+        sink.props.emit_signals = True
+        sink.props.sync = False
+        sink.connect("new-buffer", self._newBufferCb)
+        self._pipeline = pipeline({
+            decoder: conv,
+            conv: capsfilter,
+            capsfilter: sink,
+            sink: None})
+        bus = self._pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect("message::eos", self._eosCb)
+        bus.connect("message::error", self._errorCb)
+        self._pipeline.set_state(gst.STATE_PLAYING)
+
+    def stop(self):
+        """Abort the extraction, without finalizing the extractee."""
+        if self._pipeline is None:
+            return
+        bus = self._pipeline.get_bus()
+        bus.remove_signal_watch()
+        self._pipeline.set_state(gst.STATE_NULL)
+        self._pipeline = None
+
+    def _newBufferCb(self, sink):
+        # called from the streaming thread
+        buf = sink.emit("pull-buffer")
+        if self._extractee is None:
+            structure = buf.get_caps()[0]
+            self._extractee = self._extractee_factory(structure["rate"],
+                                                      structure["channels"])
+        if numpy is not None:
+            samples = numpy.frombuffer(buf.data, dtype="<f4")
+        else:
+            samples = array.array("f", buf.data)
+        self._extractee.receive(samples)
+
+    def _eosCb(self, bus, message):
+        self.stop()
+        if self._extractee is None:
+            self.warning("No audio in %s", self.uri)
+            self._cb(False, *self._cbargs)
+            return
+        self._extractee.finalize()
+        self._cb(True, *self._cbargs)
+
+    def _errorCb(self, bus, message):
+        error, debug = message.parse_error()
+        self.warning("Could not decode %s: %s: %s", self.uri, error, debug)
+        self.stop()
+        self._cb(False, *self._cbargs)
@@ -0,0 +1,283 @@
+# PiTiVi , Non-linear video editor
+#
+#       utils/search.py
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""
+Search index of the sources of the media library
+"""
+
+import os
+import re
+import bisect
+
+from urllib import unquote
+
+import gst
+
+_WORD_RE = re.compile(r"[^\W_]+", re.UNICODE)
+# a duration range, for example <30s or >1.5m
+_DURATION_RE = re.compile(r"^([<>])(\d+(?:\.\d+)?)([smh]?)$")
+_DURATION_UNITS = {"": gst.SECOND, "s": gst.SECOND, "m": 60 * gst.SECOND,
+                   "h": 3600 * gst.SECOND}
+
+
+def tokenize(text):
+    """
+    Split a text in lowercase words.
+
+    @type text: C{str} in UTF-8 or C{unicode}
+    @rtype: C{list} of C{unicode}
+    """
+    if not isinstance(text, unicode):
+        text = text.decode("utf-8", "replace")
+    return _WORD_RE.findall(text.lower())
+
+
+def info_tokens(info):
+    """
+    Get the words describing a source: the words of its file name and the
+    whole file name, its kinds of streams, codecs and resolutions, and the
+    values of its textual tags.
+
+    @type info: C{gst.pbutils.DiscovererInfo} or L{CachedDiscovererInfo}
+    @rtype: C{set} of C{unicode}
+    """
+    name = unquote(os.path.basename(info.get_uri()))
+    tokens = set(tokenize(name))
+    tokens.add(name.decode("utf-8", "replace").lower())
+    for stream in info.get_stream_list():
+        mimetype = stream.get_caps().to_string().split(",", 1)[0]
+        # video/x-h264 -> video, h264
+        for word in tokenize(mimetype):
+            if word != "x":
+                tokens.add(word)
+    for video in info.get_video_streams():
+        if video.is_image():
+            tokens.add(u"image")
+        tokens.add(u"%dx%d" % (video.get_width(), video.get_height()))
+        tokens.add(u"%dp" % video.get_height())
+    for audio in info.get_audio_streams():
+        channels = audio.get_channels()
+        tokens.add({1: u"mono", 2: u"stereo"}.get(channels,
+            u"%dch" % channels))
+    tags = info.get_tags()
+    if tags:
+        for key in tags.keys():
+            if isinstance(tags[key], basestring):
+                tokens.update(tokenize(tags[key]))
+    return tokens
+
+
+def parse_query(text):
+    """
+    Parse a search query made of words, each of them being the prefix of a
+    word of the sources searched, and of duration ranges like <30s or >2m.
+
+    @return: The words and the (comparison, duration) ranges.
+    @rtype: (C{list} of C{unicode}, C{list} of (C{str}, C{int}))
+    """
+    words = []
+    durations = []
+    for term in text.split():
+        match = _DURATION_RE.match(term)
+        if match:
+            comparison, value, unit = match.groups()
+            durations.append((comparison,
+                int(float(value) * _DURATION_UNITS[unit])))
+        else:
+            words.extend(tokenize(term))
+    return words, durations
+
+
+class MediaSearchIndex(object):
+
+    """
+    Index of the words describing the sources of the media library, for
+    prefix searches as the user types.
+
+    The words of all the sources are kept sorted, so that those starting
+    with a prefix are found by bisection, each of them mapping to the URIs
+    of the sources it describes. When a query only narrows the previous one,
+    for example when a letter is typed, only the sources which matched the
+    previous query are checked again.
+    """
+
+    # the number of sources from which the words of each source are checked
+    # one by one instead of using the index
+    SCAN_THRESHOLD = 256
+
+    def __init__(self):
+        # the sorted words and the URIs of the sources each one describes
+        self._words = []
+        self._postings = {}
+        # the words and the duration of each source
+        self._tokens = {}
+        self._durations = {}
+        self._query = ([], [])
+        # the URIs of the sources matching the query, None if all of them
+        self._matches = None
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def __contains__(self, uri):
+        return uri in self._tokens
+
+    def add(self, info):
+        """
+        Index a source.
+
+        @return: Whether the source matches the current query.
+        @rtype: C{bool}
+        """
+        uri = info.get_uri()
+        if uri in self._tokens:
+            self.remove(uri)
+        tokens = info_tokens(info)
+        for token in tokens:
+            uris = self._postings.get(token)
+            if uris is None:
+                uris = self._postings[token] = set()
+                bisect.insort(self._words, token)
+            uris.add(uri)
+        self._tokens[uri] = tokens
+        self._durations[uri] = info.get_duration()
+        if self._matches is None:
+            return True
+        if self._filter(set([uri]), *self._query):
+            self._matches.add(uri)
+            return True
+        return False
+
+    def remove(self, uri):
+        """Stop indexing a source."""
+        tokens = self._tokens.pop(uri, None)
+        if tokens is None:
+            return
+        del self._durations[uri]
+        for token in tokens:
+            uris = self._postings[token]
+            uris.discard(uri)
+            if not uris:
+                del self._postings[token]
+                del self._words[bisect.bisect_left(self._words, token)]
+        if self._matches is not None:
+            self._matches.discard(uri)
+
+    def clear(self):
+        """Stop indexing all the sources, keeping the query."""
+        self._words = []
+        self._postings = {}
+        self._tokens = {}
+        self._durations = {}
+        if self._matches is not None:
+            self._matches = set()
+
+    def isVisible(self, uri):
+        """Whether an indexed source matches the current query."""
+        return self._matches is None or uri in self._matches
+
+    def _prefixMatches(self, prefix):
+        """The URIs of the sources with a word starting with prefix."""
+        uris = set()
+        index = bisect.bisect_left(self._words, prefix)
+        while index < len(self._words) and \
+                self._words[index].startswith(prefix):
+            uris.update(self._postings[self._words[index]])
+            index += 1
+        return uris
+
+    def _filter(self, candidates, words, durations):
+        """
+        Get the sources matching a query.
+
+        @param candidates: The URIs of the sources to check, None for all
+        """
+        for word in words:
+            if candidates is None:
+                candidates = self._prefixMatches(word)
+            elif len(candidates) <= self.SCAN_THRESHOLD:
+                # checking the few remaining sources one by one is cheaper
+                # than gathering the sources of all the words with a short
+                # prefix
+                candidates = set(uri for uri in candidates
+                    if any(token.startswith(word)
+                           for token in self._tokens[uri]))
+            else:
+                candidates &= self._prefixMatches(word)
+        if candidates is None:
+            candidates = set(self._tokens)
+        for comparison, duration in durations:
+            if comparison == "<":
+                candidates = set(uri for uri in candidates
+                                 if self._durations[uri] < duration)
+            else:
+                candidates = set(uri for uri in candidates
+                                 if self._durations[uri] > duration and
+                                 self._durations[uri] != gst.CLOCK_TIME_NONE)
+        return candidates
+
+    def _narrowing(self, words, durations):
+        """
+        Get the terms of a query which the current one does not have, if
+        the query can only match sources the current one matches.
+
+        @return: The new words and durations, or None if the query does not
+        narrow the current one.
+        """
+        old_words, old_durations = self._query
+        if self._matches is None or len(words) < len(old_words):
+            return None
+        for old_word, word in zip(old_words, words):
+            if not word.startswith(old_word):
+                return None
+        if [duration for duration in old_durations
+                if duration not in durations]:
+            return None
+        return ([word for index, word in enumerate(words)
+                 if index >= len(old_words) or word != old_words[index]],
+                [duration for duration in durations
+                 if duration not in old_durations])
+
+    def setQuery(self, text):
+        """
+        Search for the sources matching a query, see L{parse_query}.
+
+        @return: The URIs of the sources which match the query and did not
+        match the previous one, and those which don't match it anymore.
+        @rtype: (C{set}, C{set})
+        """
+        words, durations = parse_query(text)
+        old_matches = self._matches
+        narrowing = self._narrowing(words, durations)
+        if not words and not durations:
+            matches = None
+        elif narrowing is not None:
+            # only the sources matching the current query are checked, and
+            # only against the terms which changed
+            matches = self._filter(set(old_matches), *narrowing)
+        else:
+            matches = self._filter(None, words, durations)
+        self._query = (words, durations)
+        self._matches = matches
+
+        if old_matches is None:
+            old_matches = set(self._tokens)
+        if matches is None:
+            matches = set(self._tokens)
+        return matches - old_matches, old_matches - matches
@@ -25,6 +25,7 @@ import gtk
 import gst
 
 from pitivi.utils.loggable import Loggable
+from pitivi.utils.misc import quote_uri
 from pitivi.utils.signal import Signallable
 from pitivi.utils.receiver import receiver, handler
 from pitivi.utils.ui import Point
@@ -165,6 +166,82 @@ class Selection(Signallable):
         return iter(self.selected)
 
 
+class UriUsageIndex(Loggable):
+    """
+    Keeps track of the timeline objects using each media file, as the
+    objects are added to and removed from the layers of a timeline.
+
+    The URIs are quoted with L{quote_uri}, the URIs given to the queries
+    being quoted the same way.
+    """
+
+    def __init__(self, timeline):
+        """
+        @param timeline: The timeline whose objects are tracked
+        @type timeline: L{ges.Timeline}
+        """
+        Loggable.__init__(self)
+        # A (URI -> set of ges.TimelineObject) map.
+        self._objects = {}
+        # A (ges.TimelineObject -> URI) map.
+        self._uris = {}
+        timeline.connect("layer-added", self._layerAddedCb)
+        timeline.connect("layer-removed", self._layerRemovedCb)
+        for layer in timeline.get_layers():
+            self._layerAddedCb(timeline, layer)
+
+    def isUsed(self, uri):
+        """Whether a media file is used by at least one timeline object."""
+        return quote_uri(uri) in self._objects
+
+    def getUseCount(self, uri):
+        """Get the number of timeline objects using a media file."""
+        return len(self._objects.get(quote_uri(uri), ()))
+
+    def getObjects(self, uri):
+        """
+        Get the timeline objects using a media file.
+
+        @rtype: C{list} of L{ges.TimelineObject}
+        """
+        return list(self._objects.get(quote_uri(uri), ()))
+
+    def getUris(self):
+        """Get the URIs of the media files used in the timeline."""
+        return self._objects.keys()
+
+    def _layerAddedCb(self, unused_timeline, layer):
+        layer.connect("object-added", self._objectAddedCb)
+        layer.connect("object-removed", self._objectRemovedCb)
+        for timeline_object in layer.get_objects():
+            self._objectAddedCb(layer, timeline_object)
+
+    def _layerRemovedCb(self, unused_timeline, layer):
+        layer.disconnect_by_func(self._objectAddedCb)
+        layer.disconnect_by_func(self._objectRemovedCb)
+        for timeline_object in layer.get_objects():
+            self._objectRemovedCb(layer, timeline_object)
+
+    def _objectAddedCb(self, unused_layer, timeline_object):
+        if not hasattr(timeline_object, "get_uri"):
+            # TimelineStandardTransition and the like don't have URIs
+            return
+        if timeline_object in self._uris:
+            return
+        uri = quote_uri(timeline_object.get_uri())
+        self._uris[timeline_object] = uri
+        self._objects.setdefault(uri, set()).add(timeline_object)
+
+    def _objectRemovedCb(self, unused_layer, timeline_object):
+        uri = self._uris.pop(timeline_object, None)
+        if uri is None:
+            return
+        objects = self._objects[uri]
+        objects.discard(timeline_object)
+        if not objects:
+            del self._objects[uri]
+
+
 #-----------------------------------------------------------------------------#
 #                       Timeline edition modes helper                         #
 class EditingContext(Signallable):
@@ -37,6 +37,8 @@ from gettext import ngettext, gettext as _
 from decimal import Decimal
 from gst.pbutils import DiscovererVideoInfo, DiscovererAudioInfo, DiscovererStreamInfo
 
+from pitivi.utils.discovery import CachedAudioInfo, CachedStreamInfo, \
+    CachedVideoInfo
 from pitivi.utils.loggable import doLog, ERROR
 
 # ---------------------- Constants -------------------------------------------#
@@ -166,8 +168,11 @@ def hex_to_rgb(value):
 def beautify_info(info):
     ranks = {
         DiscovererVideoInfo: 0,
+        CachedVideoInfo: 0,
         DiscovererAudioInfo: 1,
-        DiscovererStreamInfo: 2
+        CachedAudioInfo: 1,
+        DiscovererStreamInfo: 2,
+        CachedStreamInfo: 2
     }
 
     def stream_sort_key(stream):
@@ -193,7 +198,7 @@ def info_name(info):
 
 
 def beautify_stream(stream):
-    if type(stream) == DiscovererAudioInfo:
+    if type(stream) in (DiscovererAudioInfo, CachedAudioInfo):
         templ = ngettext("<b>Audio:</b> %d channel at %d <i>Hz</i> (%d <i>bits</i>)",
                 "<b>Audio:</b> %d channels at %d <i>Hz</i> (%d <i>bits</i>)",
                 stream.get_channels())
@@ -201,7 +206,7 @@ def beautify_stream(stream):
             stream.get_depth())
         return templ
 
-    elif type(stream) == DiscovererVideoInfo:
+    elif type(stream) in (DiscovererVideoInfo, CachedVideoInfo):
         par = stream.get_par_num() / stream.get_par_denom()
         if not stream.is_image():
             templ = _(u"<b>Video:</b> %d×%d <i>pixels</i> at %.3f <i>fps</i>")
@@ -214,7 +219,7 @@ def beautify_stream(stream):
             templ = _(u"<b>Image:</b> %d×%d <i>pixels</i>")
             templ = templ % (par * stream.get_width(), stream.get_height())
         return templ
-    elif type(stream) == DiscovererStreamInfo:
+    elif type(stream) in (DiscovererStreamInfo, CachedStreamInfo):
         caps = stream.get_caps().to_string()
         if "text" in caps:
             return _("Subtitles")
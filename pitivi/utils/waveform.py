@@ -0,0 +1,273 @@
+# PiTiVi , Non-linear video editor
+#
+#       utils/waveform.py
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""
+Computation of the peaks used to draw audio waveforms
+"""
+
+import os
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from pitivi.utils.extract import Extractee
+
+
+def compute_peaks(samples, channels, columns):
+    """
+    Compute the minimum and maximum sample of each channel over each column
+    of a waveform.
+
+    The samples are split in consecutive blocks of the same size, one per
+    column. Samples left over at the end are ignored, and there may be less
+    columns than requested if there are not enough samples.
+
+    @param samples: The interleaved samples
+    @type samples: sequence of C{float}
+    @param channels: The number of channels
+    @type channels: C{int}
+    @param columns: The number of columns of the waveform
+    @type columns: C{int}
+    @return: The minimums and the maximums, indexed by channel then column
+    @rtype: (C{numpy.ndarray}, C{numpy.ndarray}) or (C{list}, C{list}) if
+        NumPy is not available
+    """
+    frames = len(samples) // channels
+    spp = max(1, frames // columns)
+    columns = min(columns, frames // spp)
+
+    if numpy is not None:
+        # (columns, samples per column, channels) -> (channels, columns)
+        array = numpy.asarray(samples[:columns * spp * channels],
+            dtype=numpy.float32).reshape(columns, spp, channels)
+        return array.min(axis=1).T, array.max(axis=1).T
+
+    mins = []
+    maxs = []
+    stride = spp * channels
+    for chan in xrange(channels):
+        chan_mins = []
+        chan_maxs = []
+        for column in xrange(columns):
+            start = column * stride + chan
+            block = samples[start:start + stride:channels]
+            chan_mins.append(min(block))
+            chan_maxs.append(max(block))
+        mins.append(chan_mins)
+        maxs.append(chan_maxs)
+    return mins, maxs
+
+
+# Peak files hold the minimum and maximum sample of each channel over
+# blocks of PEAK_BLOCK frames, and over blocks PEAK_DECIMATION times larger
+# at each of the following levels, until a level holds a single block.
+PEAK_MAGIC = "PTVPEAKS"
+PEAK_VERSION = 1
+PEAK_BLOCK = 256
+PEAK_DECIMATION = 4
+# magic, version, rate, channels, block, decimation, number of levels
+_PEAK_HEADER = struct.Struct("<8sIIIIII")
+_PEAK_LEVEL = struct.Struct("<Q")
+_PEAK_SCALE = 32767
+
+
+class PeakFileError(Exception):
+    pass
+
+
+def _decimate(level):
+    """Compute the level above the given one."""
+    full = len(level) // PEAK_DECIMATION * PEAK_DECIMATION
+    groups = [level[:full].reshape(-1, PEAK_DECIMATION, *level.shape[1:])]
+    if full < len(level):
+        groups.append(level[full:].reshape(1, -1, *level.shape[1:]))
+    upper = []
+    for group in groups:
+        peaks = numpy.empty((len(group),) + level.shape[1:], dtype=level.dtype)
+        peaks[..., 0] = group[..., 0].min(axis=1)
+        peaks[..., 1] = group[..., 1].max(axis=1)
+        upper.append(peaks)
+    return numpy.concatenate(upper)
+
+
+class PeakFileBuilder(Extractee):
+
+    """
+    Build a L{PeakFile} from the interleaved float samples of a stream.
+
+    Requires NumPy.
+    """
+
+    def __init__(self, path, rate, channels):
+        """
+        @param path: Where to write the peak file
+        @type path: C{str}
+        @param rate: The sample rate of the stream
+        @type rate: C{int}
+        @param channels: The number of channels of the stream
+        @type channels: C{int}
+        """
+        self.path = path
+        self.rate = rate
+        self.channels = channels
+        # the frames of the last incomplete block
+        self._carry = numpy.empty((0, channels), dtype=numpy.float32)
+        self._blocks = []
+
+    def receive(self, array):
+        frames = numpy.concatenate((self._carry,
+            numpy.asarray(array, dtype=numpy.float32).reshape(-1,
+                self.channels)))
+        full = len(frames) // PEAK_BLOCK * PEAK_BLOCK
+        if full:
+            self._addBlocks(frames[:full].reshape(-1, PEAK_BLOCK,
+                self.channels))
+        self._carry = frames[full:]
+
+    def _addBlocks(self, blocks):
+        peaks = numpy.empty((len(blocks), self.channels, 2),
+            dtype=numpy.int16)
+        peaks[..., 0] = self._quantize(blocks.min(axis=1))
+        peaks[..., 1] = self._quantize(blocks.max(axis=1))
+        self._blocks.append(peaks)
+
+    def _quantize(self, samples):
+        return numpy.clip(samples, -1.0, 1.0) * _PEAK_SCALE
+
+    def finalize(self):
+        """
+        Compute the upper levels and write the peak file. It is written
+        under a temporary name first, so that a peak file is always
+        complete.
+        """
+        if len(self._carry):
+            self._addBlocks(self._carry.reshape(1, -1, self.channels))
+            self._carry = self._carry[:0]
+        if self._blocks:
+            levels = [numpy.concatenate(self._blocks)]
+        else:
+            levels = [numpy.empty((0, self.channels, 2), dtype=numpy.int16)]
+        self._blocks = []
+        while len(levels[-1]) > 1:
+            levels.append(_decimate(levels[-1]))
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as peak_file:
+            peak_file.write(_PEAK_HEADER.pack(PEAK_MAGIC, PEAK_VERSION,
+                self.rate, self.channels, PEAK_BLOCK, PEAK_DECIMATION,
+                len(levels)))
+            for level in levels:
+                peak_file.write(_PEAK_LEVEL.pack(len(level)))
+            for level in levels:
+                peak_file.write(level.astype("<i2").tostring())
+        os.rename(tmp_path, self.path)
+
+
+class PeakFile(object):
+
+    """
+    A memory-mapped peak file, written by a L{PeakFileBuilder}.
+
+    Requires NumPy.
+
+    @ivar rate: The sample rate of the stream
+    @type rate: C{int}
+    @ivar channels: The number of channels of the stream
+    @type channels: C{int}
+    @ivar frames: The number of frames covered by the peaks
+    @type frames: C{int}
+    """
+
+    def __init__(self, path):
+        """
+        @raise PeakFileError: If the file is not a valid peak file.
+        """
+        with open(path, "rb") as peak_file:
+            header = peak_file.read(_PEAK_HEADER.size)
+            if len(header) < _PEAK_HEADER.size:
+                raise PeakFileError("Truncated peak file %s" % path)
+            magic, version, self.rate, self.channels, self.block, \
+                self.decimation, nlevels = _PEAK_HEADER.unpack(header)
+            if magic != PEAK_MAGIC or version != PEAK_VERSION:
+                raise PeakFileError("Unsupported peak file %s" % path)
+            sizes = [_PEAK_LEVEL.unpack(peak_file.read(_PEAK_LEVEL.size))[0]
+                     for unused_level in xrange(nlevels)]
+
+        offset = _PEAK_HEADER.size + nlevels * _PEAK_LEVEL.size
+        total = sum(sizes)
+        if os.path.getsize(path) != offset + total * self.channels * 4:
+            raise PeakFileError("Truncated peak file %s" % path)
+        if total:
+            data = numpy.memmap(path, dtype="<i2", mode="r", offset=offset,
+                shape=(total, self.channels, 2))
+        else:
+            data = numpy.empty((0, self.channels, 2), dtype="<i2")
+        self.levels = []
+        start = 0
+        for size in sizes:
+            self.levels.append(data[start:start + size])
+            start += size
+        self.frames = sizes[0] * self.block if sizes else 0
+
+    def peaks(self, start, frames, columns):
+        """
+        Get the peaks of a range of frames, using the coarsest level which
+        has at least one block per column.
+
+        @param start: The first frame of the range
+        @type start: C{int}
+        @param frames: The number of frames of the range
+        @type frames: C{int}
+        @param columns: The number of columns to split the range into
+        @type columns: C{int}
+        @return: The minimums and the maximums, indexed by channel then
+            column, less columns being returned if the range ends after the
+            end of the stream
+        @rtype: (C{numpy.ndarray}, C{numpy.ndarray})
+        """
+        block = self.block
+        level = self.levels[0]
+        for upper in self.levels[1:]:
+            if block * self.decimation * columns > frames:
+                break
+            block *= self.decimation
+            level = upper
+
+        first = start // block
+        last = min(-(-(start + frames) // block), len(level))
+        columns = min(columns, (min(start + frames, self.frames) - start) *
+            columns // frames) if frames > 0 else 0
+        if columns <= 0 or first >= last:
+            empty = numpy.empty((self.channels, 0), dtype=numpy.float32)
+            return empty, empty
+
+        data = level[first:last]
+        edges = numpy.arange(columns) * len(data) // columns
+        if len(data) >= columns:
+            mins = numpy.minimum.reduceat(data[..., 0], edges, axis=0)
+            maxs = numpy.maximum.reduceat(data[..., 1], edges, axis=0)
+        else:
+            # zoomed in past the resolution of the first level
+            mins = data[edges, :, 0]
+            maxs = data[edges, :, 1]
+        return (mins.T.astype(numpy.float32) / _PEAK_SCALE,
+                maxs.T.astype(numpy.float32) / _PEAK_SCALE)
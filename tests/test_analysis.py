@@ -0,0 +1,46 @@
+from unittest import TestCase, skipIf
+
+import pitivi.utils.analysis as analysis
+from pitivi.utils.analysis import AudioAnalysisService, MonoExtractee
+
+
+class _Collector(object):
+
+    def __init__(self):
+        self.arrays = []
+        self.finalized = False
+
+    def receive(self, array):
+        self.arrays.append(array)
+
+    def finalize(self):
+        self.finalized = True
+
+
+@skipIf(analysis.numpy is None, "NumPy is not available")
+class TestExtractees(TestCase):
+
+    def testMono(self):
+        numpy = analysis.numpy
+        collector = _Collector()
+        mono = MonoExtractee(collector, 2)
+        mono.receive(numpy.array([1.0, 0.0, 0.5, -0.5], dtype=numpy.float32))
+        mono.finalize()
+        self.assertEqual(list(collector.arrays[0]), [0.5, 0.0])
+        self.assertTrue(collector.finalized)
+
+
+class TestAudioAnalysisService(TestCase):
+
+    def testBackground(self):
+        service = AudioAnalysisService(max_workers=1)
+        # the only worker is busy
+        service._running["file:///busy"] = None
+        service.analyzeInBackground("file:///a")
+        service.analyzeInBackground("file:///b")
+        service.analyze("file:///c")
+        # the results of b are needed now
+        service.analyze("file:///b", lambda uri, success: None)
+        self.assertEqual(service._pending, ["file:///c", "file:///b"])
+        self.assertEqual(service._background, ["file:///a"])
+        self.assertEqual(len(service._callbacks["file:///b"]), 1)
@@ -0,0 +1,235 @@
+import gst
+import shutil
+import tempfile
+from unittest import TestCase, skipIf
+
+import pitivi.autoaligner as autoaligner
+from pitivi.autoaligner import AutoAligner, EnvelopeAnalysis, EnvelopeCache, \
+    envelopeRange
+
+
+@skipIf(autoaligner.numpy is None, "NumPy is not available")
+class TestEnvelopeCache(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = EnvelopeCache(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testPutGet(self):
+        numpy = autoaligner.numpy
+        envelope = numpy.arange(100, dtype=numpy.float64)
+        self.assertEqual(self.cache.get("hash", 0, 25), None)
+        self.cache.put("hash", 0, 25, envelope, complete=True)
+
+        cached = self.cache.get("hash", 0, 25)
+        self.assertEqual(cached.dtype, numpy.float32)
+        self.assertTrue((cached == envelope).all())
+        # the stream index and the block rate are part of the key
+        self.assertEqual(self.cache.get("hash", 1, 25), None)
+        self.assertEqual(self.cache.get("hash", 0, 50), None)
+
+    def testRanges(self):
+        numpy = autoaligner.numpy
+        self.cache.put("hash", 0, 25, numpy.arange(10, 20), first=10)
+        self.assertTrue(self.cache.contains("hash", 0, 25, 12, 20))
+        self.assertEqual(list(self.cache.get("hash", 0, 25, 12, 15)),
+                         [12, 13, 14])
+        # the blocks before and after the range are not cached
+        self.assertFalse(self.cache.contains("hash", 0, 25, 5, 15))
+        self.assertEqual(self.cache.get("hash", 0, 25, 15, 25), None)
+        self.assertEqual(self.cache.get("hash", 0, 25, 10), None)
+
+        # a range touching the cached one is merged with it
+        self.cache.put("hash", 0, 25, numpy.arange(0, 12), first=0)
+        self.assertEqual(list(self.cache.get("hash", 0, 25, 0, 20)),
+                         range(20))
+        self.assertFalse(self.cache.contains("hash", 0, 25))
+
+        # the stream ends after block 22
+        self.cache.put("hash", 0, 25, numpy.arange(18, 23), first=18,
+                       complete=True)
+        self.assertEqual(list(self.cache.get("hash", 0, 25, 20, 30)),
+                         [20, 21, 22])
+        self.assertTrue(self.cache.contains("hash", 0, 25))
+
+        # a disjoint range replaces the cached one
+        self.cache.put("hash", 0, 25, numpy.arange(40, 50), first=40)
+        self.assertFalse(self.cache.contains("hash", 0, 25, 0, 10))
+        self.assertTrue(self.cache.contains("hash", 0, 25, 40, 50))
+
+
+class TestEnvelopeRange(TestCase):
+
+    def testRange(self):
+        first, last, phase = envelopeRange(gst.SECOND / 10, gst.SECOND, 25)
+        self.assertEqual((first, last), (2, 25))
+        self.assertAlmostEqual(phase, 0.5)
+        # until the end of the stream
+        self.assertEqual(envelopeRange(0, None, 25), (0, None, 0))
+
+
+class FakeAudioTrack(object):
+
+    def __init__(self, in_point, out_point):
+        self.in_point = in_point
+        self.out_point = out_point
+
+
+@skipIf(autoaligner.numpy is None, "NumPy is not available")
+class TestCachedEnvelope(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = EnvelopeCache(self.tmpdir)
+        self.aligner = AutoAligner([], None, envelope_cache=self.cache)
+        self.aligner._envelopeKey = lambda audiotrack: ("hash", 0, 25)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testUnalignedOutPoint(self):
+        numpy = autoaligner.numpy
+        # out_point is in the middle of the 26th block
+        track = FakeAudioTrack(0, 1001 * gst.MSECOND)
+        self.assertFalse(self.aligner._cachedEnvelope("clip", track))
+
+        # extracted up to the end of that block
+        self.cache.put("hash", 0, 25, numpy.ones(26))
+        self.assertTrue(self.aligner._cachedEnvelope("clip", track))
+        self.assertEqual(len(self.aligner._timeline_objects["clip"]), 26)
+
+    def testStreamEnd(self):
+        numpy = autoaligner.numpy
+        track = FakeAudioTrack(0, 1001 * gst.MSECOND)
+        self.cache.put("hash", 0, 25, numpy.ones(25))
+        self.assertFalse(self.aligner._cachedEnvelope("clip", track))
+
+        # the stream ends at out_point, its last block is incomplete
+        self.cache.put("hash", 0, 25, numpy.ones(25), complete=True)
+        self.assertTrue(self.aligner._cachedEnvelope("clip", track))
+        self.assertEqual(len(self.aligner._timeline_objects["clip"]), 25)
+
+    def testInPoint(self):
+        numpy = autoaligner.numpy
+        # a clip from the end of a long file
+        track = FakeAudioTrack(3600 * gst.SECOND, 3601 * gst.SECOND)
+        self.cache.put("hash", 0, 25, numpy.arange(90000, 90025),
+                       first=90000)
+        self.assertTrue(self.aligner._cachedEnvelope("clip", track))
+        self.assertEqual(self.aligner._timeline_objects["clip"][0], 90000)
+        self.assertEqual(len(self.aligner._timeline_objects["clip"]), 25)
+
+
+@skipIf(autoaligner.numpy is None, "NumPy is not available")
+class TestEnvelopeAnalysis(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = EnvelopeCache(self.tmpdir)
+        self.analysis = EnvelopeAnalysis(self.cache)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testIsCached(self):
+        numpy = autoaligner.numpy
+        self.assertFalse(self.analysis.isCached("hash"))
+        # the envelope of a clip aligned by an AutoAligner
+        self.cache.put("hash", 0, 25, numpy.ones(25))
+        self.assertFalse(self.analysis.isCached("hash"))
+        self.analysis._envelopeCb(numpy.ones(100), "hash")
+        self.assertTrue(self.analysis.isCached("hash"))
+
+
+@skipIf(autoaligner.numpy is None, "NumPy is not available")
+class TestAlign(TestCase):
+
+    def setUp(self):
+        numpy = autoaligner.numpy
+        random = numpy.random.RandomState(0)
+        # a smooth positive signal, like an envelope
+        signal = numpy.abs(numpy.convolve(random.randn(30000),
+                                          numpy.ones(5), "same"))
+        self.reference = signal[5000:25000]
+        # targets[i][m] is reference[m + offsets[i]]
+        self.offsets = [1234, -2000, 4321]
+        self.targets = [signal[5000 + offset:15000 + offset]
+                        for offset in self.offsets]
+
+    def testRigidAlign(self):
+        offsets = autoaligner.rigidalign(self.reference, self.targets)
+        for offset, expected in zip(offsets, self.offsets):
+            self.assertAlmostEqual(offset, expected, 2)
+
+    def testRigidAlignBatches(self):
+        # one target per batch, of different lengths
+        batch_samples = autoaligner._BATCH_SAMPLES
+        autoaligner._BATCH_SAMPLES = 1
+        try:
+            targets = self.targets + [self.targets[0][:5000]]
+            offsets = autoaligner.rigidalign(self.reference, targets)
+        finally:
+            autoaligner._BATCH_SAMPLES = batch_samples
+        for offset, expected in zip(offsets, self.offsets + [1234]):
+            self.assertAlmostEqual(offset, expected, 2)
+
+    def testRigidAlignFloat32(self):
+        offsets = autoaligner.rigidalign(self.reference, self.targets,
+                                         dtype=autoaligner.numpy.float32)
+        for offset, expected in zip(offsets, self.offsets):
+            self.assertAlmostEqual(offset, expected, 1)
+
+    def testConfidence(self):
+        numpy = autoaligner.numpy
+        noise = numpy.abs(numpy.random.RandomState(1).randn(10000))
+        targets = [self.targets[0], noise]
+        offsets, confidences = autoaligner.rigidalign(self.reference,
+            targets, with_confidence=True)
+        self.assertAlmostEqual(offsets[0], 1234, 2)
+        self.assertTrue(confidences[0] > 10)
+        self.assertTrue(confidences[1] < 10)
+
+        offsets, hierarchical_confidences = autoaligner.hierarchicalalign(
+            self.reference, targets, min_length=256, with_confidence=True)
+        self.assertAlmostEqual(offsets[0], 1234, 2)
+        self.assertTrue(hierarchical_confidences[0] > 10)
+        self.assertTrue(hierarchical_confidences[1] < 10)
+
+    def testHierarchicalAlign(self):
+        offsets = autoaligner.hierarchicalalign(self.reference, self.targets,
+                                                min_length=256)
+        for offset, expected in zip(offsets, self.offsets):
+            self.assertAlmostEqual(offset, expected, 2)
+
+    def testMaxOffset(self):
+        offsets = autoaligner.hierarchicalalign(self.reference, self.targets,
+                                                max_offset=2000,
+                                                min_length=256)
+        self.assertAlmostEqual(offsets[0], 1234, 2)
+        self.assertAlmostEqual(offsets[1], -2000, 2)
+        # out of the search window
+        self.assertTrue(abs(offsets[2]) <= 2000)
+
+    def testAffineAlign(self):
+        numpy = autoaligner.numpy
+        signal = numpy.concatenate((self.reference, self.reference[::-1]))
+        positions = numpy.arange(len(signal))
+        cases = [(1234.5, 0.0005), (-2000.25, -0.0008), (300, 0)]
+        # targets[i][m] is reference[offset + m * (1 + drift)]
+        targets = [numpy.interp(offset + numpy.arange(15000) * (1 + drift),
+                                positions, signal)
+                   for offset, drift in cases]
+        offsets, drifts = autoaligner.affinealign(signal, targets)
+        for (offset, drift), (expected, expected_drift) in zip(
+                zip(offsets, drifts), cases):
+            self.assertTrue(abs(offset - expected) < 0.5)
+            self.assertTrue(abs(drift - expected_drift) < 5e-5)
+
+    def testAffineAlignShortTarget(self):
+        offsets, drifts = autoaligner.affinealign(self.reference,
+                                                  [self.targets[0][:100]])
+        self.assertAlmostEqual(offsets[0], 1234, 2)
+        self.assertEqual(drifts[0], 0)
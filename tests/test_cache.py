@@ -3,12 +3,14 @@ import cairo
 import tempfile
 import gst
 import os
+import shutil
 
 from urllib import unquote
 from common import TestCase
-import pitivi.settings as settings
 
-from pitivi.timeline.thumbnailer import ThumbnailCache
+import pitivi.timeline.thumbnailer as thumbnailer
+from pitivi.timeline.thumbnailer import ThumbnailCache, ThumbnailStore, \
+    BLOB_CODECS, remove_legacy_thumbnails
 from pitivi.utils.misc import hash_file
 
 
@@ -20,17 +22,24 @@ class ThumbnailsCacheTest(TestCase):
         self.tmpfile = tempfile.NamedTemporaryFile()
         self.uri = unquote(gst.uri_construct("file", self.tmpfile.name))
         self.hash = hash_file(self.tmpfile.name)
+        self.tmpdir = tempfile.mkdtemp()
+        # store thumbnails uncompressed so that sizes are predictable
+        self.store = ThumbnailStore(os.path.join(self.tmpdir, "thumbs.db"),
+            codec=BLOB_CODECS["raw"])
 
     def tearDown(self):
         del self.tmpfile
-        os.remove(os.path.join(settings.xdg_cache_home(), "thumbs", self.hash))
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
 
     def testCache(self):
-        c = ThumbnailCache(self.uri, size=32)
+        # a 10x10 RGB24 surface holds 400 bytes of pixel data
+        c = ThumbnailCache(self.uri, max_bytes=32 * 400, store=self.store)
 
         for i in xrange(0, 64):
             c[i] = cairo.ImageSurface(cairo.FORMAT_RGB24, 10, 10)
         assert len(c.cache) == 32
+        assert c.memory == 32 * 400
 
         # 31 should be in the Database, but not in the memory direct cache
         assert not 31 in c.cache
@@ -47,6 +56,131 @@ class ThumbnailsCacheTest(TestCase):
         assert 32 in c
         assert 33 not in c.cache
 
+    def testWriteBehind(self):
+        c = ThumbnailCache(self.uri, max_bytes=4 * 400, flush_size=8,
+            store=self.store)
+
+        for i in xrange(0, 7):
+            c[i] = cairo.ImageSurface(cairo.FORMAT_RGB24, 10, 10)
+        # nothing has been written yet
+        assert c.pending_writes == 7
+        assert c.flushes == 0
+        # 0 was evicted from memory but is still reachable
+        assert not 0 in c.cache
+        assert 0 in c
+        assert c[0].get_width() == 10
+
+        # reaching flush_size writes everything in one transaction
+        c[7] = cairo.ImageSurface(cairo.FORMAT_RGB24, 10, 10)
+        assert c.pending_writes == 0
+        assert c.flushes == 1
+        assert self.store.size == 8 * 400
+
+        # overwriting a key replaces the row
+        c[1] = cairo.ImageSurface(cairo.FORMAT_RGB24, 20, 10)
+        c.close()
+        c = ThumbnailCache(self.uri, max_bytes=4 * 400, store=self.store)
+        assert c[1].get_width() == 20
+        c.close()
+
+    def testNotPersistent(self):
+        c = ThumbnailCache(self.uri, max_bytes=2 * 800, store=self.store,
+            persistent=False)
+        # like the waveforms of the audio previewer
+        for i in xrange(3):
+            c[(i, 1)] = [cairo.ImageSurface(cairo.FORMAT_RGB24, 10, 10)] * 2
+        c.flush()
+        assert c.pending_writes == 0
+        assert c.memory == 2 * 800
+        assert (2, 1) in c
+        assert (0, 1) not in c
+        self.assertRaises(KeyError, c.__getitem__, (0, 1))
+        c.close()
+
+    def testSharedStore(self):
+        # two caches for the same media share their thumbnails
+        c1 = ThumbnailCache(self.uri, store=self.store)
+        c1[0] = cairo.ImageSurface(cairo.FORMAT_RGB24, 10, 10)
+        c1.close()
+        c2 = ThumbnailCache(self.uri, store=self.store)
+        assert 0 in c2
+        # but not with thumbnails of a different height
+        c3 = ThumbnailCache(self.uri, height=100, store=self.store)
+        assert not 0 in c3
+
+    def testGc(self):
+        data = bytearray(400)
+        self.store.putMany([(self.hash, i, 50, data, 10, 10)
+                            for i in xrange(10)])
+        assert self.store.size == 10 * 400
+
+        # thumbnails which were not used for too long are removed
+        removed, freed = self.store.gc(max_age=3600)
+        assert removed == 0
+        self.store.cur.execute("UPDATE Thumbs SET Access = 0 WHERE Time < 2")
+        removed, freed = self.store.gc(max_age=3600)
+        assert (removed, freed) == (2, 2 * 400)
+
+        # then the least recently used ones, until the budget is met
+        self.store.cur.execute("UPDATE Thumbs SET Access = Access + Time")
+        removed, freed = self.store.gc(max_bytes=5 * 400, max_age=None)
+        assert (removed, freed) == (3, 3 * 400)
+        assert not self.store.contains(self.hash, 4, 50)
+        assert self.store.contains(self.hash, 5, 50)
+
+    def testAccessTime(self):
+        self.store.putMany([(self.hash, 0, 50, bytearray(400), 10, 10)])
+        self.store.cur.execute("UPDATE Thumbs SET Access = 0")
+        # thumbnails which are only read are not evicted
+        c = ThumbnailCache(self.uri, store=self.store)
+        assert c[0].get_width() == 10
+        c.close()
+        removed, freed = self.store.gc(max_age=3600)
+        assert removed == 0
+
+    def testLegacyThumbnails(self):
+        xdg_cache_home = thumbnailer.settings.xdg_cache_home
+        thumbnailer.settings.xdg_cache_home = lambda: self.tmpdir
+        try:
+            os.mkdir(os.path.join(self.tmpdir, "thumbs"))
+            with open(os.path.join(self.tmpdir, "thumbs", self.hash), "w") \
+                    as legacy:
+                legacy.write("x" * 100)
+            assert remove_legacy_thumbnails() == 100
+            assert not os.path.exists(os.path.join(self.tmpdir, "thumbs"))
+            assert remove_legacy_thumbnails() == 0
+        finally:
+            thumbnailer.settings.xdg_cache_home = xdg_cache_home
+
+    def testCodecs(self):
+        data = bytearray(i % 7 for i in xrange(400))
+        for name, codec in BLOB_CODECS.iteritems():
+            decoded = codec.decode(codec.encode(data, 10, 10), 10, 10)
+            if name == "png":
+                # the unused byte of each RGB24 pixel is not preserved
+                assert len(decoded) == len(data)
+            else:
+                assert decoded == data
+
+        # thumbnails written with different codecs can be read back
+        self.store.codec = BLOB_CODECS["zlib"]
+        self.store.putMany([(self.hash, 0, 50, data, 10, 10)])
+        self.store.codec = BLOB_CODECS["raw"]
+        self.store.putMany([(self.hash, 1, 50, data, 10, 10)])
+        assert self.store.get(self.hash, 0, 50) == (data, 10, 10)
+        assert self.store.get(self.hash, 1, 50) == (data, 10, 10)
+        assert self.store.size < 2 * 400
+
+        # thumbnails written with a codec which is not available are
+        # missing, rather than found but unreadable
+        self.store.cur.execute("UPDATE Thumbs SET Codec = 'unknown' "
+            "WHERE Time = 0")
+        assert not self.store.contains(self.hash, 0, 50)
+        assert self.store.get(self.hash, 0, 50) is None
+        c = ThumbnailCache(self.uri, store=self.store)
+        assert not 0 in c
+        assert 1 in c
+
 
 if __name__ == "__main__":
     unittest.main()
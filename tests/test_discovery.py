@@ -0,0 +1,184 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import pitivi.utils.discovery as discovery
+from pitivi.utils.discovery import CachedAudioInfo, CachedDiscovererInfo, \
+    CachedVideoInfo, DiscovererPool, DiscoveryCache
+from pitivi.utils.signal import Signallable
+
+
+class TestDiscoveryCache(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = DiscoveryCache(os.path.join(self.tmpdir, "discovery.db"))
+        self.path = os.path.join(self.tmpdir, "clip.ogv")
+        with open(self.path, "wb") as media:
+            media.write("media data")
+        self.uri = "file://" + self.path
+        self.info = CachedDiscovererInfo({
+            "uri": self.uri,
+            "duration": 3000000000,
+            "seekable": True,
+            "tags": {"title": "A clip"},
+            "streams": [
+                {"kind": "container", "caps": "application/ogg",
+                 "nick": "container"},
+                {"kind": "video", "caps": "video/x-theora", "nick": "video",
+                 "width": 320, "height": 240, "depth": 24,
+                 "framerate_num": 25, "framerate_denom": 1,
+                 "par_num": 1, "par_denom": 1, "bitrate": 0,
+                 "max_bitrate": 0, "interlaced": False, "image": False},
+                {"kind": "audio", "caps": "audio/x-vorbis", "nick": "audio",
+                 "channels": 2, "sample_rate": 44100, "depth": 0,
+                 "bitrate": 128000, "max_bitrate": 0}]})
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmpdir)
+
+    def testRoundTrip(self):
+        self.assertEqual(self.cache.get(self.uri), None)
+        self.cache.put(self.info)
+
+        info = self.cache.get(self.uri)
+        self.assertEqual(info.get_uri(), self.uri)
+        self.assertEqual(info.get_duration(), 3000000000)
+        self.assertTrue(info.get_seekable())
+        self.assertEqual(info.get_tags(), {"title": "A clip"})
+        # the container is not a stream of its own
+        self.assertEqual(len(info.get_stream_list()), 2)
+        self.assertEqual(len(info.get_container_streams()), 1)
+        video, = info.get_video_streams()
+        self.assertTrue(isinstance(video, CachedVideoInfo))
+        self.assertEqual((video.get_width(), video.get_height()), (320, 240))
+        self.assertFalse(video.is_image())
+        audio, = info.get_audio_streams()
+        self.assertTrue(isinstance(audio, CachedAudioInfo))
+        self.assertEqual(audio.get_sample_rate(), 44100)
+
+    def testModifiedFile(self):
+        self.cache.put(self.info)
+        with open(self.path, "ab") as media:
+            media.write("more data")
+        self.assertEqual(self.cache.get(self.uri), None)
+
+    def testRemove(self):
+        self.cache.put(self.info)
+        self.cache.remove(self.uri)
+        self.assertEqual(self.cache.get(self.uri), None)
+
+    def testMissingFile(self):
+        self.cache.put(self.info)
+        os.remove(self.path)
+        self.assertEqual(self.cache.get(self.uri), None)
+
+
+class FakeInfo(object):
+
+    def __init__(self, uri):
+        self.uri = uri
+
+    def get_uri(self):
+        return self.uri
+
+
+class FakeDiscoverer(Signallable):
+
+    __signals__ = {"discovered": ["info", "error"]}
+
+    instances = []
+
+    def __init__(self):
+        self.uris = []
+        self.stopped = False
+
+    @classmethod
+    def new(cls, timeout):
+        discoverer = cls()
+        cls.instances.append(discoverer)
+        return discoverer
+
+    def start(self):
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+    def discover_uri_async(self, uri):
+        self.uris.append(uri)
+
+    def finish(self, uri=None):
+        if uri is None:
+            uri = self.uris[-1]
+        self.emit("discovered", FakeInfo(uri), None)
+
+
+class TestDiscovererPool(TestCase):
+
+    def setUp(self):
+        self.discoverer_class = discovery.Discoverer
+        discovery.Discoverer = FakeDiscoverer
+        FakeDiscoverer.instances = []
+        self.pool = DiscovererPool(size=2)
+        self.discovered = []
+        self.finished = 0
+        self.pool.connect("discovered", self._discoveredCb)
+        self.pool.connect("finished", self._finishedCb)
+
+    def tearDown(self):
+        discovery.Discoverer = self.discoverer_class
+
+    def _discoveredCb(self, pool, info, error):
+        self.discovered.append(info.get_uri())
+
+    def _finishedCb(self, pool):
+        self.finished += 1
+
+    def testQueue(self):
+        for uri in ("a", "b", "c"):
+            self.pool.discover_uri_async(uri)
+        first, second = FakeDiscoverer.instances
+        self.assertEqual((first.uris, second.uris), (["a"], ["b"]))
+
+        # the first discoverer done takes the next file
+        second.finish()
+        self.assertEqual(second.uris, ["b", "c"])
+        first.finish()
+        second.finish()
+        self.assertEqual(self.discovered, ["b", "a", "c"])
+        self.assertEqual(self.finished, 1)
+        self.assertEqual(len(FakeDiscoverer.instances), 2)
+
+    def testCancel(self):
+        for uri in ("a", "b", "c", "d"):
+            self.pool.discover_uri_async(uri)
+        first, second = FakeDiscoverer.instances
+        self.pool.cancel("d")
+        self.pool.cancel("a")
+        # the first discoverer was restarted and took the next file
+        self.assertEqual(first.uris, ["a", "c"])
+        self.assertFalse(first.stopped)
+
+        self.pool.cancel()
+        first.finish()
+        self.assertEqual(self.discovered, [])
+        self.pool.discover_uri_async("e")
+        self.assertEqual(len(FakeDiscoverer.instances), 2)
+
+    def testStaleDiscovered(self):
+        for uri in ("a", "b", "c"):
+            self.pool.discover_uri_async(uri)
+        first, second = FakeDiscoverer.instances
+        self.pool.cancel("a")
+        self.assertEqual(first.uris, ["a", "c"])
+
+        # the result of the cancelled discovery was already queued
+        first.finish("a")
+        self.assertEqual(self.discovered, [])
+        first.finish()
+        second.finish()
+        self.assertEqual(self.discovered, ["c", "b"])
+        self.assertEqual(self.finished, 1)
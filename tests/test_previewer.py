@@ -0,0 +1,167 @@
+from unittest import TestCase
+
+import gst
+
+from pitivi.timeline.thumbnailer import RandomAccessPreviewer
+from pitivi.utils.signal import Signallable
+from pitivi.utils.timeline import Zoomable
+
+
+class FakeSettings(Signallable):
+
+    __signals__ = {"thumbnailSpacingHintChanged": []}
+
+
+class FakeInstance(Signallable):
+
+    __signals__ = {"shutdown": []}
+
+    def __init__(self):
+        self.settings = FakeSettings()
+
+
+class FakeElement(object):
+
+    def __init__(self, start, inpoint, duration):
+        self.start = start
+        self.inpoint = inpoint
+        self.duration = duration
+
+    def get_start(self):
+        return self.start
+
+    def get_inpoint(self):
+        return self.inpoint
+
+    def get_duration(self):
+        return self.duration
+
+
+class FakeContext(object):
+
+    def rectangle(self, *args):
+        pass
+
+    def clip(self):
+        pass
+
+    def set_source_surface(self, *args):
+        pass
+
+    def fill(self):
+        pass
+
+
+class FakeBounds(object):
+
+    def __init__(self, x1, x2):
+        self.x1 = x1
+        self.x2 = x2
+        self.y1 = 0
+        self.y2 = 50
+
+
+class SegmentPreviewer(RandomAccessPreviewer):
+
+    """A previewer with thumbnails 10 pixels wide, whose pipelines never
+    finish processing their segment."""
+
+    twidth = 10
+
+    @property
+    def tdur(self):
+        return Zoomable.pixelToNs(self.twidth)
+
+    def _connectSettings(self, settings):
+        self.spacing = 0
+        self.max_requests = 100
+        self._cache = {}
+
+    def _makeBin(self):
+        return None
+
+    def _pipelineInit(self, uri, bin):
+        self.started = []
+
+    def _extraPipelineInit(self, index, bin):
+        self._pipelineReady(index)
+
+    def _segment_for_time(self, time):
+        return time
+
+    def _startThumbnail(self, segment, index=0):
+        RandomAccessPreviewer._startThumbnail(self, segment, index)
+        self.started.append((index, segment))
+        return True
+
+
+class TestRandomAccessPreviewer(TestCase):
+
+    def setUp(self):
+        self.zoomratio = Zoomable.zoomratio
+        # 10 pixels per second
+        Zoomable.zoomratio = 10
+        self.previewer = SegmentPreviewer(FakeInstance(), "file:///clip.ogv")
+        self.element = FakeElement(0, 0, 200 * gst.SECOND)
+
+    def tearDown(self):
+        Zoomable.zoomratio = self.zoomratio
+
+    def _render(self, start, x1, x2):
+        """Draw the part of the element between the pixels x1 and x2 of the
+        view, which shows 20 seconds from start."""
+        self.previewer.setViewport(start, start + 20 * gst.SECOND, 0)
+        self.previewer.render_cairo(FakeContext(), FakeBounds(x1, x2),
+            self.element, -Zoomable.nsToPixel(start), 0)
+
+    def testPartialRedraw(self):
+        self._render(0, 0, 200)
+        self.assertEqual(self.previewer.started, [(0, 0)])
+        self.assertTrue(15 * gst.SECOND in self.previewer._queue)
+
+        # redrawing a strip of the view, like the playhead, does not cancel
+        # the requests for the rest of it
+        self._render(0, 50, 60)
+        self.assertEqual(len(self.previewer._queue), 19)
+        self.assertTrue(15 * gst.SECOND in self.previewer._queue)
+
+        # the requests which are not visible anymore are dropped
+        self._render(100 * gst.SECOND, 0, 200)
+        self.assertFalse(15 * gst.SECOND in self.previewer._queue)
+        self.assertTrue(110 * gst.SECOND in self.previewer._queue)
+
+    def testInOrderRuns(self):
+        previewer = self.previewer
+        previewer.pool_size = 2
+        previewer.setViewport(0, 20 * gst.SECOND, 8400 * gst.MSECOND)
+        for seconds in (9, 10, 8, 11, 7):
+            previewer._requestThumbnail(seconds * gst.SECOND)
+        self.assertEqual(previewer.started,
+                         [(0, 9 * gst.SECOND), (1, 10 * gst.SECOND)])
+
+        previewer._finishThumbnail(None, 9 * gst.SECOND, 0)
+        self.assertEqual(previewer.started[-1], (0, 8 * gst.SECOND))
+        # 7 is closer to the playhead, but 11 is next for this pipeline
+        previewer._finishThumbnail(None, 10 * gst.SECOND, 1)
+        self.assertEqual(previewer.started[-1], (1, 11 * gst.SECOND))
+
+    def testSeekTags(self):
+        previewer = self.previewer
+        self._render(0, 0, 200)
+        superseded = previewer._seek_ids[0]
+        self._render(100 * gst.SECOND, 0, 200)
+        self.assertEqual(previewer.started[-1], (0, 100 * gst.SECOND))
+
+        # the superseded result still made it, but only once
+        previewer._finishThumbnail("first", 0, 0, superseded)
+        previewer._finishThumbnail("again", 0, 0, superseded)
+        self.assertEqual(previewer._cache[0], "first")
+        self.assertEqual(len(previewer.started), 2)
+
+        # a key unit seek gives the keyframe before the segment, which may
+        # be closer to the superseded segment
+        previewer._finishThumbnail("keyframe", 40 * gst.SECOND, 0,
+            previewer._seek_ids[0])
+        self.assertEqual(previewer._cache[100 * gst.SECOND], "keyframe")
+        self.assertEqual(previewer._cache[0], "first")
+        self.assertEqual(len(previewer.started), 3)
@@ -0,0 +1,94 @@
+from unittest import TestCase
+
+import gst
+
+from pitivi.utils.discovery import CachedDiscovererInfo
+from pitivi.utils.search import MediaSearchIndex, parse_query
+
+
+def make_info(name, duration=10, video=True, tags=None):
+    streams = [{"kind": "audio", "caps": "audio/mpeg, mpegversion=1",
+                "nick": "audio", "channels": 2, "sample_rate": 48000,
+                "depth": 16, "bitrate": 0, "max_bitrate": 0}]
+    if video:
+        streams.append({"kind": "video", "caps": "video/x-h264",
+            "nick": "video", "width": 1920, "height": 1080, "depth": 24,
+            "framerate_num": 25, "framerate_denom": 1, "par_num": 1,
+            "par_denom": 1, "bitrate": 0, "max_bitrate": 0,
+            "interlaced": False, "image": False})
+    return CachedDiscovererInfo({"uri": "file:///media/" + name,
+                                 "duration": duration * gst.SECOND,
+                                 "seekable": True,
+                                 "tags": tags or {},
+                                 "streams": streams})
+
+
+class TestParseQuery(TestCase):
+
+    def testParse(self):
+        words, durations = parse_query("Beach_Day  >1.5m <2h")
+        self.assertEqual(words, ["beach", "day"])
+        self.assertEqual(durations, [(">", 90 * gst.SECOND),
+                                     ("<", 7200 * gst.SECOND)])
+
+
+class TestMediaSearchIndex(TestCase):
+
+    def setUp(self):
+        self.index = MediaSearchIndex()
+        self.uris = {}
+        for name, duration, video, tags in (
+                ("beach_day.mp4", 10, True, None),
+                ("Beach%20Night.mp4", 100, True, None),
+                ("interview.mp3", 1000, False, {"title": "Mayor Interview"}),
+                ("forest.mp4", 5, True, None)):
+            info = make_info(name, duration, video, tags)
+            self.uris[name] = info.get_uri()
+            self.assertTrue(self.index.add(info))
+
+    def _visible(self):
+        return sorted(name for name, uri in self.uris.iteritems()
+                      if self.index.isVisible(uri))
+
+    def testPrefix(self):
+        shown, hidden = self.index.setQuery("bea")
+        self.assertEqual(shown, set())
+        self.assertEqual(len(hidden), 2)
+        self.assertEqual(self._visible(),
+                         ["Beach%20Night.mp4", "beach_day.mp4"])
+
+        # narrowing the query
+        shown, hidden = self.index.setQuery("beach n")
+        self.assertEqual(hidden, set([self.uris["beach_day.mp4"]]))
+        self.assertEqual(self._visible(), ["Beach%20Night.mp4"])
+
+        # widening it again
+        shown, hidden = self.index.setQuery("")
+        self.assertEqual(len(shown), 3)
+        self.assertEqual(len(self._visible()), 4)
+
+    def testMetadata(self):
+        self.index.setQuery("h264 1080p")
+        self.assertEqual(self._visible(),
+            ["Beach%20Night.mp4", "beach_day.mp4", "forest.mp4"])
+        self.index.setQuery("mayor")
+        self.assertEqual(self._visible(), ["interview.mp3"])
+        self.index.setQuery("forest.mp")
+        self.assertEqual(self._visible(), ["forest.mp4"])
+
+    def testDuration(self):
+        self.index.setQuery(">1m")
+        self.assertEqual(self._visible(),
+                         ["Beach%20Night.mp4", "interview.mp3"])
+        self.index.setQuery(">1m <10m beach")
+        self.assertEqual(self._visible(), ["Beach%20Night.mp4"])
+
+    def testAddRemove(self):
+        self.index.setQuery("beach")
+        self.assertFalse(self.index.add(make_info("lake.mp4")))
+        self.assertTrue(self.index.add(make_info("beach_2.mp4")))
+        self.index.remove(self.uris["beach_day.mp4"])
+        self.assertFalse(self.uris["beach_day.mp4"] in self.index)
+        shown, hidden = self.index.setQuery("")
+        self.assertEqual(len(shown), 3)
+        self.assertEqual(len(self.index), 5)
@@ -0,0 +1,98 @@
+from unittest import TestCase
+
+from pitivi.utils.timeline import UriUsageIndex
+
+
+class FakeGObject(object):
+
+    def __init__(self):
+        self.handlers = []
+
+    def connect(self, signal, callback):
+        self.handlers.append((signal, callback))
+
+    def disconnect_by_func(self, callback):
+        self.handlers = [(signal, handler) for signal, handler
+                         in self.handlers if handler != callback]
+
+    def emit(self, signal, *args):
+        for handler_signal, handler in list(self.handlers):
+            if handler_signal == signal:
+                handler(self, *args)
+
+
+class FakeLayer(FakeGObject):
+
+    def __init__(self):
+        FakeGObject.__init__(self)
+        self.objects = []
+
+    def get_objects(self):
+        return list(self.objects)
+
+    def add_object(self, obj):
+        self.objects.append(obj)
+        self.emit("object-added", obj)
+
+    def remove_object(self, obj):
+        self.objects.remove(obj)
+        self.emit("object-removed", obj)
+
+
+class FakeTimeline(FakeGObject):
+
+    def __init__(self, layers):
+        FakeGObject.__init__(self)
+        self.layers = layers
+
+    def get_layers(self):
+        return list(self.layers)
+
+
+class FakeSource(object):
+
+    def __init__(self, uri):
+        self.uri = uri
+
+    def get_uri(self):
+        return self.uri
+
+
+class TestUriUsageIndex(TestCase):
+
+    def setUp(self):
+        self.layer = FakeLayer()
+        self.clip = FakeSource("file:///media/a%20clip.ogv")
+        self.layer.add_object(self.clip)
+        self.timeline = FakeTimeline([self.layer])
+        self.usage = UriUsageIndex(self.timeline)
+
+    def testExistingObjects(self):
+        # the URIs are quoted before being compared
+        self.assertTrue(self.usage.isUsed("file:///media/a clip.ogv"))
+        self.assertEqual(self.usage.getObjects("file:///media/a%20clip.ogv"),
+                         [self.clip])
+
+    def testAddRemove(self):
+        other = FakeSource("file:///media/a%20clip.ogv")
+        self.layer.add_object(other)
+        # transitions have no URI
+        self.layer.add_object(object())
+        self.assertEqual(self.usage.getUseCount("file:///media/a%20clip.ogv"),
+                         2)
+        self.layer.remove_object(self.clip)
+        self.assertTrue(self.usage.isUsed("file:///media/a%20clip.ogv"))
+        self.layer.remove_object(other)
+        self.assertFalse(self.usage.isUsed("file:///media/a%20clip.ogv"))
+        self.assertEqual(self.usage.getUris(), [])
+
+    def testLayers(self):
+        layer = FakeLayer()
+        layer.add_object(FakeSource("file:///media/b.ogv"))
+        self.timeline.emit("layer-added", layer)
+        self.assertTrue(self.usage.isUsed("file:///media/b.ogv"))
+        self.timeline.emit("layer-removed", layer)
+        self.assertFalse(self.usage.isUsed("file:///media/b.ogv"))
+        # not tracked anymore
+        layer.add_object(FakeSource("file:///media/c.ogv"))
+        self.assertFalse(self.usage.isUsed("file:///media/c.ogv"))
@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase, skipIf
+
+import pitivi.utils.waveform as waveform
+from pitivi.utils.waveform import compute_peaks, PeakFile, PeakFileBuilder, \
+    PeakFileError, PEAK_BLOCK
+
+
+class TestComputePeaks(TestCase):
+
+    # two channels, the second one being the opposite of the first one
+    samples = [0.1, -0.1, 0.5, -0.5, -0.2, 0.2, 0.3, -0.3, 0.9, -0.9]
+
+    def _checkPeaks(self):
+        mins, maxs = compute_peaks(self.samples, 2, 2)
+        # the fifth frame doesn't fit in a column
+        self.assertEqual(len(mins[0]), 2)
+        self.assertAlmostEqual(mins[0][0], 0.1)
+        self.assertAlmostEqual(maxs[0][0], 0.5)
+        self.assertAlmostEqual(mins[0][1], -0.2)
+        self.assertAlmostEqual(maxs[0][1], 0.3)
+        self.assertAlmostEqual(mins[1][0], -0.5)
+        self.assertAlmostEqual(maxs[1][1], 0.2)
+
+        # not enough samples for the requested columns
+        mins, maxs = compute_peaks(self.samples, 2, 10)
+        self.assertEqual(len(mins[0]), 5)
+        self.assertAlmostEqual(maxs[0][4], 0.9)
+
+    def testPeaks(self):
+        self._checkPeaks()
+
+    def testPeaksWithoutNumpy(self):
+        numpy = waveform.numpy
+        waveform.numpy = None
+        try:
+            self._checkPeaks()
+        finally:
+            waveform.numpy = numpy
+
+
+class TestPeakFile(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "test.peaks")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @skipIf(waveform.numpy is None, "NumPy is not available")
+    def testRoundTrip(self):
+        numpy = waveform.numpy
+        frames = PEAK_BLOCK * 100 + 10
+        ramp = numpy.linspace(-1.0, 1.0, frames).astype(numpy.float32)
+        samples = numpy.column_stack((ramp, -ramp)).ravel()
+
+        builder = PeakFileBuilder(self.path, 44100, 2)
+        # chunks which don't match the blocks
+        for start in xrange(0, len(samples), 1000):
+            builder.receive(samples[start:start + 1000])
+        builder.finalize()
+
+        peaks = PeakFile(self.path)
+        self.assertEqual(peaks.rate, 44100)
+        self.assertEqual(peaks.channels, 2)
+        self.assertEqual([len(level) for level in peaks.levels],
+            [101, 26, 7, 2, 1])
+
+        mins, maxs = peaks.peaks(0, frames, 4)
+        self.assertEqual(mins.shape, (2, 4))
+        self.assertAlmostEqual(mins[0][0], -1.0, 3)
+        self.assertAlmostEqual(maxs[0][3], 1.0, 3)
+        self.assertAlmostEqual(maxs[1][0], 1.0, 3)
+        # the columns are increasing on the first channel
+        self.assertTrue((numpy.diff(maxs[0]) > 0).all())
+
+        # zoomed in past the first level
+        mins, maxs = peaks.peaks(0, PEAK_BLOCK, 10)
+        self.assertEqual(mins.shape, (2, 10))
+
+        # past the end of the stream
+        mins, maxs = peaks.peaks(frames * 2, frames, 10)
+        self.assertEqual(mins.shape, (2, 0))
+
+    @skipIf(waveform.numpy is None, "NumPy is not available")
+    def testTruncated(self):
+        builder = PeakFileBuilder(self.path, 44100, 1)
+        builder.receive(waveform.numpy.zeros(PEAK_BLOCK * 4))
+        builder.finalize()
+        with open(self.path, "r+b") as peak_file:
+            peak_file.truncate(os.path.getsize(self.path) - 1)
+        self.assertRaises(PeakFileError, PeakFile, self.path)